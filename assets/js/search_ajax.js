@@ -1,11 +1,12 @@
 // Requests the results to the server.
 // Thanks to vhf for his precious help for the debug.
 
-function request_results (radius, userLatitude, userLongitude, searchPresetId, noPrivate) {
+function request_results (radius, userLatitude, userLongitude, searchPresetId, noPrivate, clientRendering) {
     window.map_results = [];
     console.log('Starting request...')
     $.ajax({
-        url: '/getresults/', // Destination URL.
+        // The structured results (rendered here), or the HTML blocks.
+        url: clientRendering ? '/api/v1/results/' : '/getresults/', // Destination URL.
         type: 'POST', // HTTP method.
         data: { // Data sent with the post request.
             radius: radius,
@@ -20,46 +21,13 @@ function request_results (radius, userLatitude, userLongitude, searchPresetId, n
             // Logs the returned json to the console.
             console.log('received:', JSON.stringify(json, null, 2));
             if (json.status != "ok") {
-                console.log('Error : Request status != "ok"');
-                console.log(json.debug_msg);
-                $('#geo_results').html('<em class="center">' + json.err_msg + "</em>");
-                $('#geo_results').attr("aria-live", "assertive");
-                $('#geo_results').attr("aria-busy", "false");
+                show_error(json);
                 return
             }
-            if (json.fail_msg) {
-                console.log('json content is empty')
-                $('#geo_results').html(json.fail_msg);
-                $('#geo_results').attr("aria-live", "assertive");
-                $('#geo_results').attr("aria-busy", "false");
-                console.log('Success, but no results !');
-                return
-            }
-            // Fills the page.
-            $('#geo_results').html('<ul id="results_list">' + json.content.join('') + '</ul>');
-            window.map_results = json.map_data;
-            console.log('Map data: ' + map_results);
-            // Enables the button to load the map.
-            $('#map_getter').prop("disabled", false);
-            // Hides all the links to the map, as it is not loaded yet.
-            $('.seeonmap-link').hide();
-            // Updates the ARIA.
-            $('#geo_results').attr("aria-live", "assertive");
-            $('#geo_results').attr("aria-busy", "false");
-            // Makes popovers open on top on small screens.
-            if ($(document).width() < 768) {
-                console.log("Small screen detected, popovers will open on top.");
-                var popovers = document.querySelectorAll('[data-toggle="popover"]');
-                for (i=0; i < popovers.length; i++) {
-                        popovers[i].setAttribute("data-placement", "top");
-                }
+            if (clientRendering) {
+                json = render_results(json);
             }
-            // Enables popovers.
-            $('[data-toggle="popover"]').popover();
-            // Loads filters.
-            $('#results_filters').html(json.filters);
-            console.log(json.filters);
-            console.log('Success !');
+            show_results(json);
         },
 
         // Handles a non-successful response.
@@ -73,3 +41,299 @@ function request_results (radius, userLatitude, userLongitude, searchPresetId, n
         },
     })
 };
+
+function show_error (json) {
+    console.log('Error : Request status != "ok"');
+    console.log(json.debug_msg);
+    $('#geo_results').html('<em class="center">' + json.err_msg + "</em>");
+    $('#geo_results').attr("aria-live", "assertive");
+    $('#geo_results').attr("aria-busy", "false");
+}
+
+// Fills the page with the results (in the format of "/getresults/").
+function show_results (json) {
+    if (json.fail_msg) {
+        console.log('json content is empty')
+        $('#geo_results').html(json.fail_msg);
+        $('#geo_results').attr("aria-live", "assertive");
+        $('#geo_results').attr("aria-busy", "false");
+        console.log('Success, but no results !');
+        return
+    }
+    // Fills the page.
+    $('#geo_results').html('<ul id="results_list">' + json.content.join('') + '</ul>');
+    window.map_results = json.map_data;
+    console.log('Map data: ' + map_results);
+    // Enables the button to load the map.
+    $('#map_getter').prop("disabled", false);
+    // Hides all the links to the map, as it is not loaded yet.
+    $('.seeonmap-link').hide();
+    // Updates the ARIA.
+    $('#geo_results').attr("aria-live", "assertive");
+    $('#geo_results').attr("aria-busy", "false");
+    // Makes popovers open on top on small screens.
+    if ($(document).width() < 768) {
+        console.log("Small screen detected, popovers will open on top.");
+        var popovers = document.querySelectorAll('[data-toggle="popover"]');
+        for (i=0; i < popovers.length; i++) {
+                popovers[i].setAttribute("data-placement", "top");
+        }
+    }
+    // Enables popovers.
+    $('[data-toggle="popover"]').popover();
+    // Loads filters.
+    $('#results_filters').html(json.filters);
+    console.log(json.filters);
+    console.log('Success !');
+}
+
+// Receives the results as Server-Sent Events: the results are shown
+// at once, then their addresses as soon as they are found.
+function stream_results (radius, userLatitude, userLongitude, searchPresetId, noPrivate) {
+    window.map_results = [];
+    console.log('Starting stream...')
+    var data = null;
+    var results = {};
+    var source = new EventSource('/getresults/stream/?' + $.param({
+        radius: radius,
+        user_latitude: userLatitude,
+        user_longitude: userLongitude,
+        search_preset_id: searchPresetId,
+        no_private: noPrivate,
+    }));
+    source.addEventListener('results', function (event) {
+        data = JSON.parse(event.data);
+        console.log('received:', JSON.stringify(data, null, 2));
+        var json = render_results(data);
+        // Sent by the server with the "filters" event.
+        json.filters = '';
+        show_results(json);
+        // Keeps the results, to update them with their address.
+        data.results.forEach(function (record, index) {
+            var result = read_record(data.fields, record);
+            result.index = index;
+            results[result.type + '_' + result.id] = result;
+        });
+    });
+    source.addEventListener('addresses', function (event) {
+        JSON.parse(event.data).addresses.forEach(function (address) {
+            var result = results[address[0] + '_' + address[1]];
+            if (!result) {
+                return;
+            }
+            result.address = address[2];
+            // The address is rendered (and escaped) by the server.
+            $('#result_' + address[0] + '_' + address[1] + '_address').html(address[2]);
+            var popup = render_marker_popup(result, data);
+            window.map_results[result.index][2] = popup;
+            if (window.allMarkers) {
+                window.allMarkers.eachLayer(function (marker) {
+                    if (marker.options.result_id == window.map_results[result.index][3]) {
+                        marker.getPopup().setContent(popup);
+                    }
+                });
+            }
+        });
+    });
+    source.addEventListener('filters', function (event) {
+        $('#results_filters').html(JSON.parse(event.data).filters);
+    });
+    source.addEventListener('done', function (event) {
+        // Otherwise, the browser would send the request again.
+        source.close();
+        console.log('Success !');
+    });
+    source.addEventListener('failure', function (event) {
+        source.close();
+        show_error(JSON.parse(event.data));
+    });
+    source.onerror = function (event) {
+        source.close();
+        if (data === null) {
+            $('#geo_results').html('<em class="center">Error 500</em>')
+            $('#map_getter').prop("disabled", false);
+        }
+    };
+}
+
+// Renders the structured results of "/api/v1/results/" (version 1)
+// like the "/getresults/" view, which renders them on the server.
+
+function escape_html (text) {
+    return String(text)
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;')
+        .replace(/'/g, '&#39;');
+}
+
+// Replaces the "%(name)s" of a translated message.
+function format_message (message, values) {
+    return message.replace(/%\((\w+)\)s/g, function (match, name) {
+        return values[name];
+    });
+}
+
+// Returns a number with the decimal separator of the language.
+function localize_number (number, data) {
+    return String(number).replace('.', data.labels.decimal_separator);
+}
+
+// Returns an object of the fields of a record.
+function read_record (fields, record) {
+    var result = {};
+    for (var i = 0; i < fields.length; i++) {
+        result[fields[i]] = record[i];
+    }
+    return result;
+}
+
+function render_result_block (result, data) {
+    var labels = data.labels;
+    var messages = labels.messages;
+    var anchor = 'result_' + result.type + '_' + result.id;
+    var direction = labels.directions[Math.floor((result.bearing + 22.5) / 45) % 8];
+    var tags = result.tags.map(function (tag) { return labels.tags[tag][0]; });
+    var html = '<div role="article" class="result-box" id="' + anchor + '_block" itemscope itemprop="item" itemtype="http://schema.org/Place">';
+    html += '<a href="http://www.openstreetmap.org/' + result.type + '/' + result.id + '"><img class="osm-link-logo" src="/static/images/osm_logo.png" alt="' + escape_html(messages.osm_link) + '"></a>';
+    html += '<span class="result_tags" style="visibility:hidden" aria-hidden="true">' + escape_html(tags.join(';')) + '</span>';
+    html += '<div itemprop="geo" itemscope itemtype="http://schema.org/GeoCoordinates">';
+    html += '<meta itemprop="latitude" content="' + localize_number(result.lat, data) + '"/>';
+    html += '<meta itemprop="longitude" content="' + localize_number(result.lon, data) + '"/>';
+    html += '</div>';
+    if (result.name) {
+        html += '<p style="margin-top: -1em;" itemprop="name">' + escape_html(messages.name) + escape_html(result.name) + '<br/></p>';
+    } else {
+        html += '<div style="margin-top: -1em;"></div>';
+    }
+    if (result.description) {
+        html += '<hr/><p>' + escape_html(result.description) + '</p><hr/>';
+    }
+    if (result.open !== null) {
+        html += '<p><b>' + escape_html(result.open ? messages.open : messages.closed) + '</b><br/></p>';
+    }
+    html += '<p>' + escape_html(format_message(messages.distance, {distance: localize_number(result.distance, data)})) + '<br/>';
+    html += escape_html(format_message(messages.direction, {bearing: localize_number(result.bearing, data), direction: direction})) + '<br/></p>';
+    html += '<a href="javascript: see_on_map(\'' + anchor + '_map\')" class="seeonmap-link"><span class="glyphicon glyphicon-tag inline-icon" aria-hidden="true"></span>' + escape_html(messages.see_on_map) + '</a>';
+    if (result.phone) {
+        html += '<br/><span class="glyphicon glyphicon-phone-alt inline-icon" aria-hidden="true"></span>';
+        html += escape_html(messages.phone) + '<a href="tel:' + escape_html(result.phone) + '" itemprop="telephone">' + escape_html(result.phone) + '</a><br/>';
+    }
+    if (result.website) {
+        html += '<span class="glyphicon glyphicon-globe inline-icon" aria-hidden="true"></span>';
+        html += escape_html(messages.website) + '<a href="' + escape_html(result.website) + '" itemprop="url">' + escape_html(result.website) + '</a><br/>';
+    }
+    html += '<p style="margin-top: 1em; margin-bottom: 1em;" itemprop="address" itemscope itemtype="http://schema.org/PostalAddress">' + render_address(result, data) + '</p>';
+    if (result.schedules !== null) {
+        var schedules = escape_html(labels.schedules[result.schedules]).replace(/\n/g, '<br/>');
+        html += '<p><button type="button" class="btn btn-default" data-toggle="popover" title="' + escape_html(messages.opening_hours) + '" data-content="' + escape_html(schedules) + '" data-html="true" data-placement="right">';
+        html += '<span class="glyphicon glyphicon-time inline-icon" aria-hidden="true"></span>' + escape_html(messages.opening_hours) + '</button></p>';
+    }
+    var properties = render_properties(result, data);
+    if (properties) {
+        html += '<p>' + properties + '</p>';
+    }
+    var itinerary = 'https://www.openstreetmap.org/directions?engine=graphhopper_foot&route=' + data.user[0] + ',' + data.user[1] + ';' + result.lat + ',' + result.lon;
+    html += '<p><a href="' + escape_html(itinerary) + '"><span class="glyphicon glyphicon-road inline-icon" aria-hidden="true"></span>' + escape_html(messages.itinerary) + '</a></p>';
+    html += '</div>';
+    return html;
+}
+
+// The addresses not found yet (see "stream_results") are sent later.
+function render_address (result, data) {
+    if (result.address === null) {
+        return '<span id="result_' + result.type + '_' + result.id + '_address">' + escape_html(data.labels.messages.pending_address) + '</span>';
+    }
+    // The address is rendered (and escaped) by the server.
+    return result.address;
+}
+
+function render_properties (result, data) {
+    var strings = data.labels.strings;
+    return result.properties.map(function (property) {
+        return escape_html(strings[property[0]] + ' : ' + strings[property[1]]);
+    }).join('<br/>');
+}
+
+function render_marker_popup (result, data) {
+    var labels = data.labels;
+    var messages = labels.messages;
+    var anchor = 'result_' + result.type + '_' + result.id;
+    var direction = labels.directions[Math.floor((result.bearing + 22.5) / 45) % 8];
+    var html = '<div name="#' + anchor + '_map">';
+    if (result.name) {
+        html += '<span class="center">' + escape_html(result.name) + '</span>';
+    }
+    html += '<br/><a href="#' + anchor + '_block"><span class="glyphicon glyphicon-tag inline-icon" aria-hidden="true"></span>' + escape_html(messages.see_block) + '</a><br/>';
+    if (result.open !== null) {
+        html += '<p><b>' + escape_html(result.open ? messages.open : messages.closed) + '</b><br/></p>';
+    }
+    html += '<p>' + escape_html(result.address === null ? data.labels.messages.pending_address : result.address) + '</p>';
+    html += '<p>' + escape_html(format_message(messages.distance, {distance: localize_number(result.distance, data)})) + '<br/>';
+    html += escape_html(format_message(messages.direction, {bearing: localize_number(result.bearing, data), direction: direction})) + '<br/></p>';
+    if (result.phone) {
+        html += '<span class="glyphicon glyphicon-phone-alt inline-icon" aria-hidden="true"></span>';
+        html += escape_html(messages.phone) + '<a href="tel:' + escape_html(result.phone) + '">' + escape_html(result.phone) + '</a><br/>';
+    }
+    var properties = render_properties(result, data);
+    if (properties) {
+        html += '<p>' + properties + '</p>';
+    }
+    html += '</div>';
+    return html;
+}
+
+function render_filter_panel (results, data) {
+    var labels = data.labels;
+    var counts = {};
+    var i, j;
+    for (i = 0; i < results.length; i++) {
+        for (j = 0; j < results[i].tags.length; j++) {
+            counts[results[i].tags[j]] = (counts[results[i].tags[j]] || 0) + 1;
+        }
+    }
+    // Ordered by the key of their tag.
+    var tags = Object.keys(counts).map(Number).sort(function (a, b) {
+        return labels.tags[a][2] < labels.tags[b][2] ? -1 : (labels.tags[a][2] > labels.tags[b][2] ? 1 : 0);
+    });
+    if (tags.length == 0) {
+        return '';
+    }
+    var html = '<div class="panel panel-default"><div class="panel-heading" role="tab" id="headingTwo"><h4 class="panel-title">';
+    html += '<a class="collapsed" role="button" data-toggle="collapse" data-parent="#accordion" href="#collapseTwo" aria-expanded="false" aria-controls="collapseTwo">';
+    html += '<span class="center">' + escape_html(labels.messages.filter) + ' <span class="badge">' + results.length + '</span></span></a></h4></div>';
+    html += '<div id="collapseTwo" class="panel-collapse collapse" role="tabpanel" aria-labelledby="headingTwo"><div class="panel-body">';
+    for (i = 0; i < tags.length; i++) {
+        var slug = escape_html(labels.tags[tags[i]][0]);
+        html += '<input type="checkbox" checked onchange="filter_results_handler(this)" name="result_filter" id="filter_' + slug + '" value="' + slug + '">';
+        html += '<label for="filter_' + slug + '"> ' + escape_html(labels.tags[tags[i]][1]) + ' <span class="badge">' + counts[tags[i]] + '</span></label><br/>';
+    }
+    html += '</div></div></div>';
+    return html;
+}
+
+// Returns the response of "/getresults/" from the structured results.
+function render_results (data) {
+    var results = data.results.map(function (record) {
+        return read_record(data.fields, record);
+    });
+    if (results.length == 0) {
+        return {
+            fail_msg: '<em class="center">' + escape_html(data.labels.messages.no_results) + '</em>'
+        };
+    }
+    return {
+        content: results.map(function (result) {
+            return '<li>' + render_result_block(result, data) + '</li>';
+        }),
+        map_data: results.map(function (result) {
+            return [
+                [result.type, result.id], [result.lat, result.lon],
+                render_marker_popup(result, data),
+                'result_' + result.type + '_' + result.id + '_map'
+            ];
+        }),
+        filters: render_filter_panel(results, data),
+    };
+}
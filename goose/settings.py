@@ -51,7 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'django.middleware.gzip.GZipMiddleware',
+    'search.middleware.StreamingGZipMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -241,6 +241,35 @@ GOOSE_META = {
     ),
     "max_geolocation_attempts": 3,
     "radius_extreme_values": [100, 2000],
+    # Maximum number of results returned in a page by "/getresults/".
+    "max_page_size": 100,
+}
+
+
+# API
+
+# The results page requests the structured results of "/api/v1/results/"
+# and renders them with JS. Set "client_rendering" to False to get the
+# HTML blocks rendered by the server from "/getresults/" instead.
+# With "server_sent_events", the structured results are received from
+# "/getresults/stream/" (if the browser supports it), and the addresses
+# are shown as soon as they are found.
+GOOSE_API = {
+    "client_rendering": True,
+    "server_sent_events": True,
+}
+
+
+# Light version
+
+# The results of "/light/" are streamed: the head of the page is sent at
+# once, then the blocks of the results by chunks of 'chunk_size', each
+# one when the addresses of its results are found, or after 'address_wait'
+# seconds. The late addresses are filled in at the end of the page.
+GOOSE_LIGHT = {
+    "streaming": True,
+    "chunk_size": 10,
+    "address_wait": 2,
 }
 
 
@@ -248,3 +277,181 @@ GOOSE_META = {
 
 RATELIMIT_ENABLE = not TESTING
 
+
+
+# Caching
+
+GOOSE_CACHE = {
+    # Size (in degrees) of the grid tiles in which the Overpass data
+    # is requested and cached, for each line of the OSM keys.
+    "tile_size": 0.01,
+    "tiles_max_size": 4096,
+    # In seconds.
+    "tiles_ttl": 3600,
+    # During this delay after the TTL, a stale tile is still served,
+    # while it is refreshed in the background.
+    "tiles_stale_ttl": 3600,
+    # The concurrent identical upstream requests are sent only once.
+    # To also deduplicate them across the worker processes, set a
+    # directory for the lock files; the results are then shared
+    # during 'single_flight_ttl' seconds.
+    "single_flight_dir": None,
+    "single_flight_ttl": 10,
+    # The parsed opening hours (and their week schedules) are shared
+    # by the results with the same "opening_hours" tag.
+    "opening_hours_max_size": 4096,
+    "opening_hours_ttl": 86400,
+    # The compiled processing rules (of the presets and of their filters)
+    # are cached for each version of the presets.
+    "compiled_rules_max_size": 256,
+    "compiled_rules_ttl": 86400,
+    # The addresses of the results obtained by reverse geocoding are
+    # stored in the database during 'addresses_ttl' seconds. They are
+    # keyed by their coordinates, rounded to 'addresses_precision'
+    # decimals (5 is about 1 meter).
+    "addresses_ttl": 30 * 86400,
+    "addresses_precision": 5,
+    # The addresses of the positions of the users are only kept in
+    # memory, during 'positions_ttl' seconds.
+    "positions_max_size": 1024,
+    "positions_ttl": 600,
+    # The rendered blocks and popups of the results, without the parts
+    # depending on the user (distance...) or on the time (open state...).
+    "fragments_max_size": 4096,
+    "fragments_ttl": 86400,
+}
+
+
+# Overpass
+
+GOOSE_OVERPASS = {
+    # Server-side limits of each query, sent as "[timeout:]" (in
+    # seconds) and "[maxsize:]" (in bytes). The client timeout is
+    # set in GOOSE_UPSTREAM.
+    "timeout": 25,
+    "maxsize": 16 * 1024 * 1024,
+    # The requests are sent to the fastest endpoint, then "hedged" (sent
+    # again to the next one) if it did not answer after this percentile
+    # of its recent latencies (but at least after 'min_hedge_delay').
+    "endpoints": [
+        "https://overpass-api.de/api/interpreter",
+        "https://overpass.kumi.systems/api/interpreter",
+        "https://overpass.openstreetmap.fr/api/interpreter",
+    ],
+    "hedge_percentile": 90,
+    "min_hedge_delay": 0.5,
+}
+
+
+# Upstream services
+
+GOOSE_UPSTREAM = {
+    # The timeouts are in seconds. After 'failure_threshold' consecutive
+    # failures, a service is considered as down (its circuit is "open")
+    # and is not requested anymore during 'reset_timeout' seconds.
+    # For Overpass, each endpoint has its own circuit.
+    "overpass": {"timeout": 30, "failure_threshold": 5, "reset_timeout": 60},
+    "ban": {
+        "timeout": 10, "failure_threshold": 5, "reset_timeout": 60,
+        # The addresses of the large result sets are requested
+        # in several batches, sent in parallel.
+        "batch_size": 200, "parallel_batches": 4,
+    },
+    "nominatim": {
+        "timeout": 10, "failure_threshold": 5, "reset_timeout": 60,
+        # The usage policy of Nominatim allows one request per second.
+        # The requests are delayed to respect it (by process), but
+        # are given up if they should wait more than 'max_wait' seconds.
+        "rate": 1, "burst": 1, "max_wait": 5,
+    },
+    # The retries wait for a random delay, between 0 and
+    # 'backoff_base * 2 ** attempt' seconds (at most 'backoff_max').
+    "backoff_base": 0.25,
+    "backoff_max": 4,
+}
+
+
+# HTTP
+
+# All the calls to the upstream services share a session, which keeps
+# the connections alive in a pool for each host (of at most
+# 'pool_maxsize' connections). 'pool_connections' is the number of
+# hosts whose pool is kept. 'pool_maxsizes' overrides the size of the
+# pools by URL prefix (like "https://overpass-api.de").
+GOOSE_HTTP = {
+    "user_agent": "Goose (https://github.com/rezemika/goose-search)",
+    "pool_connections": 10,
+    "pool_maxsize": 16,
+    "pool_maxsizes": {},
+}
+
+
+# Search pipeline
+
+GOOSE_PIPELINE = {
+    # Size of the thread pool running the blocking stages of the searches.
+    "max_workers": 16,
+    # Maximum number of concurrent Nominatim requests for a search.
+    "nominatim_parallelism": 4,
+    # In seconds. The addresses not obtained with Nominatim after this
+    # delay are left empty, rather than delaying the results.
+    "nominatim_deadline": 8,
+}
+
+
+# Geometry
+
+GOOSE_GEOMETRY = {
+    # Formula used to compute the distances of the results:
+    # "vincenty" (on the WGS-84 ellipsoid) or "haversine" (on a
+    # sphere, faster but up to 0.5% less precise).
+    "distance_model": "vincenty",
+}
+
+
+# Search backend
+
+# "overpass" requests the Overpass API. "local" uses an index built
+# from an OSM extract, with the 'load_osm_extract' command (which
+# requires pyosmium to read ".osm.pbf" files).
+GOOSE_SEARCH_BACKEND = "overpass"
+
+GOOSE_LOCAL_ENGINE = {
+    "index_path": os.path.join(BASE_DIR, "data", "osm_index.pickle"),
+    # Size (in degrees) of the grid tiles of the index.
+    "tile_size": 0.01,
+}
+
+
+# Timezones
+
+# The timezones are found with a grid built by the 'build_timezone_grid'
+# command (which requires Shapely). The positions in the cells crossed
+# by a border are looked up in the polygons of the timezones, and their
+# timezone is cached for the positions rounded to 'cache_precision'
+# decimals (3 is about 100 meters).
+GOOSE_TIMEZONES = {
+    "grid_path": os.path.join(BASE_DIR, "data", "timezone_grid"),
+    # In degrees. Must divide 0.5.
+    "cell_size": 0.25,
+    "cache_precision": 3,
+    "cache_max_size": 4096,
+    "cache_ttl": 86400,
+}
+
+
+# Local geocoder
+
+# Finds the addresses of the results (and of the users) in an index
+# built from a dump of the "Base Adresse Nationale" with the
+# 'load_ban_addresses' command, instead of requesting the BAN API.
+# The places without address nearby still fall back on Nominatim.
+GOOSE_LOCAL_GEOCODER = {
+    "enabled": False,
+    "index_path": os.path.join(BASE_DIR, "data", "ban_index"),
+    # Size (in degrees) of the grid cells of the index.
+    "cell_size": 0.005,
+    # In meters. Must be smaller than a cell (about 350 meters
+    # of longitude at the latitude of Dunkirk).
+    "max_distance": 200,
+}
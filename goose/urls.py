@@ -7,10 +7,13 @@ urlpatterns = [
     url(r'^$', views.home, name='home'),
     url(r'^results/$', views.results, name='results'),
     url(r'^getresults/$', views.get_results, name='getresults'),
+    url(r'^getresults/stream/$', views.get_results_stream, name='getresults-stream'),
+    url(r'^api/v1/results/$', views.api_results, name='api-results'),
     url(r'^getmap/$', views.get_map, name='getmap'),
     url(r'^about/$', views.about, name='about'),
     url(r'^light/$', views.light_home, name='light'),
     url(r'^light/about/$', views.about, name='light-about'),
+    url(r'^status/$', views.status, name='status'),
     url(r'^admin/', admin.site.urls),
     url(r'^i18n/', include('django.conf.urls.i18n'))
 ]
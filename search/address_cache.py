@@ -0,0 +1,136 @@
+#  A persistent cache of the addresses obtained by reverse geocoding,
+#  stored in the database, as the address of a place almost never changes.
+
+import json
+import threading
+import datetime
+from collections import OrderedDict
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from goose import settings
+from search import caching
+from search.models import CachedAddress
+
+class AddressCacheStats:
+    """
+        Counts the lookups in the cache, to expose them in '/status/'.
+    """
+    def __init__(self, name):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        caching.registry[name] = self
+        return
+    
+    def record(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        return
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": CachedAddress.objects.count(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+address_stats = AddressCacheStats("addresses")
+
+def round_coordinates(coords):
+    precision = settings.GOOSE_CACHE["addresses_precision"]
+    return "{:.{p}f},{:.{p}f}".format(coords[0], coords[1], p=precision)
+
+def result_key(source, result):
+    """
+        Returns the key of the address of a result given by a source
+        ("ban" or "nominatim"). It includes the coordinates, so that
+        the address of a moved element is requested again.
+    """
+    return "{}:{}_{}@{}".format(
+        source, result.osm_meta[0], result.osm_meta[1],
+        round_coordinates(result.coordinates)
+    )
+
+def coordinates_key(source, coords):
+    """
+        Returns the key of the address of some coordinates
+        (like the position of a user).
+    """
+    return "{}:{}".format(source, round_coordinates(coords))
+
+# The addresses of the positions of the users are not stored in the
+# database, for privacy's sake, but only kept in memory for a while.
+positions_cache = caching.TTLCache(
+    "positions_addresses",
+    max_size=settings.GOOSE_CACHE["positions_max_size"],
+    ttl=settings.GOOSE_CACHE["positions_ttl"]
+)
+
+def get_position(source, coords):
+    """
+        Returns the data cached for the address of a position,
+        or caching.MISSING.
+    """
+    return positions_cache.get(coordinates_key(source, coords))
+
+def set_position(source, coords, data):
+    positions_cache.set(coordinates_key(source, coords), data)
+    return
+
+def get_expiry():
+    return timezone.now() - datetime.timedelta(
+        seconds=settings.GOOSE_CACHE["addresses_ttl"]
+    )
+
+def get_many(keys):
+    """
+        Returns a dict of the data cached (and not expired)
+        for the given keys.
+    """
+    keys = list(OrderedDict.fromkeys(keys))
+    if not keys:
+        return {}
+    cached = {
+        key: json.loads(data) for key, data in CachedAddress.objects.filter(
+            key__in=keys, updated__gte=get_expiry()
+        ).values_list("key", "data")
+    }
+    address_stats.record(len(cached), len(keys) - len(cached))
+    return cached
+
+def get(key):
+    """
+        Returns the data cached for the given key, or caching.MISSING.
+    """
+    return get_many([key]).get(key, caching.MISSING)
+
+def set_many(items):
+    """
+        Caches the data of a dict of the form {key: data}.
+    """
+    if not items:
+        return
+    try:
+        with transaction.atomic():
+            CachedAddress.objects.filter(key__in=items.keys()).delete()
+            CachedAddress.objects.bulk_create([
+                CachedAddress(key=key, data=json.dumps(data))
+                for key, data in items.items()
+            ])
+    except IntegrityError:
+        # Cached at the same time by a concurrent search.
+        pass
+    return
+
+def set(key, data):
+    set_many({key: data})
+    return
+
+def purge_expired():
+    """
+        Deletes the expired addresses and returns their number.
+    """
+    return CachedAddress.objects.filter(updated__lt=get_expiry()).delete()[0]
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from search.models import SearchPreset, Filter
+from django.utils.translation import ugettext_lazy as _
+from search.models import SearchPreset, Filter, CachedAddress
+from search import address_cache
 
 class SearchPresetAdmin(admin.ModelAdmin):
     list_display   = ("name", "id")
@@ -7,5 +9,23 @@ class SearchPresetAdmin(admin.ModelAdmin):
 class FilterAdmin(admin.ModelAdmin):
     list_display   = ("name", "id")
 
+def purge_expired_addresses(modeladmin, request, queryset):
+    count = address_cache.purge_expired()
+    modeladmin.message_user(request, _("{} adresse(s) expirée(s) supprimée(s).").format(count))
+purge_expired_addresses.short_description = _("Purger les adresses expirées")
+
+def purge_selected_addresses(modeladmin, request, queryset):
+    # Without the confirmation page of "delete_selected", which lists
+    # all the addresses (select all of them to purge the cache).
+    count = queryset.delete()[0]
+    modeladmin.message_user(request, _("{} adresse(s) supprimée(s).").format(count))
+purge_selected_addresses.short_description = _("Purger les adresses sélectionnées")
+
+class CachedAddressAdmin(admin.ModelAdmin):
+    list_display   = ("key", "updated")
+    search_fields  = ("key",)
+    actions        = [purge_expired_addresses, purge_selected_addresses]
+
 admin.site.register(SearchPreset, SearchPresetAdmin)
 admin.site.register(Filter, FilterAdmin)
+admin.site.register(CachedAddress, CachedAddressAdmin)
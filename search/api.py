@@ -0,0 +1,127 @@
+#  The structured (JSON) version of the search results, rendered by the
+#  client. The strings shared by the results (labels of the tags and of
+#  the properties, opening hours...) are sent once, in tables.
+
+from django.utils import formats
+from django.utils.translation import ugettext as _
+from search import utils
+from search.tables import Table
+
+VERSION = 1
+
+# The fields of each record of "results", in this order.
+FIELDS = [
+    "type", "id", "lat", "lon", "distance", "bearing", "tags", "name",
+    "description", "phone", "website", "address", "open", "schedules",
+    "properties",
+]
+
+def get_messages():
+    """
+        Returns the translated strings used by the client to render
+        the results (using the translations of the templates).
+    """
+    return {
+        "name": _("Nom : "),
+        "phone": _("Téléphone : "),
+        "website": _("Site web : "),
+        "distance": _("Distance : %(distance)s mètres"),
+        "direction": _("Direction : %(bearing)s° %(direction)s"),
+        "open": _("Ouvert"),
+        "closed": _("Fermé"),
+        "opening_hours": _("Horaires d'ouverture"),
+        "itinerary": _("Itinéraire jusqu'à ce point"),
+        "osm_link": _("Lien OSM"),
+        "pending_address": _("Recherche de l'adresse…"),
+        # Not translated in the templates.
+        "see_on_map": "Voir sur la carte",
+        "see_block": "Voir le bloc",
+        "filter": _("Filtrer les résultats"),
+        "no_results": _("Pas de résultats."),
+    }
+
+def get_schedules(result):
+    # The week schedules, or None if they can not be rendered.
+    try:
+        return result.get_week_schedules()
+    except Exception:
+        return None
+
+def serialize_result(result, tags, strings, schedules, pending_addresses=False):
+    """
+        Returns the record of a result (see FIELDS), adding its
+        labels to the given Tables.
+        
+        If 'pending_addresses' is True, the address is null if it is
+        not found yet (it is sent later, see 'views.stream_results').
+    """
+    properties = result.properties
+    opening_hours = result.opening_hours
+    week_schedules = get_schedules(result) if opening_hours is not None else None
+    if pending_addresses and not (result.default_address or result.string_address):
+        address = None
+    else:
+        address = result.get_address()
+    return [
+        result.osm_meta[0],
+        result.osm_meta[1],
+        round(result.coordinates[0], 6),
+        round(result.coordinates[1], 6),
+        result.distance,
+        result.bearing,
+        [tags.add(tag[:2]) for tag in result.tags],
+        properties.get("name"),
+        properties.get("description"),
+        properties.get("phone"),
+        properties.get("website"),
+        address,
+        opening_hours.is_open() if opening_hours is not None else None,
+        schedules.add(week_schedules) if week_schedules else None,
+        [
+            [strings.add(label), strings.add(value)]
+            for label, value in result.search_preset.get_pr_items(properties)
+        ],
+    ]
+
+def serialize_results(results, user_coords, total, next_offset,
+        pending_addresses=False):
+    """
+        Returns a dict of the results of a search, to be sent as JSON.
+    """
+    tags, strings, schedules = Table(), Table(), Table()
+    records = [
+        serialize_result(result, tags, strings, schedules, pending_addresses)
+        for result in results
+    ]
+    # The filters are ordered by the key of their tag.
+    order = {tag[:2]: tag[2] for result in results for tag in result.tags}
+    return {
+        "version": VERSION,
+        "status": "ok",
+        "total": total,
+        "next_offset": next_offset,
+        "user": list(user_coords),
+        "fields": FIELDS,
+        "labels": {
+            "tags": [list(tag) + [order[tag]] for tag in tags.values],
+            "strings": strings.values,
+            "schedules": schedules.values,
+            # Indexed by 'int((bearing + 22.5) / 45) % 8' (see 'utils.deg2dir').
+            "directions": utils.DIRECTIONS,
+            "messages": get_messages(),
+            "decimal_separator": formats.get_format("DECIMAL_SEPARATOR"),
+        },
+        "results": records,
+    }
+
+def serialize_addresses(results):
+    """
+        Returns a dict of the addresses of the given results, of the
+        form {"addresses": [[type, id, address]...]}.
+    """
+    return {
+        "addresses": [
+            [result.osm_meta[0], result.osm_meta[1], result.get_address()]
+            for result in results
+        ]
+    }
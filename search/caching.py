@@ -0,0 +1,257 @@
+import os
+import threading
+import time
+import logging
+import pickle
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the calls can only be
+    # deduplicated inside a process.
+    fcntl = None
+
+debug_logger = logging.getLogger("DEBUG")
+
+# Returned by 'TTLCache.get' when a key is not cached, as 'None'
+# (or an empty list) can be a legit cached value.
+MISSING = object()
+
+# All the caches of the process, by name, to expose their statistics.
+registry = OrderedDict()
+
+# Runs the refreshes of the stale entries of all the caches, so that
+# they do not send too many concurrent requests to the upstream services.
+refresh_executor = ThreadPoolExecutor(max_workers=4)
+
+class TTLCache:
+    """
+        A thread-safe LRU cache whose entries expire after 'ttl' seconds.
+        
+        An expired entry can still be served during 'stale_ttl' more
+        seconds, while it is refreshed in the background
+        ("stale-while-revalidate"). After that, it is a miss.
+    """
+    def __init__(self, name, max_size, ttl, stale_ttl=0, clock=time.monotonic):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        registry[name] = self
+        return
+    
+    def get(self, key, loader=None):
+        """
+            Returns the value cached for the given key, or MISSING.
+            
+            If the entry is stale and a loader is given, the stale value
+            is returned and the loader is called in the background to
+            refresh it.
+        """
+        value, stale = self.get_entry(key)
+        if stale and loader is not None:
+            self.refresh([key], lambda keys: {key: loader()})
+        return value
+    
+    def get_entry(self, key):
+        """
+            Returns a tuple (value, stale), where the value is MISSING
+            if the key is not cached, and 'stale' is True if the entry
+            should be refreshed (see 'refresh').
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING, False
+            value, stored_at = entry
+            age = self.clock() - stored_at
+            if age > self.ttl + self.stale_ttl:
+                del self._data[key]
+                self.misses += 1
+                return MISSING, False
+            self._data.move_to_end(key)
+            if age <= self.ttl:
+                self.hits += 1
+                return value, False
+            self.stale_hits += 1
+            return value, key not in self._refreshing
+    
+    def refresh(self, keys, loader):
+        """
+            Refreshes the given keys in the background, with one call of
+            the loader, which takes the list of the keys (except the ones
+            already being refreshed) and returns a dict {key: value}.
+        """
+        with self._lock:
+            keys = [key for key in keys if key not in self._refreshing]
+            self._refreshing.update(keys)
+        if keys:
+            refresh_executor.submit(self._refresh, keys, loader)
+        return
+    
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, self.clock())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return
+    
+    def get_or_set(self, key, loader):
+        """
+            Returns the value cached for the given key, calling
+            the loader (and caching its return) in case of miss.
+        """
+        value = self.get(key, loader)
+        if value is MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return
+    
+    def stats(self):
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_rate": round(
+                (self.hits + self.stale_hits) / lookups, 3
+            ) if lookups else None,
+        }
+    
+    def _refresh(self, keys, loader):
+        try:
+            for key, value in loader(keys).items():
+                self.set(key, value)
+            debug_logger.debug(
+                "Cache '{}': {} key(s) refreshed.".format(self.name, len(keys))
+            )
+        except Exception as e:
+            # Keeps serving the stale values until they expire.
+            debug_logger.error(
+                "Cache '{}': refresh of {} key(s) failed ({}).".format(
+                    self.name, len(keys), str(e)
+                )
+            )
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+        return
+    
+    def __len__(self):
+        return len(self._data)
+
+class _Flight:
+    # A call in progress, awaited by the concurrent identical calls.
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        return
+
+class SingleFlight:
+    """
+        Deduplicates the concurrent identical calls: the first caller
+        of a key runs the function, while the others wait for it and
+        share its result (or its exception).
+        
+        If 'lock_dir' is given, the calls are also deduplicated across
+        processes: the callers of a key take a file lock, and the result
+        is stored on disk during 'result_ttl' seconds for the processes
+        which were waiting for the lock.
+    """
+    def __init__(self, name, lock_dir=None, result_ttl=10):
+        self.name = name
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.result_ttl = result_ttl
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        registry[name] = self
+        return
+    
+    def do(self, key, func):
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                self.shared += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            if self.lock_dir:
+                flight.value = self._do_locked(key, func)
+            else:
+                flight.value = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+        return flight.value
+    
+    def _do_locked(self, key, func):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        path = os.path.join(self.lock_dir, "{}-{}".format(
+            self.name, hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        ))
+        with open(path + ".lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path) and time.time() - os.path.getmtime(path) < self.result_ttl:
+                    with open(path, "rb") as f:
+                        debug_logger.debug(
+                            "Single-flight '{}': result shared by another process.".format(self.name)
+                        )
+                        with self._lock:
+                            self.shared += 1
+                        return pickle.load(f)
+                value = func()
+                with open(path + ".tmp", "wb") as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + ".tmp", path)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._flights),
+        }
+
+def get_stats():
+    """
+        Returns a dict of the statistics of all the caches
+        (and single-flights) of the process.
+    """
+    return {name: cache.stats() for name, cache in registry.items()}
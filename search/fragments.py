@@ -0,0 +1,126 @@
+#  A cache of the rendered blocks and map popups of the results. The
+#  parts depending on the user or on the time are replaced by markers
+#  in the cached fragments, and filled in for each request.
+
+import re
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils import formats
+from django.utils.translation import get_language
+from goose import settings
+from search import caching
+from search.templatetags import geo_extras
+
+fragments_cache = caching.TTLCache(
+    "fragments",
+    settings.GOOSE_CACHE["fragments_max_size"],
+    settings.GOOSE_CACHE["fragments_ttl"]
+)
+
+# Not escaped by the templates, and not found in the OSM data.
+MARKER = "\x1e{}\x1e"
+MARKERS = re.compile("\x1e(\\w+)\x1e")
+
+class FragmentResult:
+    """
+        Stands for a result while its fragments are rendered. Gives the
+        attributes of the result, except for the parts depending on the
+        user or on the time, which are replaced by markers.
+        
+        The template filters of these parts ('render_open_state'...)
+        return a marker too when given a FragmentResult.
+    """
+    __slots__ = ("result",)
+    
+    def __init__(self, result):
+        self.result = result
+        return
+    
+    def __getattr__(self, name):
+        return getattr(self.result, name)
+    
+    @property
+    def distance(self):
+        return MARKER.format("distance")
+    
+    @property
+    def bearing(self):
+        return MARKER.format("bearing")
+    
+    @property
+    def direction(self):
+        return MARKER.format("direction")
+    
+    @property
+    def renderable_tags(self):
+        # The tags include the open / closed state.
+        return [MARKER.format("tags")]
+    
+    def get_address(self):
+        # May be left empty by a slow geocoder, then obtained later.
+        return MARKER.format("address")
+    
+    @staticmethod
+    def marker(name):
+        return MARKER.format(name)
+
+def get_key(result, template_name, flags):
+    """
+        Returns the key of a fragment. It changes with the data of the
+        result, the version of its SearchPreset and the language.
+    """
+    return (
+        template_name, result.osm_meta, result.coordinates,
+        hash(frozenset(result.properties.items())),
+        result.search_preset.id, result.search_preset.version,
+        get_language(), flags
+    )
+
+def fill(html, result, safe_address, oh_in_popover=True, address=None):
+    """
+        Replaces the markers of a fragment by the values of the result.
+        'address' replaces the address of the result, if given.
+    """
+    values = {
+        "distance": lambda: escape(formats.localize(result.distance)),
+        "bearing": lambda: escape(formats.localize(result.bearing)),
+        "direction": lambda: escape(result.direction),
+        "tags": lambda: ';'.join(escape(tag) for tag in result.renderable_tags),
+        "address": lambda: address if address is not None else (
+            result.get_address() if safe_address else escape(result.get_address())
+        ),
+        "open_state": lambda: geo_extras.render_open_state(result),
+        "opening_hours": lambda: geo_extras.render_opening_hours(result, oh_in_popover),
+        "address_link": lambda: geo_extras.render_address_link(result),
+    }
+    return MARKERS.sub(lambda match: values[match.group(1)](), html)
+
+def render(template_name, result, context, safe_address, address=None):
+    """
+        Renders a template for a result, from its cached fragment
+        if possible. 'context' contains the flags of the template.
+    """
+    flags = tuple(sorted(context.items()))
+    key = get_key(result, template_name, flags)
+    html = fragments_cache.get(key)
+    if html is caching.MISSING:
+        html = render_to_string(
+            template_name, dict(context, result=FragmentResult(result))
+        )
+        fragments_cache.set(key, html)
+    return fill(
+        html, result, safe_address, context.get("oh_in_popover", True), address
+    )
+
+def render_result_block(result, render_tags=True, oh_in_popover=True, light=False,
+        address=None):
+    return render(
+        "search/result_block.part.html", result,
+        {"render_tags": render_tags, "oh_in_popover": oh_in_popover, "light": light},
+        safe_address=True, address=address
+    )
+
+def render_marker_popup(result):
+    return render(
+        "search/marker_popup.part.html", result, {}, safe_address=False
+    )
@@ -0,0 +1,174 @@
+from math import cos, radians, degrees, floor
+import numpy as np
+
+# Mean radius of the Earth, in meters.
+EARTH_RADIUS = 6371008.8
+
+# The WGS-84 ellipsoid (used by the Vincenty formulae).
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+
+def tile_of(coords, tile_size):
+    """
+        Returns the index (x, y) of the tile containing the given
+        coordinates, in a grid of tiles of 'tile_size' degrees.
+    """
+    return (
+        int(floor(coords[1] / tile_size)),
+        int(floor(coords[0] / tile_size))
+    )
+
+def tile_bbox(tile, tile_size):
+    """
+        Returns the bounding box (south, west, north, east) of a tile.
+    """
+    x, y = tile
+    return (
+        round(y * tile_size, 7), round(x * tile_size, 7),
+        round((y + 1) * tile_size, 7), round((x + 1) * tile_size, 7)
+    )
+
+def tiles_around(coords, radius, tile_size):
+    """
+        Returns the list of the tiles intersecting the circle of the
+        given radius (in meters) around the given coordinates.
+        
+        Uses an equirectangular approximation, which is precise
+        enough at the scale of a search radius.
+    """
+    lat, lon = coords
+    lon_scale = max(cos(radians(lat)), 0.01)
+    delta_lat = degrees(radius / EARTH_RADIUS)
+    delta_lon = delta_lat / lon_scale
+    min_x, min_y = tile_of((lat - delta_lat, lon - delta_lon), tile_size)
+    max_x, max_y = tile_of((lat + delta_lat, lon + delta_lon), tile_size)
+    tiles = []
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            south, west, north, east = tile_bbox((x, y), tile_size)
+            # Distance from the center to the closest point of the tile.
+            closest_lat = min(max(lat, south), north)
+            closest_lon = min(max(lon, west), east)
+            dy = radians(closest_lat - lat) * EARTH_RADIUS
+            dx = radians(closest_lon - lon) * EARTH_RADIUS * lon_scale
+            if dx ** 2 + dy ** 2 <= radius ** 2:
+                tiles.append((x, y))
+    return tiles
+
+def haversine_distances(origin, lats, lons):
+    """
+        Returns the array of the distances (in meters) from the origin
+        (lat, lon) to the given points, on a sphere.
+        
+        Fast, with an error up to 0.5%.
+    """
+    phi1, lambda1 = np.radians(origin[0]), np.radians(origin[1])
+    phi2, lambda2 = np.radians(lats), np.radians(lons)
+    a = (
+        np.sin((phi2 - phi1) / 2) ** 2 +
+        np.cos(phi1) * np.cos(phi2) * np.sin((lambda2 - lambda1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def vincenty_distances(origin, lats, lons, max_iterations=100, tolerance=1e-12):
+    """
+        Returns the array of the distances (in meters) from the origin
+        (lat, lon) to the given points, on the WGS-84 ellipsoid.
+        
+        Solves the inverse Vincenty formulae for all the points at
+        once (as 'geopy.distance.vincenty' does for one point).
+    """
+    f = WGS84_F
+    U1 = np.arctan((1 - f) * np.tan(np.radians(origin[0])))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lats)))
+    L = np.radians(lons) - np.radians(origin[1])
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+    lambda_ = L
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(max_iterations):
+            sin_lambda, cos_lambda = np.sin(lambda_), np.cos(lambda_)
+            sin_sigma = np.sqrt(
+                (cos_U2 * sin_lambda) ** 2 +
+                (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lambda) ** 2
+            )
+            cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lambda
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(
+                sin_sigma == 0, 0, cos_U1 * cos_U2 * sin_lambda / sin_sigma
+            )
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha == 0.
+            cos_2sigma_m = np.where(
+                cos_sq_alpha == 0, 0,
+                cos_sigma - 2 * sin_U1 * sin_U2 / cos_sq_alpha
+            )
+            C = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            previous_lambda = lambda_
+            lambda_ = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * (
+                cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            ))
+            if np.all(np.abs(lambda_ - previous_lambda) <= tolerance):
+                break
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    A = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    B = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+        B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+    ))
+    return WGS84_B * A * (sigma - delta_sigma)
+
+DISTANCE_MODELS = {
+    "vincenty": vincenty_distances,
+    "haversine": haversine_distances,
+}
+
+def bearings(origin, lats, lons):
+    """
+        Returns the array of the initial bearings (in degrees, from 0
+        to 360) to go from the origin (lat, lon) to the given points.
+    """
+    phi1, lambda1 = np.radians(origin[0]), np.radians(origin[1])
+    phi2, lambda2 = np.radians(lats), np.radians(lons)
+    bearing = np.arctan2(
+        np.sin(lambda2 - lambda1) * np.cos(phi2),
+        np.cos(phi1) * np.sin(phi2) -
+        np.sin(phi1) * np.cos(phi2) * np.cos(lambda2 - lambda1)
+    )
+    return (np.degrees(bearing) + 360) % 360
+
+def distances_and_bearings(origin, points, model="vincenty"):
+    """
+        Returns the arrays of the distances (in meters) and the bearings
+        (in degrees) from the origin (lat, lon) to a list of points.
+        
+        'model' is the name of the distance formula ("vincenty" or
+        "haversine", the latter being faster and less precise).
+    """
+    points = np.array(points, dtype=float).reshape(-1, 2)
+    lats, lons = points[:, 0], points[:, 1]
+    return DISTANCE_MODELS[model](origin, lats, lons), bearings(origin, lats, lons)
+
+def representative_point(coordinates):
+    """
+        Returns a point (lat, lon) representing a way, from the list of
+        the [lon, lat] of its nodes: the centroid of its area for a
+        closed way, the center of its bounding box otherwise.
+    """
+    points = np.array(coordinates, dtype=float).reshape(-1, 2)
+    lons, lats = points[:, 0], points[:, 1]
+    if len(points) >= 4 and np.array_equal(points[0], points[-1]):
+        # Shoelace formula, relative to the first node for precision.
+        x, y = lons - lons[0], lats - lats[0]
+        cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+        area = cross.sum() / 2
+        if area != 0:
+            centroid_lon = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+            centroid_lat = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+            return (float(centroid_lat + lats[0]), float(centroid_lon + lons[0]))
+    return (
+        float((lats.min() + lats.max()) / 2),
+        float((lons.min() + lons.max()) / 2)
+    )
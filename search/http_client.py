@@ -0,0 +1,134 @@
+#  The HTTP layer shared by all the calls to the upstream services,
+#  which keeps the connections alive in a pool for each host.
+
+import json
+import threading
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+import geopy
+from geopy.geocoders.base import ERROR_CODE_MAP
+from goose import settings
+
+class HostStats:
+    """
+        Counts the requests sent to a host, and keeps their latency
+        (until the headers of the response are received).
+    """
+    def __init__(self, window=100):
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        return
+    
+    def percentile(self, percent):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+        return round(latencies[index], 3)
+
+# The statistics of all the requested hosts, by host.
+hosts = OrderedDict()
+_hosts_lock = threading.Lock()
+
+def record_response(response, *args, **kwargs):
+    """
+        A hook of the session, recording the statistics of a response.
+    """
+    host = urlsplit(response.url).netloc
+    with _hosts_lock:
+        stats = hosts.setdefault(host, HostStats())
+        stats.requests += 1
+        if response.status_code >= 400:
+            stats.errors += 1
+        stats.latencies.append(response.elapsed.total_seconds())
+    return
+
+def create_session():
+    """
+        Returns a session with a pool of connections for each host,
+        whose sizes are set in GOOSE_HTTP.
+    """
+    session = requests.Session()
+    session.headers["User-Agent"] = settings.GOOSE_HTTP["user_agent"]
+    adapter = HTTPAdapter(
+        pool_connections=settings.GOOSE_HTTP["pool_connections"],
+        pool_maxsize=settings.GOOSE_HTTP["pool_maxsize"]
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    for prefix, pool_maxsize in settings.GOOSE_HTTP["pool_maxsizes"].items():
+        session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+    session.hooks["response"].append(record_response)
+    return session
+
+session = create_session()
+
+def get_pools():
+    """
+        Yields the urllib3 pools of connections of the session.
+    """
+    adapters = set(session.adapters.values())
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                yield pool
+
+def get_stats():
+    """
+        Returns the statistics of the requested hosts: their number of
+        requests, of connections opened and reused, and their latency.
+    """
+    stats = OrderedDict()
+    with _hosts_lock:
+        for host, host_stats in hosts.items():
+            stats[host] = {
+                "requests": host_stats.requests,
+                "errors": host_stats.errors,
+                "median_latency": host_stats.percentile(50),
+                "p90_latency": host_stats.percentile(90),
+                "connections": 0,
+                "reused_connections": 0,
+            }
+    for pool in get_pools():
+        host = pool.host if pool.port in (80, 443, None) else "{}:{}".format(pool.host, pool.port)
+        if host in stats:
+            stats[host]["connections"] += pool.num_connections
+            stats[host]["reused_connections"] += max(0, pool.num_requests - pool.num_connections)
+    return stats
+
+class PooledNominatim(geopy.geocoders.Nominatim):
+    """
+        A Nominatim geocoder sending its requests with the shared
+        session, instead of opening a new connection for each of them.
+    """
+    def _call_geocoder(self, url, timeout=None, raw=False, requester=None,
+            deserializer=json.loads, **kwargs):
+        try:
+            response = session.get(
+                url, timeout=timeout or self.timeout, headers=self.headers
+            )
+        except requests.exceptions.Timeout:
+            raise geopy.exc.GeocoderTimedOut("Service timed out")
+        except requests.exceptions.RequestException as e:
+            raise geopy.exc.GeocoderUnavailable(str(e))
+        if response.status_code in ERROR_CODE_MAP:
+            raise ERROR_CODE_MAP[response.status_code](response.text)
+        if response.status_code != 200:
+            raise geopy.exc.GeocoderServiceError(
+                "The request returned status code {}".format(response.status_code)
+            )
+        if raw:
+            return response
+        if deserializer is None:
+            return response.text
+        try:
+            return deserializer(response.text)
+        except ValueError:
+            raise geopy.exc.GeocoderParseError(
+                "Could not deserialize using deserializer:\n{}".format(response.text)
+            )
@@ -0,0 +1,311 @@
+#  An offline search engine, answering searches from an index built
+#  from an OpenStreetMap extract instead of requesting Overpass.
+
+import os
+import re
+import pickle
+import threading
+import logging
+from xml.etree import ElementTree
+from goose import settings
+from search import geometry
+from search import overpass_client
+
+try:
+    import osmium
+except ImportError:
+    # Only required to read the ".osm.pbf" extracts.
+    osmium = None
+
+debug_logger = logging.getLogger("DEBUG")
+
+_index = None
+_index_mtime = None
+_index_lock = threading.Lock()
+
+def parse_selector(osm_key):
+    """
+        Returns a tuple (key, value) from a line of the OSM keys
+        of a SearchPreset ('"key"="value"').
+    """
+    match = re.match('"(.+)"="(.+)"', osm_key.strip())
+    if not match:
+        raise ValueError("Invalid OSM key: '{}'.".format(osm_key))
+    return match.groups()
+
+class LocalIndex:
+    """
+        An in-memory spatial index of OSM elements.
+        
+        Has one entry for each selector (a tuple (key, value)), which
+        stores the elements matching it by grid tile.
+    """
+    def __init__(self, selectors, tile_size):
+        self.tile_size = tile_size
+        self.entries = {selector: {} for selector in selectors}
+        self.size = 0
+        return
+    
+    def matches(self, tags):
+        """
+            Returns the list of the selectors matching the given tags.
+        """
+        return [
+            selector for selector in self.entries
+            if tags.get(selector[0]) == selector[1]
+        ]
+    
+    def add(self, osm_type, osm_id, coordinates, tags):
+        """
+            Adds an element to the entries of all the selectors it matches.
+            
+            'coordinates' is the list of the (lat, lon) of its nodes
+            (of the nodes of its member ways for a relation).
+        """
+        matching = self.matches(tags)
+        if not matching or not coordinates:
+            return
+        if osm_type == "node":
+            geom = {"type": "Point", "coordinates": [
+                coordinates[0][1], coordinates[0][0]
+            ]}
+            position = coordinates[0]
+        elif osm_type == "relation":
+            # Like the "center" returned by Overpass, the center
+            # of its bounding box.
+            lats = [lat for lat, lon in coordinates]
+            lons = [lon for lat, lon in coordinates]
+            position = ((min(lats) + max(lats)) / 2, (min(lons) + max(lons)) / 2)
+            geom = {"type": "Point", "coordinates": [position[1], position[0]]}
+        else:
+            geom = {"type": "LineString", "coordinates": [
+                [lon, lat] for lat, lon in coordinates
+            ]}
+            position = geometry.representative_point(geom["coordinates"])
+        element = {
+            "id": osm_id, "geometry": geom,
+            "properties": overpass_client.intern_tags(tags)
+        }
+        if osm_type == "relation":
+            # Can not be told from its geometry (see 'utils.get_element_meta').
+            element["osm_type"] = osm_type
+        # The element is stored in the tile of its representative point,
+        # which is the point used to compute its distance.
+        tile = geometry.tile_of(position, self.tile_size)
+        for selector in matching:
+            self.entries[selector].setdefault(tile, []).append(element)
+        self.size += 1
+        return
+    
+    def get_elements(self, osm_keys, coords, radius):
+        """
+            Returns the list of the elements matching the given OSM keys
+            in all the tiles intersecting the search circle.
+        """
+        tiles = geometry.tiles_around(coords, radius, self.tile_size)
+        elements = {}
+        for osm_key in osm_keys.splitlines():
+            entry = self.entries.get(parse_selector(osm_key))
+            if entry is None:
+                debug_logger.error(
+                    "Local engine - The key '{}' is not indexed. "
+                    "The index must be rebuilt.".format(osm_key)
+                )
+                continue
+            for tile in tiles:
+                for element in entry.get(tile, []):
+                    osm_type = element.get("osm_type") or (
+                        "node" if element["geometry"]["type"] == "Point" else "way"
+                    )
+                    elements[(osm_type, element["id"])] = element
+        return list(elements.values())
+
+def iter_osm_xml(path):
+    """
+        Yields the top-level elements (nodes, ways and relations)
+        of an ".osm" extract, removing them from the tree once they
+        are read.
+    """
+    events = ElementTree.iterparse(path, events=("start", "end"))
+    event, root = next(events)
+    for event, elem in events:
+        if event == "end" and elem.tag in ("node", "way", "relation"):
+            yield elem
+            # Otherwise, the root would keep all the elements read.
+            root.clear()
+    return
+
+def get_tags(elem):
+    return {tag.get('k'): tag.get('v') for tag in elem.iter("tag")}
+
+def get_member_ways(elem):
+    return [
+        int(member.get("ref")) for member in elem.iter("member")
+        if member.get("type") == "way"
+    ]
+
+def parse_osm_xml(path, index):
+    """
+        Fills the index with the elements of an ".osm" extract.
+        
+        The extract is read three times: first to find the member ways
+        of the matching relations (which come last), then to find the
+        nodes of these ways and of the matching ones, and finally to
+        index the elements. So only the coordinates of these nodes and
+        ways are kept in memory.
+    """
+    member_ways = set()
+    for elem in iter_osm_xml(path):
+        if elem.tag == "relation" and index.matches(get_tags(elem)):
+            member_ways.update(get_member_ways(elem))
+    refs = set()
+    for elem in iter_osm_xml(path):
+        if elem.tag == "way" and (
+                int(elem.get("id")) in member_ways or index.matches(get_tags(elem))):
+            refs.update(int(nd.get("ref")) for nd in elem.iter("nd"))
+    nodes = {}
+    ways = {}
+    for elem in iter_osm_xml(path):
+        if elem.tag == "node":
+            osm_id = int(elem.get("id"))
+            coords = (float(elem.get("lat")), float(elem.get("lon")))
+            if osm_id in refs:
+                nodes[osm_id] = coords
+            tags = get_tags(elem)
+            if tags:
+                index.add("node", osm_id, [coords], tags)
+        elif elem.tag == "way":
+            osm_id = int(elem.get("id"))
+            tags = get_tags(elem)
+            if not tags and osm_id not in member_ways:
+                continue
+            coordinates = [
+                nodes[int(nd.get("ref"))] for nd in elem.iter("nd")
+                if int(nd.get("ref")) in nodes
+            ]
+            if osm_id in member_ways:
+                ways[osm_id] = coordinates
+            if tags:
+                index.add("way", osm_id, coordinates, tags)
+        elif elem.tag == "relation":
+            tags = get_tags(elem)
+            if tags:
+                coordinates = [
+                    coords for way_id in get_member_ways(elem)
+                    for coords in ways.get(way_id, [])
+                ]
+                index.add("relation", int(elem.get("id")), coordinates, tags)
+    return
+
+def parse_osm_pbf(path, index):
+    """
+        Fills the index with the elements of an ".osm.pbf" extract.
+        Requires pyosmium.
+        
+        The extract is read twice: first to find the member ways of
+        the matching relations, then to index the elements.
+    """
+    if osmium is None:
+        raise ImportError("pyosmium is required to read '.osm.pbf' files.")
+    member_ways = set()
+    ways = {}
+    
+    class RelationsHandler(osmium.SimpleHandler):
+        def relation(self, r):
+            if index.matches({tag.k: tag.v for tag in r.tags}):
+                member_ways.update(
+                    member.ref for member in r.members if member.type == 'w'
+                )
+    
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            if len(n.tags):
+                index.add(
+                    "node", n.id, [(n.location.lat, n.location.lon)],
+                    {tag.k: tag.v for tag in n.tags}
+                )
+        
+        def way(self, w):
+            if not len(w.tags) and w.id not in member_ways:
+                return
+            coordinates = [
+                (nd.location.lat, nd.location.lon) for nd in w.nodes
+                if nd.location.valid()
+            ]
+            if w.id in member_ways:
+                ways[w.id] = coordinates
+            if len(w.tags):
+                index.add(
+                    "way", w.id, coordinates,
+                    {tag.k: tag.v for tag in w.tags}
+                )
+        
+        def relation(self, r):
+            if len(r.tags):
+                coordinates = [
+                    coords for member in r.members if member.type == 'w'
+                    for coords in ways.get(member.ref, [])
+                ]
+                index.add(
+                    "relation", r.id, coordinates,
+                    {tag.k: tag.v for tag in r.tags}
+                )
+    
+    RelationsHandler().apply_file(path)
+    Handler().apply_file(path, locations=True)
+    return
+
+def build_index(path, osm_keys):
+    """
+        Returns a LocalIndex built from an OSM extract, with
+        an entry for each of the given OSM keys.
+    """
+    selectors = set(parse_selector(osm_key) for osm_key in osm_keys)
+    index = LocalIndex(selectors, settings.GOOSE_LOCAL_ENGINE["tile_size"])
+    if path.endswith(".pbf"):
+        parse_osm_pbf(path, index)
+    else:
+        parse_osm_xml(path, index)
+    return index
+
+def save_index(index, path=None):
+    """
+        Saves the index on disk (atomically, as it may be
+        loaded by running workers).
+    """
+    path = path or settings.GOOSE_LOCAL_ENGINE["index_path"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+    return
+
+def get_index():
+    """
+        Returns the index of the process, loading it on the first call,
+        and again when the file of the index is replaced (see
+        'save_index'), so that the workers use a rebuilt index without
+        being restarted.
+        
+        Returns None if the index has not been built.
+    """
+    global _index, _index_mtime
+    path = settings.GOOSE_LOCAL_ENGINE["index_path"]
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError as e:
+        if _index is None:
+            debug_logger.error(
+                "Local engine - Unable to load the index ({}). "
+                "It must be built.".format(str(e))
+            )
+        # Otherwise, the index already loaded is still used.
+        return _index
+    if _index is None or mtime != _index_mtime:
+        with _index_lock:
+            if _index is None or mtime != _index_mtime:
+                debug_logger.debug("Loading the local index from '{}'.".format(path))
+                with open(path, "rb") as f:
+                    _index = pickle.load(f)
+                _index_mtime = mtime
+    return _index
@@ -0,0 +1,247 @@
+#  An offline reverse geocoder, finding the nearest address in an index
+#  built from a dump of the "Base Adresse Nationale" (BAN), instead of
+#  requesting api-adresse.data.gouv.fr.
+
+import os
+import io
+import csv
+import gzip
+import json
+import math
+import shutil
+import threading
+import logging
+from array import array
+import numpy as np
+from goose import settings
+from search import geometry
+from search.tables import Table
+
+debug_logger = logging.getLogger("DEBUG")
+
+_index = None
+_index_mtime = None
+_index_lock = threading.Lock()
+
+# Returned for the positions without address nearby, like
+# the empty lines of the CSV returned by the BAN API.
+NO_ADDRESS = ['', '', '', '']
+
+def cell_of(lat, lon, cell_size):
+    """
+        Returns the id of the grid cell containing the given position
+        (works with arrays too).
+    """
+    columns = math.ceil(360 / cell_size)
+    row = np.floor((np.asarray(lat, dtype=np.float64) + 90) / cell_size).astype(np.int64)
+    column = np.floor((np.asarray(lon, dtype=np.float64) + 180) / cell_size).astype(np.int64)
+    return row * columns + column
+
+def open_dump(path):
+    """
+        Opens a BAN dump ("adresses-*.csv", gzipped or not) as text.
+    """
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path), encoding="utf-8", newline='')
+    return open(path, encoding="utf-8", newline='')
+
+def build_index(paths, output, cell_size=None):
+    """
+        Builds an index of the addresses of the given BAN dumps (with
+        the columns "numero", "rep", "nom_voie", "code_postal",
+        "nom_commune", "lon" and "lat"), and saves it in the 'output'
+        directory. Returns the number of indexed addresses.
+        
+        The addresses are sorted by grid cell. The index stores their
+        coordinates and the ids of their strings in numpy arrays, which
+        are memory-mapped when loaded, and the strings in a JSON file.
+    """
+    cell_size = cell_size or settings.GOOSE_LOCAL_GEOCODER["cell_size"]
+    # Arrays of machine values, as a dump has millions of lines.
+    lats, lons = array('d'), array('d')
+    numbers, streets, places = array('l'), array('l'), array('l')
+    numbers_table, streets_table, places_table = Table(), Table(), Table()
+    for path in paths:
+        with open_dump(path) as f:
+            for row in csv.DictReader(f, delimiter=';'):
+                try:
+                    lat, lon = float(row["lat"]), float(row["lon"])
+                except (ValueError, TypeError):
+                    continue
+                lats.append(lat)
+                lons.append(lon)
+                numbers.append(numbers_table.add(
+                    "{}{}".format(row.get("numero") or '', row.get("rep") or '')
+                ))
+                streets.append(streets_table.add(row.get("nom_voie") or ''))
+                places.append(places_table.add(
+                    (row.get("code_postal") or '', row.get("nom_commune") or '')
+                ))
+    if not lats:
+        raise ValueError("No address found in the dumps.")
+    lats, lons = np.array(lats), np.array(lons)
+    cells = cell_of(lats, lons, cell_size)
+    order = np.argsort(cells, kind="mergesort")
+    cells = cells[order]
+    cell_ids, offsets = np.unique(cells, return_index=True)
+    arrays = {
+        "cells": cell_ids,
+        "offsets": np.append(offsets, len(cells)).astype(np.int64),
+        "coordinates": np.column_stack((lats[order], lons[order])).astype(np.float32),
+        "strings": np.column_stack((
+            np.array(numbers, dtype=np.int32)[order],
+            np.array(streets, dtype=np.int32)[order],
+            np.array(places, dtype=np.int32)[order],
+        )),
+    }
+    # Written in a temporary directory, then moved, as the
+    # index may be in use by running workers.
+    tmp = output.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), values)
+    with open(os.path.join(tmp, "tables.json"), 'w', encoding="utf-8") as f:
+        json.dump({
+            "cell_size": cell_size,
+            "numbers": numbers_table.values,
+            "streets": streets_table.values,
+            "places": places_table.values,
+        }, f)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp, output)
+    return len(cells)
+
+class AddressIndex:
+    """
+        The index of addresses built by 'build_index'.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "tables.json"), encoding="utf-8") as f:
+            tables = json.load(f)
+        self.cell_size = tables["cell_size"]
+        self.numbers = tables["numbers"]
+        self.streets = tables["streets"]
+        self.places = tables["places"]
+        self.cells, self.offsets, self.coordinates, self.strings = [
+            np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+            for name in ("cells", "offsets", "coordinates", "strings")
+        ]
+        return
+    
+    def __len__(self):
+        return len(self.coordinates)
+    
+    def nearest(self, coords, max_distance):
+        """
+            Returns the position of the nearest address (in the index)
+            within 'max_distance' meters, or None.
+            
+            Only the cell of the position and its eight neighbours are
+            searched, so 'max_distance' must be smaller than a cell.
+        """
+        center = int(cell_of(coords[0], coords[1], self.cell_size))
+        columns = math.ceil(360 / self.cell_size)
+        candidates = [
+            center + row * columns + column
+            for row in (-1, 0, 1) for column in (-1, 0, 1)
+        ]
+        positions = np.searchsorted(self.cells, candidates)
+        ranges = [
+            np.arange(self.offsets[position], self.offsets[position + 1])
+            for cell, position in zip(candidates, positions)
+            if position < len(self.cells) and self.cells[position] == cell
+        ]
+        if not ranges:
+            return None
+        indexes = np.concatenate(ranges)
+        points = self.coordinates[indexes]
+        distances = geometry.haversine_distances(coords, points[:, 0], points[:, 1])
+        nearest = int(np.argmin(distances))
+        if distances[nearest] > max_distance:
+            return None
+        return int(indexes[nearest])
+    
+    def get_address_data(self, position):
+        """
+            Returns the list [housenumber, street, postcode, city] of the
+            address at the given position (like 'utils.parse_ban_csv').
+        """
+        number, street, place = self.strings[position]
+        postcode, city = self.places[place]
+        return [self.numbers[number], self.streets[street], postcode, city]
+    
+    def get_coordinates(self, position):
+        lat, lon = self.coordinates[position]
+        return (float(lat), float(lon))
+
+def get_index_mtime(path):
+    # The tables are written last (see 'build_index').
+    try:
+        return os.path.getmtime(os.path.join(path, "tables.json"))
+    except OSError:
+        return None
+
+def get_index():
+    """
+        Returns the index of the process, or None if it can not be loaded.
+        
+        It is loaded on the first call, and again when it is replaced
+        (see 'build_index'), so that the workers do not keep using the
+        deleted files.
+    """
+    global _index, _index_mtime
+    path = settings.GOOSE_LOCAL_GEOCODER["index_path"]
+    mtime = get_index_mtime(path)
+    if _index is None or mtime != _index_mtime:
+        with _index_lock:
+            if _index is None or mtime != _index_mtime:
+                debug_logger.debug("Loading the addresses index from '{}'.".format(path))
+                try:
+                    _index = AddressIndex(path)
+                except (OSError, ValueError) as e:
+                    # Retried when the index is built: the API is used meanwhile.
+                    debug_logger.error(
+                        "Unable to load the addresses index ({}).".format(str(e))
+                    )
+                    _index = False
+                _index_mtime = mtime
+    return _index or None
+
+def is_enabled():
+    """
+        Returns True if the addresses must be found locally.
+    """
+    return settings.GOOSE_LOCAL_GEOCODER["enabled"] and get_index() is not None
+
+def get_addresses(results):
+    """
+        Returns a dict of the form {uuid: address_data} (see
+        'utils.parse_ban_csv') of the given results. The results
+        without address nearby get an empty address.
+    """
+    index = get_index()
+    max_distance = settings.GOOSE_LOCAL_GEOCODER["max_distance"]
+    addresses = {}
+    for result in results:
+        position = index.nearest(result.coordinates, max_distance)
+        if position is None:
+            addresses[result.uuid] = list(NO_ADDRESS)
+        else:
+            addresses[result.uuid] = index.get_address_data(position)
+    return addresses
+
+def reverse(coords):
+    """
+        Returns the nearest address of the given coordinates, like
+        'utils.get_address' ('((lat, lon), address)'), or None.
+    """
+    index = get_index()
+    position = index.nearest(coords, settings.GOOSE_LOCAL_GEOCODER["max_distance"])
+    if position is None:
+        return None
+    housenumber, street, postcode, city = index.get_address_data(position)
+    if not street:
+        return None
+    label = ' '.join(part for part in (housenumber, street, postcode, city) if part)
+    return (index.get_coordinates(position), label)
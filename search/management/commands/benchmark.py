@@ -0,0 +1,105 @@
+#  Measures the time and the memory used to build the results of a
+#  search, on synthetic elements.
+
+import time
+import random
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import translation
+from goose import settings
+from search.models import SearchPreset
+from search import utils
+from search import overpass_client
+
+# The center of the synthetic searches (Paris).
+CENTER = (48.8566, 2.3522)
+RADIUS = 2000
+
+def synthetic_elements(number):
+    """
+        Returns a list of GeoJSON features looking like
+        the results of a parking search.
+    """
+    elements = []
+    for i in range(number):
+        tags = {
+            "amenity": "parking",
+            "access": random.choice(["yes", "yes", "customers", "private"]),
+            "fee": random.choice(["yes", "no"]),
+            "parking": random.choice(["surface", "underground", "multi-storey"]),
+            "capacity": str(random.randint(5, 500)),
+        }
+        if random.random() < 0.5:
+            tags["name"] = "Parking {}".format(i)
+        if random.random() < 0.5:
+            tags["opening_hours"] = random.choice([
+                "Mo-Su 00:00-24:00", "Mo-Sa 07:00-21:00", "Mo-Fr 08:00-19:00"
+            ])
+        elements.append(overpass_client.element_to_feature({
+            "type": "node",
+            "id": i,
+            "lat": CENTER[0] + random.uniform(-0.018, 0.018),
+            "lon": CENTER[1] + random.uniform(-0.027, 0.027),
+            "tags": tags,
+        }))
+    return elements
+
+class Command(BaseCommand):
+    help = "Measures the time and the memory used to build the results of a search"
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--elements", action="store", dest="elements", type=int, default=2000,
+            help="Number of synthetic elements (default: 2000)"
+        )
+        parser.add_argument(
+            "--preset", action="store", dest="preset", type=int,
+            help="ID of the SearchPreset to use (default: the first one)"
+        )
+        return
+    
+    def measure(self, label, number, func):
+        """
+            Calls the function and writes the time it took and the
+            memory it allocated (per result). Returns its result.
+        """
+        tracemalloc.start()
+        start = time.monotonic()
+        value = func()
+        duration = time.monotonic() - start
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(
+            "{} : {:.1f} ms, {:.0f} octets par résultat (pic : {:.1f} Kio).".format(
+                label, duration * 1000, current / max(number, 1), peak / 1024
+            )
+        )
+        return value
+    
+    def handle(self, *args, **options):
+        if options["preset"]:
+            search_preset = SearchPreset.objects.filter(id=options["preset"]).first()
+        else:
+            search_preset = SearchPreset.objects.first()
+        if search_preset is None:
+            raise CommandError("Aucun SearchPreset à utiliser.")
+        random.seed(0)
+        elements = synthetic_elements(options["elements"])
+        # The management commands are run without active language.
+        translation.activate(settings.LANGUAGE_CODE)
+        results = self.measure(
+            "Construction", options["elements"],
+            lambda: utils.build_results(
+                elements, search_preset, CENTER, RADIUS, False, "Europe/Paris"
+            ).results
+        )
+        self.stdout.write("{} résultats dans le rayon.".format(len(results)))
+        self.measure(
+            "Évaluation (horaires et étiquettes)", len(results),
+            lambda: [result.tags for result in results]
+        )
+        self.measure(
+            "Rendu des propriétés", len(results),
+            lambda: [search_preset.render_pr(result.properties) for result in results]
+        )
+        return
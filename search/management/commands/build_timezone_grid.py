@@ -0,0 +1,30 @@
+#  Builds the grid used to find the timezones of the positions.
+
+from django.core.management.base import BaseCommand, CommandError
+from goose import settings
+from search import timezones
+
+class Command(BaseCommand):
+    help = "Builds the grid of the timezones (requires Shapely)"
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", action="store", dest="output", type=str,
+            help="Path of the grid (default: GOOSE_TIMEZONES['grid_path'])"
+        )
+        parser.add_argument(
+            "--cell-size", action="store", dest="cell_size", type=float,
+            help="Size of the cells, in degrees (default: GOOSE_TIMEZONES['cell_size'])"
+        )
+        return
+    
+    def handle(self, *args, **options):
+        output = options["output"] or settings.GOOSE_TIMEZONES["grid_path"]
+        try:
+            mixed = timezones.build_grid(output, options["cell_size"])
+        except (ImportError, OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            "Grille créée : {:.1%} des cellules sont à la frontière de plusieurs fuseaux.".format(mixed)
+        ))
+        return
@@ -0,0 +1,28 @@
+#  Builds the index of the local geocoder from dumps of the
+#  "Base Adresse Nationale" (https://adresse.data.gouv.fr/data/ban/).
+
+from django.core.management.base import BaseCommand, CommandError
+from goose import settings
+from search import local_geocoder
+
+class Command(BaseCommand):
+    help = "Builds the index of the local geocoder from BAN dumps (adresses-*.csv or .csv.gz)"
+    
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs='+', type=str, help="Paths of the BAN dumps")
+        parser.add_argument(
+            "--output", action="store", dest="output", type=str,
+            help="Path of the index (default: GOOSE_LOCAL_GEOCODER['index_path'])"
+        )
+        return
+    
+    def handle(self, *args, **options):
+        output = options["output"] or settings.GOOSE_LOCAL_GEOCODER["index_path"]
+        try:
+            count = local_geocoder.build_index(options["paths"], output)
+        except (OSError, KeyError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            "Index créé : {} adresses.".format(count)
+        ))
+        return
@@ -0,0 +1,34 @@
+#  Builds the index of the local search engine from an OSM extract.
+
+from django.core.management.base import BaseCommand, CommandError
+from search.models import SearchPreset
+from search import local_engine
+
+class Command(BaseCommand):
+    help = "Builds the index of the local search engine from an OSM extract (.osm or .osm.pbf)"
+    
+    def add_arguments(self, parser):
+        parser.add_argument("path", type=str, help="Path of the OSM extract")
+        parser.add_argument(
+            "--output", action="store", dest="output", type=str,
+            help="Path of the index (default: GOOSE_LOCAL_ENGINE['index_path'])"
+        )
+        return
+    
+    def handle(self, *args, **options):
+        osm_keys = set()
+        for search_preset in SearchPreset.objects.all():
+            osm_keys.update((search_preset.osm_keys or '').splitlines())
+        if not osm_keys:
+            raise CommandError("Aucune clé OpenStreetMap à indexer.")
+        try:
+            index = local_engine.build_index(options["path"], osm_keys)
+        except (ImportError, OSError) as e:
+            raise CommandError(str(e))
+        local_engine.save_index(index, options["output"])
+        self.stdout.write(self.style.SUCCESS(
+            "Index créé : {} éléments pour {} clés.".format(
+                index.size, len(index.entries)
+            )
+        ))
+        return
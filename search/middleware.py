@@ -0,0 +1,45 @@
+#  The middlewares of Goose.
+
+from gzip import GzipFile
+from django.middleware.gzip import GZipMiddleware
+from django.utils.text import StreamingBuffer
+
+def compress_sequence(sequence):
+    """
+        Like 'django.utils.text.compress_sequence', but flushes the
+        compressor after each item, so that a streamed item is sent
+        at once instead of when the buffer of zlib is full.
+    """
+    buf = StreamingBuffer()
+    zfile = GzipFile(mode='wb', compresslevel=6, fileobj=buf)
+    # Output headers...
+    yield buf.read()
+    for item in sequence:
+        zfile.write(item)
+        zfile.flush()
+        data = buf.read()
+        if data:
+            yield data
+    zfile.close()
+    yield buf.read()
+
+class StreamingGZipMiddleware(GZipMiddleware):
+    """
+        Compresses the responses like GZipMiddleware, flushing the
+        streaming responses (see 'views.stream_light_results').
+    """
+    def process_response(self, request, response):
+        if not response.streaming:
+            return super().process_response(request, response)
+        if response.has_header("Content-Encoding"):
+            # Already compressed (a ".gz" file, for example).
+            return response
+        sequence = response.streaming_content
+        # Replaced by the compressed sequence if the client accepts it.
+        response.streaming_content = []
+        response = super().process_response(request, response)
+        if response.get("Content-Encoding") == "gzip":
+            response.streaming_content = compress_sequence(sequence)
+        else:
+            response.streaming_content = sequence
+        return response
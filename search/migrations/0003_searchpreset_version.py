@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0002_auto_20171027_1546'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchpreset',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-18 10:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0003_searchpreset_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedAddress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True, verbose_name='Clé')),
+                ('data', models.TextField(verbose_name='Données')),
+                ('updated', models.DateTimeField(auto_now=True, db_index=True, verbose_name='Mise à jour')),
+            ],
+            options={
+                'verbose_name': 'Adresse en cache',
+                'verbose_name_plural': 'Adresses en cache',
+            },
+        ),
+    ]
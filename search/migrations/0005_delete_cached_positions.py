@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def delete_cached_positions(apps, schema_editor):
+    # The addresses of the positions of the users are no longer
+    # stored in the database (see "address_cache.positions_cache").
+    CachedAddress = apps.get_model("search", "CachedAddress")
+    CachedAddress.objects.filter(key__startswith="reverse:").delete()
+    CachedAddress.objects.filter(key__regex=r'^nominatim:-?[0-9]').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('search', '0004_cachedaddress'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_cached_positions, migrations.RunPython.noop),
+    ]
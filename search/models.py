@@ -1,6 +1,12 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save, pre_delete, m2m_changed
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import get_language
+from goose import settings
+from search import caching
 import re
 
 # TODO : Allow spaces in patterns (["v1":"DV1" | "v2":"DV2"])
@@ -87,20 +93,53 @@ class Filter(models.Model):
         verbose_name = _("Filtre")
         verbose_name_plural = _("Filtres")
     
+    def compile_rules(self):
+        """
+            Returns the processing rules in a form allowing to match
+            the properties of a result quickly: a tuple (rules, default).
+            
+            'rules' is a dict of the form {key: {value: (line, tag)}},
+            'default' is the (line, tag) of the '*' line (or None), where
+            'line' is the index of the line and 'tag' a tuple
+            "(tag, description, filter name)".
+        """
+        rules = {}
+        default = None
+        pr = self.processing_rules if self.processing_rules is not None else ''
+        for i, line in enumerate(pr.splitlines()):
+            osm_tag, tag, description = [s.strip() for s in line.split('==')]
+            if osm_tag.startswith('*'):
+                default = (i, (tag, description, self.name))
+                # The next lines can not match.
+                break
+            osm_key, osm_value = osm_tag.split('=', 1)
+            # In case of multiple matches, the first line wins.
+            rules.setdefault(osm_key, {}).setdefault(
+                osm_value, (i, (tag, description, self.name))
+            )
+        return (rules, default)
+    
+    @staticmethod
+    def match_compiled_rules(compiled_rules, properties):
+        """
+            Returns the tag (see 'compile_rules') of the first line of the
+            compiled rules matching the given properties, or None.
+        """
+        rules, match = compiled_rules
+        for osm_key, values in rules.items():
+            line_match = values.get(properties.get(osm_key))
+            if line_match is not None and (match is None or line_match[0] < match[0]):
+                match = line_match
+        if match is None:
+            return None
+        return match[1]
+    
     def parse_result(self, result):
         """
             Returns a tuple of the form "(tag, description)"
             from a Result object.
         """
-        for line in self.processing_rules.splitlines():
-            osm_tag, tag, description = [s.strip() for s in line.split('==')]
-            if not line.startswith('*'):
-                osm_key, osm_value = osm_tag.split('=', 1)
-                if osm_key in result.properties and result.properties[osm_key] == osm_value:
-                    return (tag, description, self.name)
-            else:
-                return (tag, description, self.name)
-        return None
+        return self.match_compiled_rules(self.compile_rules(), result.properties)
     
     def __str__(self):
         return self.name
@@ -126,48 +165,200 @@ class SearchPreset(models.Model):
         related_name="search_presets",
         blank=True
     )
+    # Incremented each time the preset (or one of its filters) changes,
+    # to invalidate the compiled processing rules in all the processes.
+    version = models.PositiveIntegerField(default=0, editable=False)
     
     class Meta:
         verbose_name = _("Point d'intérêt")
         verbose_name_plural = _("Points d'intérêt")
     
-    def render_pr(self, properties):
+    def get_compiled_filters(self):
         """
-            Return a string describing the object with its properties and PR.
+            Returns the list of the compiled rules of the filters of the
+            preset (see 'Filter.compile_rules').
+            
+            They are cached for each version of the preset and each
+            language (as the filters are translated).
+        """
+        if self.id is None:
+            return [f.compile_rules() for f in self.filters.all()]
+        return compiled_filters_cache.get_or_set(
+            (self.id, self.version, get_language()),
+            lambda: [f.compile_rules() for f in self.filters.all()]
+        )
+    
+    def get_filters_tags(self, properties):
         """
-        output = []
+            Returns the list of the tags of the filters of the preset
+            matching the given properties. Does not query the database,
+            except on the first call.
+        """
+        tags = []
+        for compiled_rules in self.get_compiled_filters():
+            tag = Filter.match_compiled_rules(compiled_rules, properties)
+            if tag:
+                tags.append(tag)
+        return tags
+    
+    def compile_pr(self):
+        """
+            Returns the processing rules as a "display program": a list
+            of instructions for 'render_pr', which only needs dict
+            lookups to render the properties of a result.
+            
+            An instruction is either ('display', label, key), or
+            ('values', label, key, {value: displayed value}, default),
+            where 'default' is the displayed value of '*' (or None).
+        """
+        program = []
         pr = self.processing_rules if self.processing_rules is not None else ''
         for line in pr.splitlines():
             if re.match('DISPLAY ".*":"\w+"', line):
                 label, key = re.findall('DISPLAY "(.*)":"(\w+)"', line)[0]
-                value = properties.get(key)
-                if not value:
-                    continue
-                else:
-                    output.append("{} : {}".format(label, value))
-                    continue
+                program.append(('display', label, key))
+                continue
             if re.match('"\w+" ".*":\[".*":".*"(\|".*":".*")*\]', line):
                 key = re.findall('"(\w+)"', line)[0]
-                values = properties.get(key)
-                if not values:
-                    continue
-                else:
-                    label = re.search('\w+', line.split()[1]).group()
-                    possible_values = re.findall('"(\w+|\*)":"', line.split(' ', 1)[1])
-                    displayed_values = re.findall('":"([\w ]+)"', line.split(' ', 1)[1])
-                    values_list = values.split(';')
-                    values_output_list = []
-                    for value in [i for i in values_list if i in possible_values]:
-                        values_output_list.append(displayed_values[possible_values.index(value)])
-                    if not values_output_list and '*' in possible_values:
-                        values_output_list.append(displayed_values[possible_values.index('*')])
-                    if not values_output_list:
-                        continue
-                    else:
-                        output.append("{} : {}".format(label,
-                            ' - '.join(values_output_list)))
-                        continue
-        return '\n'.join(output)
+                label = re.search('\w+', line.split()[1]).group()
+                possible_values = re.findall('"(\w+|\*)":"', line.split(' ', 1)[1])
+                displayed_values = re.findall('":"([\w ]+)"', line.split(' ', 1)[1])
+                values = {}
+                for value, displayed_value in zip(possible_values, displayed_values):
+                    # The first occurrence of a value wins.
+                    values.setdefault(value, displayed_value)
+                program.append(('values', label, key, values, values.pop('*', None)))
+        return program
+    
+    def get_display_program(self):
+        """
+            Returns the compiled processing rules (see 'compile_pr'),
+            cached for each version of the preset and each language.
+        """
+        if self.id is None:
+            return self.compile_pr()
+        return display_programs_cache.get_or_set(
+            (self.id, self.version, get_language()), self.compile_pr
+        )
+    
+    def get_pr_items(self, properties):
+        """
+            Returns the list of the properties of a result to display,
+            as tuples (label, displayed value), following the PR.
+        """
+        items = []
+        for instruction in self.get_display_program():
+            value = properties.get(instruction[2])
+            if not value:
+                continue
+            if instruction[0] == 'display':
+                items.append((instruction[1], value))
+                continue
+            values, default = instruction[3], instruction[4]
+            values_output_list = [values[v] for v in value.split(';') if v in values]
+            if not values_output_list and default is not None:
+                values_output_list.append(default)
+            if values_output_list:
+                items.append((instruction[1], ' - '.join(values_output_list)))
+        return items
+    
+    def render_pr(self, properties):
+        """
+            Return a string describing the object with its properties and PR.
+        """
+        return '\n'.join(
+            "{} : {}".format(label, value)
+            for label, value in self.get_pr_items(properties)
+        )
+    
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            self.version += 1
+            super().save(*args, **kwargs)
+            return
+        # Incremented in the database, as the preset may have been
+        # saved by another process since this instance was loaded.
+        self.version = F("version") + 1
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=["version"])
+        return
     
     def __str__(self):
         return self.name
+
+class CachedAddress(models.Model):
+    """
+        An address obtained by reverse geocoding (of a result or of
+        the position of a user), cached to not request it again.
+        
+        See 'search.address_cache'.
+    """
+    key = models.CharField(max_length=100, unique=True, verbose_name=_("Clé"))
+    # Encoded in JSON.
+    data = models.TextField(verbose_name=_("Données"))
+    updated = models.DateTimeField(auto_now=True, db_index=True, verbose_name=_("Mise à jour"))
+    
+    class Meta:
+        verbose_name = _("Adresse en cache")
+        verbose_name_plural = _("Adresses en cache")
+    
+    def __str__(self):
+        return self.key
+
+compiled_filters_cache = caching.TTLCache(
+    "compiled_filters",
+    max_size=settings.GOOSE_CACHE["compiled_rules_max_size"],
+    ttl=settings.GOOSE_CACHE["compiled_rules_ttl"]
+)
+
+display_programs_cache = caching.TTLCache(
+    "display_programs",
+    max_size=settings.GOOSE_CACHE["compiled_rules_max_size"],
+    ttl=settings.GOOSE_CACHE["compiled_rules_ttl"]
+)
+
+@receiver(post_save, sender=SearchPreset)
+@receiver(pre_delete, sender=SearchPreset)
+def clear_compiled_rules(sender, **kwargs):
+    """
+        Frees the compiled rules of the outdated versions (in the
+        current process; the other ones will not use them anymore).
+    """
+    compiled_filters_cache.clear()
+    display_programs_cache.clear()
+    return
+
+@receiver(post_save, sender=Filter)
+@receiver(pre_delete, sender=Filter)
+def bump_presets_versions(sender, instance, **kwargs):
+    """
+        Increments the version of the presets using a filter
+        which changed.
+    """
+    SearchPreset.objects.filter(filters=instance).update(version=F("version") + 1)
+    compiled_filters_cache.clear()
+    return
+
+@receiver(m2m_changed, sender=SearchPreset.filters.through)
+def bump_preset_version(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+        Increments the version of the presets whose filters changed.
+    """
+    if action == "pre_clear" and reverse:
+        # The links of the filter are already deleted at "post_clear".
+        instance._cleared_presets_ids = list(
+            SearchPreset.objects.filter(filters=instance).values_list("id", flat=True)
+        )
+        return
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        presets = SearchPreset.objects.filter(id=instance.id)
+    elif action == "post_clear":
+        presets = SearchPreset.objects.filter(id__in=instance._cleared_presets_ids)
+    else:
+        presets = SearchPreset.objects.filter(id__in=pk_set)
+    presets.update(version=F("version") + 1)
+    if not reverse:
+        instance.refresh_from_db(fields=["version"])
+    return
@@ -0,0 +1,130 @@
+#  A lean Overpass client, which parses the answers as a stream
+#  instead of loading them entirely in memory.
+
+import re
+import sys
+import json
+import logging
+from contextlib import closing
+import requests
+from overpass import errors
+from search import http_client
+
+debug_logger = logging.getLogger("DEBUG")
+
+# Size of the chunks read from the connection.
+CHUNK_SIZE = 64 * 1024
+
+ELEMENTS_START = re.compile(r'"elements"\s*:\s*\[')
+SEPARATORS = re.compile(r'[\s,]*')
+
+def iter_elements(chunks):
+    """
+        Yields the elements of an Overpass JSON answer, given as an
+        iterable of text chunks, as soon as they are complete.
+        
+        Only the element being received is kept in memory, never
+        the whole document. Raises an OverpassError if the answer is
+        invalid, truncated, or ends with a runtime error.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ''
+    # Skips the header, up to the beginning of the array of elements.
+    while True:
+        match = ELEMENTS_START.search(buffer)
+        if match:
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise errors.UnknownOverpassError("Received an invalid answer from Overpass.")
+        buffer += chunk
+    position = match.end()
+    while True:
+        position = SEPARATORS.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == ']':
+            break
+        try:
+            element, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # The element is not entirely received yet.
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise errors.UnknownOverpassError("Received a truncated answer from Overpass.")
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield element
+    # The trailer may contain a remark, telling that the request failed.
+    trailer = buffer[position + 1:] + ''.join(chunks)
+    remark = re.search(r'"remark"\s*:\s*("(?:[^"\\]|\\.)*")', trailer)
+    if remark:
+        remark = json.loads(remark.group(1))
+        if remark.startswith("runtime error"):
+            raise errors.ServerRuntimeError(remark)
+    return
+
+def intern_tags(tags):
+    """
+        Returns the tags with interned keys and values, so that the
+        many elements sharing them (like "shop": "bakery") share
+        the same strings in memory.
+    """
+    return {sys.intern(key): sys.intern(value) for key, value in tags.items()}
+
+def element_to_feature(element):
+    """
+        Returns a GeoJSON feature from an element returned by Overpass
+        (with "out tags center"), or None if it has no position.
+    """
+    if element["type"] == "node":
+        lat, lon = element["lat"], element["lon"]
+    elif "center" in element:
+        lat, lon = element["center"]["lat"], element["center"]["lon"]
+    else:
+        return None
+    return {
+        "type": "Feature",
+        "id": element["id"],
+        "osm_type": element["type"],
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "properties": intern_tags(element.get("tags", {})),
+    }
+
+def get_features(endpoint, query, timeout):
+    """
+        Sends a query to an Overpass endpoint and yields the GeoJSON
+        features of the returned elements, while they are received.
+        
+        Raises the errors of the 'overpass' library.
+    """
+    try:
+        response = http_client.session.post(
+            endpoint, data={"data": query}, timeout=timeout, stream=True,
+            headers={'Accept-Charset': 'utf-8;q=0.7,*;q=0.7'}
+        )
+    except requests.exceptions.Timeout:
+        raise errors.TimeoutError(timeout)
+    except requests.exceptions.RequestException as e:
+        raise errors.UnknownOverpassError(str(e))
+    with closing(response):
+        if response.status_code == 400:
+            raise errors.OverpassSyntaxError(query)
+        elif response.status_code == 429:
+            raise errors.MultipleRequestsError()
+        elif response.status_code == 504:
+            raise errors.ServerLoadError(timeout)
+        elif response.status_code != 200:
+            raise errors.UnknownOverpassError(
+                "The request returned status code {}".format(response.status_code)
+            )
+        response.encoding = 'utf-8'
+        chunks = response.iter_content(CHUNK_SIZE, decode_unicode=True)
+        try:
+            for element in iter_elements(chunks):
+                feature = element_to_feature(element)
+                if feature is not None:
+                    yield feature
+        except requests.exceptions.RequestException as e:
+            raise errors.UnknownOverpassError(str(e))
+    return
@@ -0,0 +1,145 @@
+#  The asynchronous search pipeline, running the independent stages
+#  of a search concurrently.
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.utils import translation
+from goose import settings
+from search import utils
+
+debug_logger = logging.getLogger("DEBUG")
+
+# The blocking calls (network, timezone lookup) are run in this pool.
+executor = ThreadPoolExecutor(max_workers=settings.GOOSE_PIPELINE["max_workers"])
+
+def run(coroutine):
+    """
+        Runs a coroutine in a new event loop and returns its result.
+        Allows to use the pipeline from the (synchronous) views.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def close_loop(loop):
+    """
+        Cancels the pending tasks of a loop (for example when the
+        client of a streamed response is gone), and closes it.
+    """
+    pending = [task for task in asyncio.Task.all_tasks(loop) if not task.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(asyncio.wait(pending))
+    loop.close()
+    return
+
+async def in_executor(func, *args):
+    """
+        Runs a blocking function in the executor, with the language
+        of the current request (which is thread-local).
+    """
+    language = translation.get_language()
+    def call():
+        with translation.override(language):
+            return func(*args)
+    return await asyncio.get_event_loop().run_in_executor(executor, call)
+
+async def get_all_addresses(results, on_found=None):
+    """
+        Fills the addresses of the given results, like
+        'utils.get_all_addresses', but runs the Nominatim fallbacks
+        concurrently (at most 'nominatim_parallelism' at once), and
+        leaves empty the addresses not obtained before the deadline.
+        
+        Only the requests are run in the executor: the cache of the
+        addresses is read and written in the thread of the loop.
+        
+        'on_found' is called (in the thread of the loop) with the list
+        of the results whose address was just found, as soon as they are.
+    """
+    results_index = utils.get_addressless_results(results)
+    if not results_index:
+        return
+    addresses, uncached = utils.get_cached_addresses(list(results_index.values()))
+    if uncached:
+        fetched = await in_executor(utils.get_ban_addresses, uncached)
+        utils.store_addresses(uncached, fetched)
+        addresses.update(fetched)
+    missing = utils.merge_addresses(results_index, addresses, False)
+    missing = utils.get_cached_fallback_addresses(missing)
+    if on_found is not None:
+        missing_set = set(missing)
+        found = [result for result in results_index.values() if result not in missing_set]
+        if found:
+            on_found(found)
+    if not missing:
+        return
+    semaphore = asyncio.Semaphore(settings.GOOSE_PIPELINE["nominatim_parallelism"])
+    labels = {}
+    
+    async def fallback(result):
+        async with semaphore:
+            labels[result] = await in_executor(utils.request_fallback_address, result)
+        result.string_address = utils.format_fallback_address(labels[result])
+        if on_found is not None:
+            on_found([result])
+    
+    debug_logger.debug(
+        "Getting {} address(es) with Nominatim.".format(len(missing))
+    )
+    tasks = [asyncio.ensure_future(fallback(result)) for result in missing]
+    done, pending = await asyncio.wait(
+        tasks, timeout=settings.GOOSE_PIPELINE["nominatim_deadline"]
+    )
+    # The requests not sent yet are given up, the others are ignored.
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+        debug_logger.error(
+            "{} address(es) not obtained from Nominatim in time.".format(len(pending))
+        )
+    for task in done:
+        # Raises the unexpected errors.
+        task.result()
+    labels = [labels.get(result) for result in missing]
+    for result, label in zip(missing, labels):
+        result.string_address = utils.format_fallback_address(label)
+    utils.store_fallback_addresses(missing, labels)
+    return
+
+async def get_address(coords, mocking_parameters=None):
+    """
+        Returns the address of the given coordinates, like
+        'utils.get_address', but requests it in the executor.
+    """
+    return await in_executor(
+        lambda: utils.get_address(coords=coords, mocking_parameters=mocking_parameters)
+    )
+
+async def search(search_preset, user_coords, radius, no_private,
+        offset=0, limit=None, addresses=True):
+    """
+        Returns a ResultsPage with the requested page of the results
+        of a search (all of them by default), with their addresses.
+        
+        The timezone lookup and the fetch of the elements run
+        concurrently. The results are built in the thread of the loop,
+        as they may query the database.
+    """
+    radius = int(radius)
+    timezone_name, elements = await asyncio.gather(
+        in_executor(utils.get_timezone_name, user_coords),
+        in_executor(utils.fetch_elements, search_preset, user_coords, radius)
+    )
+    page = utils.build_results(
+        elements, search_preset, user_coords, radius, no_private,
+        timezone_name, offset, limit
+    )
+    if addresses and page.results:
+        await get_all_addresses(page.results)
+    return page
@@ -0,0 +1,20 @@
+#  A table of distinct values, used to send or store the values shared
+#  by many items once (the labels of the API, the strings of the
+#  addresses index...).
+
+class Table:
+    """
+        Stores each distinct string (or tuple) once, and gives its id.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+        return
+    
+    def add(self, value):
+        id_ = self.ids.get(value)
+        if id_ is None:
+            id_ = len(self.values)
+            self.ids[value] = id_
+            self.values.append(value)
+        return id_
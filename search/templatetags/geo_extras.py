@@ -6,18 +6,36 @@ register = template.Library()
 
 debug_logger = logging.getLogger("DEBUG")
 
+def is_fragment(result):
+    """
+        Returns True if the result is a 'fragments.FragmentResult',
+        whose parts depending on the user or on the time are rendered
+        as markers.
+    """
+    return hasattr(result, "marker")
+
 @register.filter()
 def get_item(dictionary, key):
     return dictionary.get(key)
 
+@register.filter()
+def render_open_state(result):
+    if is_fragment(result):
+        return result.marker("open_state")
+    if result.opening_hours.is_open():
+        return "<b>{}</b>".format(_("Ouvert"))
+    return "<b>{}</b>".format(_("Fermé"))
+
 @register.filter()
 def render_opening_hours(result, popover):
+    if is_fragment(result):
+        return result.marker("opening_hours")
     try:
-        oh_text = result.opening_hours.stringify_week_schedules().replace('\n', '<br/>')
+        oh_text = result.get_week_schedules().replace('\n', '<br/>')
     except Exception as e:
         debug_logger.error(
             "Error of HOH ({}) on rendering opening hours of the result (OSM_ID: {}).".format(
-                str(e), self.osm_meta[1]
+                str(e), result.osm_meta[1]
             )
         )
         return ''
@@ -41,6 +59,8 @@ def render_properties(result):
 
 @register.filter()
 def render_address_link(result):
+    if is_fragment(result):
+        return result.marker("address_link")
     itinerary_url = (
         'https://www.openstreetmap.org/directions?'
         'engine=graphhopper_foot&route={},{};{},{}'
@@ -39,11 +39,16 @@ def gouv_api_address(coords, address):
     }]
 
 def gouv_api_csv(csv):
-    output_csv = ''
+    output_csv = (
+        "latitude,longitude,uuid,result_latitude,result_longitude,"
+        "result_label,result_distance,result_type,result_id,"
+        "result_housenumber,result_name,result_street,result_postcode,"
+        "result_city,result_context,result_citycode\n"
+    )
     for line in csv.splitlines()[1:]:
         output_csv += line
         # Always fills the data of the result used for tests.
-        if bool(random.getrandbits(1)) or "-21.9419851,64.14602" in line: #"64,1460200,-21,9419851" in line:
+        if bool(random.getrandbits(1)) or "64.14602,-21.9419851" in line:
             output_csv += ',' + ','.join([
                 str(fake.latitude()),  # "result_latitude"
                 str(fake.longitude()),  # "result_longitude"
@@ -81,30 +86,25 @@ def result_properties():
         properties["opening_hours"] = "Mo-Th 12:30-16:30"
     return properties
 
-def geojsons():
+def overpass_elements():
     results = []
     for i in range(8):
         properties = result_properties()
         result = {
+            "type": "node",
             "id": random.randint(1, 10000),
-            "geometry": {
-                "type": "Point",
-                "coordinates": [
-                    float(fake.latitude()),
-                    float(fake.longitude())
-                ]
-            },
-            "properties": properties
+            "lat": float(fake.latitude()),
+            "lon": float(fake.longitude()),
+            "tags": properties
         }
         results.append(result)
     # Appends a constant result for tests.
     results.append({
+        "type": "node",
         "id": 1337,
-        "geometry": {
-            "type": "Point",
-            "coordinates": [64.1460200, -21.9419851]
-        },
-        "properties": {
+        "lat": 64.1460200,
+        "lon": -21.9419851,
+        "tags": {
             "name": "City Hall of Reykjavik",
             "opening_hours": "Mo-Fr 08:00-19:00",
             "wheelchair": "yes",
@@ -1,10 +1,42 @@
 from django.test import TestCase
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
+import threading
+import http.server
+import socketserver
+import json
+import time
+import zlib
 from django.core.exceptions import ValidationError
 from search.models import SearchPreset, Filter
 from search.forms import SearchForm
 from django.contrib.auth.models import User
 from django.utils.html import escape
+from django.template.loader import render_to_string
 from search.views import utils
+from search import caching
+from search import geometry
+from search import timezones
+from search import test_mockers
+from search import local_engine
+from search import local_geocoder
+from search import upstream
+from search import pipeline
+from search import fragments
+from search import overpass_client
+from search import http_client
+from search import address_cache
+from search.models import CachedAddress
+from search.middleware import StreamingGZipMiddleware
+import overpass
+from goose import settings
+from geopy import distance
+import tempfile
+import numpy
+import datetime
+import os
+from unittest import mock
+from collections import OrderedDict
 
 class UtilsTest(TestCase):
     """
@@ -20,13 +52,1018 @@ class UtilsTest(TestCase):
     def test_get_bearing(self):
         self.assertEqual(
             utils.get_bearing((47.2044, -1.5474), (47.4694, -0.5596)),
-            290.6
+            68.0
         )
         self.assertEqual(
             utils.get_bearing((48.8500, 2.3325), (51.5044, -0.1113)),
-            244.4
+            330.4
         )
         return
+    
+    def test_batch_geometry(self):
+        origin = (48.8500, 2.3325)
+        points = [(47.4694, -0.5596), (51.5044, -0.1113), (48.8510, 2.3335), origin]
+        distances, bearings = geometry.distances_and_bearings(origin, points)
+        for point, point_distance, bearing in zip(points, distances, bearings):
+            self.assertAlmostEqual(point_distance, distance.vincenty(origin, point).m, 3)
+            if point != origin:
+                self.assertAlmostEqual(bearing, utils.get_bearing(origin, point), 1)
+        distances, bearings = geometry.distances_and_bearings(origin, points, "haversine")
+        self.assertAlmostEqual(distances[1] / distance.vincenty(origin, points[1]).m, 1, 2)
+        return
+    
+    def test_lazy_result(self):
+        search_preset = SearchPreset(
+            name="Boulangerie / Pâtisserie",
+            osm_keys='"shop"="bakery"',
+            processing_rules='"fee" "Payant":["yes":"Oui"|"no":"Non"]'
+        )
+        search_preset.save()
+        feature = overpass_client.element_to_feature({
+            "type": "node", "id": 42, "lat": 64.1461, "lon": -21.942,
+            "tags": {"shop": "bakery", "wheelchair": "no", "opening_hours": "Mo-Su 08:00-19:00"}
+        })
+        other_feature = overpass_client.element_to_feature({
+            "type": "node", "id": 43, "lat": 64.1461, "lon": -21.942,
+            # Not a constant, which would already be interned.
+            "tags": json.loads('{"shop": "bakery"}')
+        })
+        self.assertIs(feature["properties"]["shop"], other_feature["properties"]["shop"])
+        result = utils.Result(
+            "node_42", feature, search_preset, (64.14624, -21.94259), "UTC"
+        )
+        self.assertFalse(hasattr(result, "__dict__"))
+        self.assertIs(result._tags, utils.NOT_COMPUTED)
+        self.assertIs(result._opening_hours, utils.NOT_COMPUTED)
+        self.assertIn("wheelchair_no", result.renderable_tags)
+        self.assertIsNot(result._tags, utils.NOT_COMPUTED)
+        self.assertEqual(result.direction, "SE ↘")
+        return
+    
+    def test_opening_hours_cache(self):
+        utils.opening_hours_cache.clear()
+        utils.week_schedules_cache.clear()
+        parsed = []
+        class FakeHOH:
+            def __init__(self, field, lang, tz):
+                parsed.append(field)
+                if field == "invalid":
+                    raise utils.humanized_opening_hours.HOHError()
+                return
+            
+            def stringify_week_schedules(self):
+                return "Lundi : 09:00 - 19:00"
+        with mock.patch.object(utils.humanized_opening_hours, "HumanizedOpeningHours", FakeHOH):
+            opening_hours = utils.parse_opening_hours("Mo 09:00-19:00", "UTC", "fr")
+            self.assertIs(utils.parse_opening_hours("Mo 09:00-19:00", "UTC", "fr"), opening_hours)
+            self.assertIsNot(utils.parse_opening_hours("Mo 09:00-19:00", "UTC", "en"), opening_hours)
+            self.assertEqual(len(parsed), 2)
+            # The failures are cached too.
+            with self.assertLogs("DEBUG", "ERROR") as logs:
+                self.assertIsNone(utils.parse_opening_hours("invalid", "UTC", "fr"))
+                self.assertIsNone(utils.parse_opening_hours("invalid", "UTC", "fr"))
+            self.assertEqual(len(logs.output), 1)
+            self.assertEqual(len(parsed), 3)
+            self.assertEqual(
+                utils.get_week_schedules("Mo 09:00-19:00", "UTC", "fr"),
+                "Lundi : 09:00 - 19:00"
+            )
+            self.assertEqual(utils.get_week_schedules("invalid", "UTC", "fr"), '')
+            self.assertEqual(len(parsed), 3)
+        utils.opening_hours_cache.clear()
+        utils.week_schedules_cache.clear()
+        return
+    
+    def test_ban_batches(self):
+        search_preset = SearchPreset(name="Parking", osm_keys='"amenity"="parking"')
+        search_preset.save()
+        results = [
+            utils.Result("node_{}".format(i), overpass_client.element_to_feature({
+                "type": "node", "id": i, "lat": 48.85 + i * 0.001, "lon": 2.35, "tags": {}
+            }), search_preset, (48.85, 2.35), "UTC")
+            for i in range(8)
+        ]
+        batches = []
+        def fake_request(csv_data):
+            batches.append(csv_data)
+            addresses = {}
+            for row in csv_data.splitlines()[1:]:
+                uuid = row.split(',')[2]
+                if uuid != "node_7":
+                    addresses[uuid] = ["12", "Rue de la Paix", "75002", "Paris"]
+                else:
+                    addresses[uuid] = ['', '', '', '']
+            return addresses
+        with mock.patch.dict(settings.GOOSE_UPSTREAM["ban"], {"batch_size": 3}), \
+                mock.patch.object(utils, "request_ban_addresses", fake_request):
+            missing = utils.get_all_addresses(results, False)
+        self.assertEqual(len(batches), 3)
+        self.assertTrue(all(batch.startswith("latitude,longitude,uuid\n") for batch in batches))
+        self.assertEqual(sorted(len(batch.splitlines()) for batch in batches), [3, 4, 4])
+        self.assertEqual(missing, [results[7]])
+        self.assertIn("Rue de la Paix", results[0].get_address())
+        self.assertIn("75002", results[6].get_address())
+        return
+    
+    def test_address_cache(self):
+        search_preset = SearchPreset(name="Parking", osm_keys='"amenity"="parking"')
+        search_preset.save()
+        def make_results():
+            return [
+                utils.Result("node_{}".format(i), overpass_client.element_to_feature({
+                    "type": "node", "id": i, "lat": 48.85 + i * 0.001, "lon": 2.35, "tags": {}
+                }), search_preset, (48.85, 2.35), "UTC")
+                for i in range(3)
+            ]
+        batches = []
+        def fake_request(csv_data):
+            batches.append(csv_data)
+            return {
+                row.split(',')[2]: ["12", "Rue de la Paix", "75002", "Paris"]
+                for row in csv_data.splitlines()[1:]
+            }
+        with mock.patch.object(utils, "request_ban_addresses", fake_request):
+            utils.get_all_addresses(make_results())
+            # The second search does not request the API.
+            results = make_results()
+            utils.get_all_addresses(results)
+        self.assertEqual(len(batches), 1)
+        self.assertIn("Rue de la Paix", results[2].get_address())
+        # The expired addresses are ignored, then purged.
+        CachedAddress.objects.update(
+            updated=address_cache.get_expiry() - datetime.timedelta(seconds=1)
+        )
+        with mock.patch.object(utils, "request_ban_addresses", fake_request):
+            utils.get_all_addresses(make_results())
+        self.assertEqual(len(batches), 2)
+        CachedAddress.objects.update(
+            updated=address_cache.get_expiry() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual(address_cache.purge_expired(), 3)
+        self.assertEqual(CachedAddress.objects.count(), 0)
+        return
+    
+    def test_purge_selected_addresses(self):
+        for key in ("a", "b", "c"):
+            address_cache.set(key, "Somewhere")
+        User.objects.create_superuser("admin", "test@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        selected = CachedAddress.objects.filter(key__in=["a", "b"])
+        self.client.post('/admin/search/cachedaddress/', {
+            "action": "purge_selected_addresses",
+            "_selected_action": [address.pk for address in selected],
+        })
+        self.assertEqual(
+            list(CachedAddress.objects.values_list("key", flat=True)), ["c"]
+        )
+        return
+    
+    def test_user_address_cache(self):
+        address_cache.positions_cache.clear()
+        with mock.patch.object(test_mockers, "gouv_api_address", wraps=test_mockers.gouv_api_address) as reverse:
+            first = utils.get_address(coords=(64.14624, -21.94259))
+            second = utils.get_address(coords=(64.146241, -21.942591))
+        self.assertEqual(first, second)
+        self.assertEqual(reverse.call_count, 1)
+        # The position of the user is not stored in the database.
+        self.assertEqual(CachedAddress.objects.count(), 0)
+        return
+    
+    def test_timezone_grid(self):
+        with tempfile.TemporaryDirectory() as path:
+            cells = numpy.zeros((36, 72), dtype=numpy.uint16)
+            # The cell of Paris (5° of side) is in "Europe/Paris".
+            cells[27, 36] = 2
+            numpy.save(os.path.join(path, "cells.npy"), cells)
+            with open(os.path.join(path, "names.json"), 'w') as f:
+                json.dump({"cell_size": 5, "names": ["Europe/London", "Europe/Paris"]}, f)
+            grid = timezones.TimezoneGrid(path)
+            timezones.timezones_cache.clear()
+            lookups = []
+            def find_timezone(coords):
+                lookups.append(coords)
+                return "Atlantic/Reykjavik"
+            with mock.patch.object(timezones, "get_grid", lambda: grid), \
+                    mock.patch.object(timezones, "find_timezone", find_timezone):
+                self.assertEqual(utils.get_timezone_name((48.85, 2.35)), "Europe/Paris")
+                self.assertEqual(lookups, [])
+                # The mixed cells are looked up in the polygons, once.
+                self.assertEqual(utils.get_timezone_name((64.1462, -21.9424)), "Atlantic/Reykjavik")
+                self.assertEqual(utils.get_timezone_name((64.14624, -21.94229)), "Atlantic/Reykjavik")
+                self.assertEqual(len(lookups), 1)
+        timezones.timezones_cache.clear()
+        return
+    
+    def test_representative_point(self):
+        square = [[2.0, 48.0], [2.2, 48.0], [2.2, 48.2], [2.0, 48.2], [2.0, 48.0]]
+        self.assertEqual(geometry.representative_point(square), (48.1, 2.1))
+        # The centroid of a "L" is not the center of its bounding box.
+        l_shape = [[0, 0], [2, 0], [2, 1], [1, 1], [1, 2], [0, 2], [0, 0]]
+        lat, lon = geometry.representative_point(l_shape)
+        self.assertAlmostEqual(lat, 5 / 6)
+        self.assertAlmostEqual(lon, 5 / 6)
+        self.assertEqual(geometry.representative_point([[0, 0], [1, 3]]), (1.5, 0.5))
+        return
+    
+    def test_tiles_around(self):
+        tiles = geometry.tiles_around((48.85, 2.35), 500, 0.01)
+        self.assertIn(geometry.tile_of((48.85, 2.35), 0.01), tiles)
+        # The circle is about 0.009° high and 0.014° wide.
+        self.assertTrue(4 <= len(tiles) <= 9)
+        for tile in tiles:
+            south, west, north, east = geometry.tile_bbox(tile, 0.01)
+            self.assertTrue(48.84 <= north and south <= 48.86)
+        return
+    
+    def test_tiles_cache(self):
+        utils.tiles_cache.clear()
+        requests = []
+        def fake_request_overpass(request):
+            requests.append(request)
+            return [
+                overpass_client.element_to_feature(element)
+                for element in test_mockers.overpass_elements()
+            ]
+        with mock.patch.object(utils, "request_overpass", fake_request_overpass):
+            elements = utils.get_elements('"shop"="bakery"', (64.14624, -21.94259), 500)
+            self.assertEqual(len(requests), 1)
+            self.assertIn(1337, [element["id"] for element in elements])
+            # A close search is answered by the cached tiles.
+            elements = utils.get_elements('"shop"="bakery"', (64.14630, -21.94250), 300)
+            self.assertEqual(len(requests), 1)
+            self.assertIn(1337, [element["id"] for element in elements])
+            # The stale tiles are served, and refreshed in one request.
+            clock = FakeClock()
+            clock.now = time.monotonic() + settings.GOOSE_CACHE["tiles_ttl"] + 1
+            with mock.patch.object(utils.tiles_cache, "clock", clock):
+                elements = utils.get_elements('"shop"="bakery"', (64.14624, -21.94259), 500)
+                self.assertIn(1337, [element["id"] for element in elements])
+                for i in range(500):
+                    if len(requests) == 2 and not utils.tiles_cache._refreshing:
+                        break
+                    time.sleep(0.01)
+                self.assertEqual(len(requests), 2)
+                self.assertEqual(requests[0], requests[1])
+                elements = utils.get_elements('"shop"="bakery"', (64.14624, -21.94259), 500)
+            self.assertEqual(len(requests), 2)
+        return
+    
+    def test_overpass_query(self):
+        request = utils.build_tiles_query('"shop"="bakery"', [(-2195, 6414)])
+        self.assertTrue(request.startswith("[out:json][timeout:25][maxsize:"))
+        self.assertIn('way["shop"="bakery"](64.14,-21.95,64.15,-21.94);', request)
+        self.assertIn('relation["shop"="bakery"](64.14,-21.95,64.15,-21.94);', request)
+        self.assertTrue(request.endswith(");out tags center qt;"))
+        feature = overpass_client.element_to_feature({
+            "type": "way", "id": 42, "tags": {"shop": "bakery"},
+            "center": {"lat": 64.1461, "lon": -21.942}
+        })
+        self.assertEqual(utils.get_element_meta(feature), ("way", 42))
+        self.assertEqual(utils.get_element_coordinates(feature), (64.1461, -21.942))
+        self.assertIsNone(overpass_client.element_to_feature({"type": "relation", "id": 1}))
+        return
+    
+    def test_select_nearest(self):
+        elements = [
+            {"id": i, "osm_type": "node", "properties": {},
+            "geometry": {"type": "Point", "coordinates": [2.35, 48.85 + i * 0.0001]}}
+            for i in (7, 3, 9, 1, 5, 2, 8, 4, 6)
+        ]
+        elements[0]["properties"]["access"] = "private"
+        records, total = utils.select_nearest(elements, (48.85, 2.35), 80, True, 2, 3)
+        self.assertEqual(total, 6)
+        self.assertEqual([record[1][1] for record in records], [3, 4, 5])
+        records, total = utils.select_nearest(elements, (48.85, 2.35), 80, False)
+        self.assertEqual([record[1][1] for record in records], [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(records[0][0], 11)
+        return
+
+OVERPASS_ANSWER = """{
+  "version": 0.6,
+  "generator": "Overpass API",
+  "osm3s": {"timestamp_osm_base": "2017-10-24T10:00:02Z"},
+  "elements": [
+{"type": "node", "id": 1, "lat": 64.1, "lon": -21.9, "tags": {"name": "A \\"]\\" [B]", "shop": "bakery"}},
+{"type": "way", "id": 2, "center": {"lat": 64.2, "lon": -21.8}, "tags": {"shop": "bakery"}},
+{"type": "relation", "id": 3, "tags": {"shop": "bakery"}}
+  ]{}
+}"""
+
+class OverpassClientTest(TestCase):
+    """
+        Tests the streaming Overpass client.
+    """
+    def parse(self, answer, chunk_size):
+        chunks = (answer[i:i+chunk_size] for i in range(0, len(answer), chunk_size))
+        return list(overpass_client.iter_elements(chunks))
+    
+    def test_iter_elements(self):
+        answer = OVERPASS_ANSWER.replace("]{}", "]")
+        for chunk_size in (1, 7, 100, len(answer)):
+            elements = self.parse(answer, chunk_size)
+            self.assertEqual([e["id"] for e in elements], [1, 2, 3])
+            self.assertEqual(elements[0]["tags"]["name"], 'A "]" [B]')
+        features = [overpass_client.element_to_feature(e) for e in elements]
+        self.assertEqual(features[1]["geometry"]["coordinates"], [-21.8, 64.2])
+        self.assertIsNone(features[2])
+        return
+    
+    def test_lazy_parsing(self):
+        answer = OVERPASS_ANSWER.replace("]{}", "]")
+        received = []
+        def chunks():
+            for i in range(0, len(answer), 10):
+                received.append(i)
+                yield answer[i:i+10]
+        elements = overpass_client.iter_elements(chunks())
+        next(elements)
+        # The first element is available before the end of the answer.
+        self.assertLess(len(received) * 10, answer.index('"id": 2'))
+        return
+    
+    def test_errors(self):
+        answer = OVERPASS_ANSWER.replace(
+            "]{}", '],\n  "remark": "runtime error: Query timed out in \\"query\\"."'
+        )
+        with self.assertRaises(overpass.errors.ServerRuntimeError):
+            self.parse(answer, 50)
+        with self.assertRaises(overpass.errors.UnknownOverpassError):
+            self.parse(OVERPASS_ANSWER[:300], 50)
+        with self.assertRaises(overpass.errors.UnknownOverpassError):
+            self.parse("<html>Error</html>", 50)
+        return
+
+class FakeClock:
+    # Allows to control the time seen by the caches.
+    def __init__(self):
+        self.now = 0
+        return
+    
+    def __call__(self):
+        return self.now
+
+class CachingTest(TestCase):
+    """
+        Tests the in-process caches.
+    """
+    def test_ttl_and_lru(self):
+        clock = FakeClock()
+        cache = caching.TTLCache("test", max_size=2, ttl=10, clock=clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is now the least recently used key.
+        cache.set("c", 3)
+        self.assertIs(cache.get("b"), caching.MISSING)
+        self.assertEqual(cache.get("c"), 3)
+        clock.now = 11
+        self.assertIs(cache.get("a"), caching.MISSING)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 2)
+        return
+    
+    def test_stale_while_revalidate(self):
+        clock = FakeClock()
+        cache = caching.TTLCache(
+            "test", max_size=10, ttl=10, stale_ttl=10, clock=clock
+        )
+        cache.set("a", "old")
+        clock.now = 15
+        refreshed = threading.Event()
+        def loader():
+            refreshed.set()
+            return "new"
+        # The stale value is served while the refresh happens.
+        self.assertEqual(cache.get_or_set("a", loader), "old")
+        self.assertTrue(refreshed.wait(5))
+        for i in range(50):
+            if cache.get("a") == "new":
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get("a"), "new")
+        clock.now = 40
+        self.assertIs(cache.get("a"), caching.MISSING)
+        return
+
+OSM_EXTRACT = """\
+<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="64.1460200" lon="-21.9419851">
+    <tag k="shop" v="bakery"/>
+    <tag k="name" v="Brauð &amp; Co"/>
+  </node>
+  <node id="2" lat="64.1500000" lon="-21.9500000">
+    <tag k="shop" v="butcher"/>
+  </node>
+  <node id="3" lat="64.1470000" lon="-21.9430000"/>
+  <node id="4" lat="64.1471000" lon="-21.9431000"/>
+  <way id="10">
+    <nd ref="3"/>
+    <nd ref="4"/>
+    <tag k="shop" v="pastry"/>
+  </way>
+  <node id="5" lat="48.8500000" lon="2.3500000">
+    <tag k="shop" v="bakery"/>
+  </node>
+  <node id="6" lat="64.1480000" lon="-21.9440000"/>
+  <node id="7" lat="64.1480000" lon="-21.9450000"/>
+  <node id="8" lat="64.1490000" lon="-21.9450000"/>
+  <way id="11">
+    <nd ref="6"/>
+    <nd ref="7"/>
+    <nd ref="8"/>
+    <nd ref="6"/>
+  </way>
+  <relation id="20">
+    <member type="way" ref="11" role="outer"/>
+    <tag k="type" v="multipolygon"/>
+    <tag k="shop" v="bakery"/>
+  </relation>
+</osm>
+"""
+
+class LocalEngineTest(TestCase):
+    """
+        Tests the offline search engine.
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".osm")
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(OSM_EXTRACT)
+        return
+    
+    def tearDown(self):
+        os.remove(self.path)
+        return
+    
+    def test_index(self):
+        index = local_engine.build_index(
+            self.path, ['"shop"="bakery"', '"shop"="pastry"']
+        )
+        self.assertEqual(index.size, 4)
+        elements = index.get_elements(
+            '"shop"="bakery"\n"shop"="pastry"', (64.14624, -21.94259), 500
+        )
+        self.assertEqual(sorted(e["id"] for e in elements), [1, 10, 20])
+        # The relations are placed at the center of their bounding box.
+        relation = [e for e in elements if e["id"] == 20][0]
+        self.assertEqual(utils.get_element_meta(relation), ("relation", 20))
+        lat, lon = utils.get_element_coordinates(relation)
+        self.assertAlmostEqual(lat, 64.1485)
+        self.assertAlmostEqual(lon, -21.9445)
+        elements = index.get_elements('"shop"="pastry"', (48.85, 2.35), 500)
+        self.assertEqual(elements, [])
+        return
+    
+    def test_index_reload(self):
+        with tempfile.TemporaryDirectory() as path:
+            index_path = os.path.join(path, "osm_index.pickle")
+            index = local_engine.build_index(self.path, ['"shop"="bakery"'])
+            local_engine.save_index(index, index_path)
+            with mock.patch.dict(settings.GOOSE_LOCAL_ENGINE, {"index_path": index_path}), \
+                    mock.patch.object(local_engine, "_index", None):
+                self.assertEqual(local_engine.get_index().size, 3)
+                loaded = local_engine.get_index()
+                self.assertIs(local_engine.get_index(), loaded)
+                # A rebuilt index is loaded without restarting.
+                index = local_engine.build_index(
+                    self.path, ['"shop"="bakery"', '"shop"="pastry"']
+                )
+                local_engine.save_index(index, index_path)
+                os.utime(index_path, (0, 0))
+                self.assertEqual(local_engine.get_index().size, 4)
+        return
+    
+    def test_local_backend(self):
+        search_preset = SearchPreset(name="Boulangerie", osm_keys='"shop"="bakery"')
+        search_preset.save()
+        index = local_engine.build_index(self.path, ['"shop"="bakery"'])
+        with mock.patch.object(settings, "GOOSE_SEARCH_BACKEND", "local"), \
+                mock.patch.object(local_engine, "get_index", lambda: index):
+            results = utils.get_results(
+                search_preset, (64.14624, -21.94259), 500, True, "UTC"
+            )
+        self.assertEqual([r.osm_meta for r in results], [("node", 1), ("relation", 20)])
+        self.assertEqual(results[0].properties["name"], "Brauð & Co")
+        # Overpass is used while the index is not built.
+        missing_path = os.path.join(os.path.dirname(self.path), "missing.pickle")
+        with mock.patch.object(settings, "GOOSE_SEARCH_BACKEND", "local"), \
+                mock.patch.dict(settings.GOOSE_LOCAL_ENGINE, {"index_path": missing_path}), \
+                mock.patch.object(local_engine, "_index", None), \
+                mock.patch.object(utils, "get_elements", return_value=[]) as get_elements:
+            results = utils.get_results(
+                search_preset, (64.14624, -21.94259), 500, True, "UTC"
+            )
+        self.assertTrue(get_elements.called)
+        self.assertEqual(results, [])
+        return
+
+BAN_DUMP = """id;id_fantoir;numero;rep;nom_voie;code_postal;code_insee;nom_commune;lon;lat
+75102_7152_00012;75102_7152;12;;Rue de la Paix;75002;75102;Paris;2.331;48.8692
+75102_7152_00014;75102_7152;14;bis;Rue de la Paix;75002;75102;Paris;2.3312;48.8694
+75101_1234_00001;75101_1234;1;;Place Vendôme;75001;75101;Paris;2.3294;48.8675
+"""
+
+class LocalGeocoderTest(TestCase):
+    """
+        Tests the offline reverse geocoder.
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        dump = os.path.join(self.directory.name, "adresses-75.csv")
+        with open(dump, 'w', encoding='utf-8') as f:
+            f.write(BAN_DUMP)
+        path = os.path.join(self.directory.name, "index")
+        self.assertEqual(local_geocoder.build_index([dump], path, 0.005), 3)
+        self.index = local_geocoder.AddressIndex(path)
+        return
+    
+    def tearDown(self):
+        self.directory.cleanup()
+        return
+    
+    def test_nearest(self):
+        position = self.index.nearest((48.86935, 2.3311), 200)
+        self.assertEqual(
+            self.index.get_address_data(position),
+            ["14bis", "Rue de la Paix", "75002", "Paris"]
+        )
+        position = self.index.nearest((48.8676, 2.3293), 200)
+        self.assertEqual(self.index.get_address_data(position)[1], "Place Vendôme")
+        # Too far from any address.
+        self.assertIsNone(self.index.nearest((48.8692, 2.3400), 200))
+        self.assertIsNone(self.index.nearest((64.14624, -21.94259), 200))
+        return
+    
+    def test_local_addresses(self):
+        with mock.patch.dict(settings.GOOSE_LOCAL_GEOCODER, {"enabled": True}), \
+                mock.patch.object(local_geocoder, "get_index", lambda: self.index), \
+                mock.patch.object(utils, "request_ban_addresses") as request:
+            position = utils.get_address(coords=(48.8692, 2.3310))
+            search_preset = SearchPreset(name="Parking", osm_keys='"amenity"="parking"')
+            search_preset.save()
+            results = [
+                utils.Result("node_{}".format(i), overpass_client.element_to_feature({
+                    "type": "node", "id": i, "lat": lat, "lon": lon, "tags": {}
+                }), search_preset, (48.8692, 2.3310), "UTC")
+                for i, (lat, lon) in enumerate([(48.8692, 2.3310), (48.8692, 2.3400)])
+            ]
+            missing = utils.get_all_addresses(results, False)
+        self.assertEqual(position[1], "12 Rue de la Paix 75002 Paris")
+        self.assertAlmostEqual(position[0][0], 48.8692, places=4)
+        request.assert_not_called()
+        self.assertIn("Rue de la Paix", results[0].get_address())
+        self.assertEqual(missing, [results[1]])
+        return
+    
+    def test_index_reload(self):
+        dump = os.path.join(self.directory.name, "adresses-75.csv")
+        path = os.path.join(self.directory.name, "new_index")
+        with mock.patch.dict(settings.GOOSE_LOCAL_GEOCODER, {"index_path": path}), \
+                mock.patch.object(local_geocoder, "_index", None):
+            # Not built yet.
+            self.assertIsNone(local_geocoder.get_index())
+            self.assertIsNone(local_geocoder.get_index())
+            local_geocoder.build_index([dump], path, 0.005)
+            index = local_geocoder.get_index()
+            self.assertIsNotNone(index)
+            self.assertIs(local_geocoder.get_index(), index)
+            # Built again.
+            local_geocoder.build_index([dump], path, 0.005)
+            os.utime(os.path.join(path, "tables.json"), (0, 0))
+            self.assertIsNot(local_geocoder.get_index(), index)
+        return
+
+class FakeHedgedOverpass(upstream.HedgedOverpass):
+    # Replaces the HTTP requests by a dict of fake behaviours.
+    def __init__(self, behaviours, **kwargs):
+        super().__init__(list(behaviours), timeout=1, **kwargs)
+        self.behaviours = behaviours
+        self.calls = []
+        return
+    
+    def send(self, endpoint, query):
+        self.calls.append(endpoint.url)
+        delay, elements = self.behaviours[endpoint.url]
+        if isinstance(delay, threading.Event):
+            # Answers when the test sets it.
+            delay.wait(5)
+        else:
+            time.sleep(delay)
+        if elements is None:
+            raise upstream.overpass.errors.ServerLoadError(1)
+        return elements
+
+class UpstreamTest(TestCase):
+    """
+        Tests the tools used to call the upstream services.
+    """
+    def setUp(self):
+        upstream.breakers.clear()
+        return
+    
+    def test_hedging(self):
+        released = threading.Event()
+        api = FakeHedgedOverpass(
+            OrderedDict([("slow", (released, ["slow"])), ("fast", (0, ["fast"]))]),
+            min_hedge_delay=0.05, default_latency=0.05
+        )
+        # The slow endpoint answers only after the end of the request.
+        self.assertEqual(api.get("query"), ["fast"])
+        released.set()
+        self.assertEqual(api.calls, ["slow", "fast"])
+        # The fastest endpoint is now requested first.
+        api.calls = []
+        self.assertEqual(api.get("query"), ["fast"])
+        self.assertEqual(api.calls, ["fast"])
+        return
+    
+    def test_failover(self):
+        api = FakeHedgedOverpass(
+            OrderedDict([("down", (0, None)), ("up", (0, ["up"]))]),
+            min_hedge_delay=5
+        )
+        self.assertEqual(api.get("query"), ["up"])
+        api = FakeHedgedOverpass(OrderedDict([("down", (0, None))]))
+        with self.assertRaises(upstream.overpass.OverpassError):
+            api.get("query")
+        self.assertEqual(api.endpoints[0].stats()["failures"], 1)
+        return
+    
+    def test_fast_failures_order(self):
+        api = FakeHedgedOverpass(
+            OrderedDict([("failing fast", (0, None)), ("working", (0.1, ["working"]))]),
+            min_hedge_delay=5, default_latency=1
+        )
+        self.assertEqual(api.get("query"), ["working"])
+        self.assertEqual(api.calls, ["failing fast", "working"])
+        # The endpoint failing fast is not considered as the fastest.
+        api.calls = []
+        self.assertEqual(api.get("query"), ["working"])
+        self.assertEqual(api.calls, ["working"])
+        return
+    
+    def test_circuit_breaker(self):
+        clock = FakeClock()
+        breaker = upstream.CircuitBreaker(
+            "test", failure_threshold=2, reset_timeout=10, clock=clock
+        )
+        calls = []
+        def failing():
+            calls.append(1)
+            raise ValueError("Service down.")
+        with mock.patch.object(upstream.time, "sleep") as sleep:
+            with self.assertRaises(upstream.CircuitOpenError):
+                upstream.call_with_retries(breaker, (ValueError,), failing)
+            # Waits before each retry.
+            self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(upstream.CircuitOpenError):
+            upstream.call_with_retries(breaker, (ValueError,), failing)
+        self.assertEqual(len(calls), 2)
+        # A trial call is allowed after the reset timeout.
+        clock.now = 11
+        self.assertEqual(breaker.state, "half-open")
+        self.assertEqual(
+            upstream.call_with_retries(breaker, (ValueError,), lambda: "ok"),
+            "ok"
+        )
+        self.assertEqual(breaker.state, "closed")
+        return
+    
+    def test_unexpected_error_trial(self):
+        clock = FakeClock()
+        breaker = upstream.CircuitBreaker(
+            "test", failure_threshold=1, reset_timeout=10, clock=clock
+        )
+        breaker.record_failure()
+        clock.now = 11
+        def broken():
+            raise KeyError("Unexpected.")
+        # Not retried, and recorded as a failed trial.
+        with self.assertRaises(KeyError):
+            upstream.call_with_retries(breaker, (ValueError,), broken)
+        self.assertEqual(breaker.state, "open")
+        # A new trial is allowed after the reset timeout.
+        clock.now = 22
+        self.assertEqual(
+            upstream.call_with_retries(breaker, (ValueError,), lambda: "ok"), "ok"
+        )
+        self.assertEqual(breaker.state, "closed")
+        return
+    
+    def test_all_endpoints_down(self):
+        api = FakeHedgedOverpass(OrderedDict([("down", (0, None))]))
+        for i in range(settings.GOOSE_UPSTREAM["overpass"]["failure_threshold"]):
+            with self.assertRaises(upstream.overpass.OverpassError):
+                api.get("query")
+        with self.assertRaises(upstream.OverpassUnavailableError):
+            api.get("query")
+        self.assertEqual(len(api.calls), settings.GOOSE_UPSTREAM["overpass"]["failure_threshold"])
+        return
+    
+    def test_token_bucket(self):
+        clock = FakeClock()
+        delays = []
+        def sleep(delay):
+            delays.append(delay)
+            clock.now += delay
+        bucket = upstream.TokenBucket("test", rate=1, capacity=2, clock=clock, sleep=sleep)
+        self.assertTrue(bucket.acquire())
+        self.assertTrue(bucket.acquire())
+        self.assertEqual(delays, [])
+        # The bucket is empty: waits for the next token.
+        self.assertTrue(bucket.acquire())
+        self.assertEqual(delays, [1])
+        # Would have to wait too long.
+        self.assertFalse(bucket.acquire(timeout=0.5))
+        clock.now += 1
+        self.assertTrue(bucket.acquire(timeout=0.5))
+        self.assertEqual(bucket.stats()["rejected"], 1)
+        return
+    
+    def test_rate_limited(self):
+        calls = []
+        with mock.patch.dict(upstream.buckets, {
+                    "nominatim": upstream.TokenBucket("test", rate=0.1, capacity=1)
+                }), \
+                mock.patch.dict(settings.GOOSE_UPSTREAM["nominatim"], {"max_wait": 1}):
+            func = upstream.rate_limited("nominatim", calls.append)
+            func(1)
+            with self.assertRaises(upstream.RateLimitError):
+                func(2)
+        self.assertEqual(calls, [1])
+        return
+    
+    def test_rate_limited_trial(self):
+        clock = FakeClock()
+        breaker = upstream.CircuitBreaker(
+            "test", failure_threshold=1, reset_timeout=10, clock=clock
+        )
+        breaker.record_failure()
+        clock.now = 11
+        with mock.patch.dict(upstream.buckets, {
+                    "nominatim": upstream.TokenBucket("test", rate=0.1, capacity=0)
+                }), \
+                mock.patch.dict(settings.GOOSE_UPSTREAM["nominatim"], {"max_wait": 1}):
+            func = upstream.rate_limited("nominatim", lambda: "ok")
+            with self.assertRaises(upstream.RateLimitError):
+                upstream.call_with_retries(breaker, (ValueError,), func)
+        # The trial was not made, so the next call can be the trial.
+        self.assertEqual(breaker.state, "half-open")
+        self.assertEqual(
+            upstream.call_with_retries(breaker, (ValueError,), lambda: "ok"), "ok"
+        )
+        self.assertEqual(breaker.state, "closed")
+        return
+
+class FakeUpstreamHandler(http.server.BaseHTTPRequestHandler):
+    # Answers all the requests with a Nominatim-like JSON, keeping alive the connections.
+    protocol_version = "HTTP/1.1"
+    
+    def do_GET(self):
+        body = json.dumps({
+            "lat": "48.85", "lon": "2.35", "display_name": "Rue de la Paix, Paris"
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+    
+    def log_message(self, *args):
+        return
+
+class FakeUpstreamServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    # The kept-alive connections are handled in their own thread.
+    daemon_threads = True
+
+class HTTPClientTest(TestCase):
+    """
+        Tests the shared HTTP layer.
+    """
+    def setUp(self):
+        self.server = FakeUpstreamServer(("127.0.0.1", 0), FakeUpstreamHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host = "127.0.0.1:{}".format(self.server.server_port)
+        return
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        return
+    
+    def test_connections_reuse(self):
+        for i in range(3):
+            response = http_client.session.get("http://{}/".format(self.host), timeout=5)
+            self.assertEqual(response.status_code, 200)
+        stats = http_client.get_stats()[self.host]
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["reused_connections"], 2)
+        self.assertIsNotNone(stats["median_latency"])
+        return
+    
+    def test_pooled_nominatim(self):
+        geolocator = http_client.PooledNominatim(domain=self.host, scheme="http", timeout=5)
+        location = geolocator.reverse("48.85, 2.35")
+        self.assertEqual(location.address, "Rue de la Paix, Paris")
+        self.assertEqual(http_client.get_stats()[self.host]["requests"], 1)
+        return
+
+class SingleFlightTest(TestCase):
+    """
+        Tests the deduplication of concurrent identical calls.
+    """
+    def test_threads(self):
+        flight = caching.SingleFlight("test")
+        calls = []
+        started = threading.Event()
+        def slow():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return "result"
+        returned = []
+        threads = [
+            threading.Thread(target=lambda: returned.append(flight.do("key", slow)))
+            for i in range(5)
+        ]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(returned, ["result"] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()["shared"], 4)
+        return
+    
+    def test_processes(self):
+        # Two instances simulate two processes sharing the lock directory.
+        with tempfile.TemporaryDirectory() as lock_dir:
+            flight1 = caching.SingleFlight("test", lock_dir=lock_dir)
+            flight2 = caching.SingleFlight("test", lock_dir=lock_dir)
+            self.assertEqual(flight1.do("key", lambda: [1, 2]), [1, 2])
+            self.assertEqual(flight2.do("key", lambda: self.fail("Not shared.")), [1, 2])
+        return
+
+class PipelineTest(TestCase):
+    """
+        Tests the asynchronous search pipeline.
+    """
+    def setUp(self):
+        self.search_preset = SearchPreset(
+            name="Boulangerie / Pâtisserie",
+            osm_keys='"shop"="bakery"\n"shop"="pastry"',
+            processing_rules='"fee" "Payant":["yes":"Oui"|"no":"Non"]'
+        )
+        self.search_preset.save()
+        return
+    
+    def test_search(self):
+        results = pipeline.run(pipeline.search(
+            self.search_preset, (64.14624, -21.94259), "500", True
+        )).results
+        self.assertEqual(results[0].properties["name"], "City Hall of Reykjavik")
+        self.assertIn("Adresse estimée : ", results[0].get_address())
+        return
+    
+    def test_concurrent_stages(self):
+        # Broken (after a timeout) unless both stages run at the same time.
+        barrier = threading.Barrier(2, timeout=5)
+        def slow_timezone(coords):
+            barrier.wait()
+            return "UTC"
+        def slow_elements(search_preset, coords, radius):
+            barrier.wait()
+            return []
+        with mock.patch.object(utils, "get_timezone_name", slow_timezone), \
+                mock.patch.object(utils, "fetch_elements", slow_elements):
+            page = pipeline.run(pipeline.search(
+                self.search_preset, (64.14624, -21.94259), 500, True
+            ))
+        self.assertEqual(page.results, [])
+        return
+    
+    def test_parallel_fallbacks(self):
+        results = utils.get_results(
+            self.search_preset, (64.14624, -21.94259), 500, True, "UTC"
+        )
+        # Four results, four concurrent requests.
+        barrier = threading.Barrier(4, timeout=5)
+        def slow_fallback(result):
+            barrier.wait()
+            return "Somewhere"
+        with mock.patch.object(utils, "merge_addresses", lambda index, addresses, fallback: results * 4), \
+                mock.patch.object(utils, "request_fallback_address", slow_fallback):
+            pipeline.run(pipeline.get_all_addresses(results))
+        self.assertFalse(barrier.broken)
+        self.assertEqual(results[0].string_address, "Adresse estimée : Somewhere")
+        return
+    
+    def test_fallbacks_deadline(self):
+        results = utils.get_results(
+            self.search_preset, (64.14624, -21.94259), 500, True, "UTC"
+        )
+        results = results[:1] + [
+            utils.Result(
+                "node_{}".format(i), overpass_client.element_to_feature({
+                    "type": "node", "id": i, "lat": 64.14, "lon": -21.94, "tags": {}
+                }), self.search_preset, (64.14624, -21.94259), "UTC"
+            ) for i in range(2)
+        ]
+        # The other requests end only after the pipeline.
+        released = threading.Event()
+        def fallback(result):
+            if result is not results[0]:
+                released.wait(5)
+            return "Somewhere"
+        with mock.patch.object(utils, "merge_addresses", lambda index, addresses, fallback: results), \
+                mock.patch.object(utils, "request_fallback_address", fallback), \
+                mock.patch.dict(settings.GOOSE_PIPELINE, {"nominatim_deadline": 0.2}):
+            pipeline.run(pipeline.get_all_addresses(results))
+            released.set()
+        self.assertEqual(results[0].string_address, "Adresse estimée : Somewhere")
+        self.assertEqual(results[1].string_address, '')
+        # Only the obtained address is cached.
+        self.assertEqual(CachedAddress.objects.filter(key__startswith="nominatim:").count(), 1)
+        return
+    
+    def test_sync_fallbacks(self):
+        results = [
+            utils.Result(
+                "node_{}".format(i), overpass_client.element_to_feature({
+                    "type": "node", "id": i, "lat": 64.14, "lon": -21.94, "tags": {}
+                }), self.search_preset, (64.14624, -21.94259), "UTC"
+            ) for i in range(4)
+        ]
+        # Four results, four concurrent requests.
+        barrier = threading.Barrier(4, timeout=5)
+        def slow_fallback(result):
+            barrier.wait()
+            return "Somewhere"
+        with mock.patch.object(utils, "request_fallback_address", slow_fallback):
+            utils.get_fallback_addresses(results)
+        self.assertFalse(barrier.broken)
+        self.assertEqual(results[0].string_address, "Adresse estimée : Somewhere")
+        return
+
+class FragmentsTest(TestCase):
+    """
+        Tests the cache of the rendered results.
+    """
+    def setUp(self):
+        fragments.fragments_cache.clear()
+        self.search_preset = SearchPreset(
+            name="Boulangerie", osm_keys='"shop"="bakery"',
+            processing_rules='"fee" "Payant":["yes":"Oui"|"no":"Non"]'
+        )
+        self.search_preset.save()
+        return
+    
+    def get_result(self, user_coords):
+        result = utils.Result("node_1", overpass_client.element_to_feature({
+            "type": "node", "id": 1, "lat": 48.85, "lon": 2.35, "tags": {
+                "shop": "bakery", "name": "Boulangerie <Test>", "fee": "yes",
+                "phone": "01 23 45 67 89", "wheelchair": "yes",
+            }
+        }), self.search_preset, user_coords, "Europe/Paris")
+        result.string_address = 'Adresse estimée : <span itemprop="streetAddress">12 Rue de la Paix</span>'
+        return result
+    
+    def test_same_rendering(self):
+        for user_coords in [(48.86, 2.36), (48.84, 2.30)]:
+            result = self.get_result(user_coords)
+            self.assertEqual(
+                fragments.render_result_block(result),
+                render_to_string("search/result_block.part.html", {
+                    "result": result, "render_tags": True,
+                    "oh_in_popover": True, "light": False
+                })
+            )
+            self.assertEqual(
+                fragments.render_marker_popup(result),
+                render_to_string("search/marker_popup.part.html", {"result": result})
+            )
+        return
+    
+    def test_cached_rendering(self):
+        fragments.render_result_block(self.get_result((48.86, 2.36)))
+        with mock.patch.object(fragments, "render_to_string") as render:
+            html = fragments.render_result_block(self.get_result((48.84, 2.30)))
+            render.assert_not_called()
+        self.assertNotIn("\x1e", html)
+        self.assertIn("route=48.84,2.3;48.85,2.35", html)
+        # A new version of the SearchPreset is rendered again.
+        self.search_preset.save()
+        with mock.patch.object(fragments, "render_to_string", return_value='') as render:
+            fragments.render_result_block(self.get_result((48.84, 2.30)))
+            render.assert_called_once()
+        return
 
 class FakeResult:
     # Mocks a real Result object.
@@ -97,6 +1134,44 @@ class FilterTest(TestCase):
         fee=no == free == Gratuit"""
         tag = f.parse_result(result)
         self.assertEqual(tag, None)
+        
+        # In case of multiple matches, the first line wins.
+        f.processing_rules = """\
+        shop=supermarket == supermarket == Supermarché
+        fee=yes == paying == Payant
+        shop=greengrocer == greengrocer == Primeur
+        * == other == Autre"""
+        tag = f.parse_result(result)
+        self.assertEqual(tag, ("paying", "Payant", "Test filter"))
+        tag = f.parse_result(FakeResult({"shop": "bakery"}))
+        self.assertEqual(tag, ("other", "Autre", "Test filter"))
+        return
+    
+    def test_compiled_filters(self):
+        f = Filter(name="Fee", processing_rules="fee=yes == paying == Payant\nfee=no == free == Gratuit")
+        f.save()
+        sp = SearchPreset(name="Parking", osm_keys='"amenity"="parking"')
+        sp.save()
+        sp.filters.add(f)
+        self.assertEqual(sp.get_filters_tags({"fee": "no"}), [("free", "Gratuit", "Fee")])
+        # The compiled filters are cached.
+        with self.assertNumQueries(0):
+            for i in range(10):
+                self.assertEqual(sp.get_filters_tags({"fee": "yes"}), [("paying", "Payant", "Fee")])
+        # A change of a filter changes the version of its presets.
+        f.processing_rules = "fee=yes == fee == Payant"
+        f.save()
+        sp.refresh_from_db()
+        self.assertEqual(sp.get_filters_tags({"fee": "yes"}), [("fee", "Payant", "Fee")])
+        sp.filters.remove(f)
+        self.assertEqual(sp.get_filters_tags({"fee": "yes"}), [])
+        # The presets of a filter whose links are cleared are changed too.
+        sp.filters.add(f)
+        sp.refresh_from_db()
+        version = sp.version
+        f.search_presets.clear()
+        sp.refresh_from_db()
+        self.assertEqual(sp.version, version + 1)
         return
 
 class SearchPresetTest(TestCase):
@@ -169,6 +1244,51 @@ class SearchPresetTest(TestCase):
             sp.processing_rules = '"fee" "Payant" ["yes":"Oui"|"no":"Non"'
             sp.full_clean()
         return
+    
+    def test_render_pr(self):
+        sp = SearchPreset(
+            name="Parking",
+            osm_keys='"amenity"="parking"',
+            processing_rules=(
+                '"surface" "Revêtement":'
+                '["asphalt":"Bitume"|"dirt":"Terre"|"*":"Autre"]\n'
+                'DISPLAY "Nom":"name"\n'
+                '"fee" "Payant":["yes":"Oui"|"no":"Non"]'
+            )
+        )
+        sp.save()
+        self.assertEqual(
+            sp.render_pr({"surface": "dirt;asphalt", "name": "P1", "fee": "maybe"}),
+            "Revêtement : Terre - Bitume\nNom : P1"
+        )
+        self.assertEqual(
+            sp.render_pr({"surface": "grass", "fee": "no"}),
+            "Revêtement : Autre\nPayant : Non"
+        )
+        # The display program is compiled once for each version.
+        with self.assertNumQueries(0), mock.patch("search.models.re") as re_mock:
+            sp.render_pr({"name": "P2"})
+            self.assertFalse(re_mock.match.called)
+        version = sp.version
+        sp.processing_rules = 'DISPLAY "Nom":"name"'
+        sp.save()
+        self.assertEqual(sp.version, version + 1)
+        self.assertEqual(sp.render_pr({"name": "P3", "fee": "no"}), "Nom : P3")
+        return
+    
+    def test_concurrent_versions(self):
+        sp = SearchPreset(name="Parking", osm_keys='"amenity"="parking"')
+        sp.save()
+        first = SearchPreset.objects.get(id=sp.id)
+        second = SearchPreset.objects.get(id=sp.id)
+        first.processing_rules = 'DISPLAY "Nom":"name"'
+        first.save()
+        # Saved from an instance loaded before the first save.
+        second.processing_rules = 'DISPLAY "Payant":"fee"'
+        second.save()
+        self.assertEqual(first.version, sp.version + 1)
+        self.assertEqual(second.version, sp.version + 2)
+        return
 
 class ViewsTest(TestCase):
     """
@@ -286,14 +1406,168 @@ class ViewsTest(TestCase):
                 test_result = result
         if not test_result:
             self.fail("Test result can not be found.")
-        self.assertIn("Distance : 11990937 mètres", test_result)
-        self.assertIn("Direction : 107,6° E →", test_result)
+        self.assertIn("Distance : 38 mètres", test_result)
+        self.assertIn("Direction : 129,8° SE ↘", test_result)
         self.assertIn('Téléphone : <a href="tel:+354 411 1111" itemprop="telephone">+354 411 1111</a><br/>', test_result)
         self.assertIn('<hr/>\n        <p>A great city hall!</p>\n        <hr/>', test_result)
         self.assertIn('Site web : <a href="example.com" itemprop="url">example.com</a>', test_result)
         self.assertIn("Adresse estimée : ", test_result)
+        self.assertEqual(json["total"], len(json["content"]))
+        self.assertIsNone(json["next_offset"])
+        return
+    
+    def test_paginated_search_ajax(self):
+        form_data = {
+            "user_latitude": "64.14624",
+            "user_longitude": "-21.94259",
+            "user_address": "",
+            "radius": "500",
+            "search_preset_id": self.search_preset_id,
+            "no_private": "true",
+            "limit": "1",
+        }
+        response = self.client.post(
+            '/getresults/', data=form_data, follow=True,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        json = response.json()
+        self.assertEqual(json["status"], "ok")
+        self.assertEqual(len(json["content"]), 1)
+        self.assertEqual(len(json["map_data"]), 1)
+        self.assertIn("Nom : City Hall of Reykjavik", json["content"][0])
+        self.assertEqual(json["filters"], '')
+        form_data["offset"] = str(json["total"])
+        response = self.client.post(
+            '/getresults/', data=form_data, follow=True,
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        json = response.json()
+        self.assertEqual(json["content"], [])
+        self.assertIsNone(json["next_offset"])
+        return
+    
+    def test_api_search(self):
+        form_data = {
+            "user_latitude": "64.14624",
+            "user_longitude": "-21.94259",
+            "radius": "500",
+            "search_preset_id": self.search_preset_id,
+            "no_private": "true"
+        }
+        response = self.client.get('/api/v1/results/', data=form_data)
+        self.assertEqual(response.status_code, 200)
+        json = response.json()
+        self.assertEqual(json["version"], 1)
+        self.assertEqual(json["status"], "ok")
+        self.assertEqual(json["total"], len(json["results"]))
+        self.assertIsNone(json["next_offset"])
+        results = [dict(zip(json["fields"], record)) for record in json["results"]]
+        labels = json["labels"]
+        test_result = None
+        for result in results:
+            if result["name"] == "City Hall of Reykjavik":
+                test_result = result
+        if not test_result:
+            self.fail("Test result can not be found.")
+        self.assertEqual(test_result["distance"], 38)
+        self.assertEqual(test_result["bearing"], 129.8)
+        self.assertEqual(
+            labels["directions"][int((test_result["bearing"] + 22.5) / 45) % 8], "SE ↘"
+        )
+        self.assertEqual(test_result["phone"], "+354 411 1111")
+        self.assertEqual(test_result["website"], "example.com")
+        self.assertIn("Adresse estimée : ", test_result["address"])
+        # The labels are shared by the results.
+        tags = [tag[0] for tag in labels["tags"]]
+        self.assertEqual(len(tags), len(set(tags)))
+        self.assertIn("unknown_schedules", [tags[i] for i in test_result["tags"]])
+        self.assertEqual(len(labels["strings"]), len(set(labels["strings"])))
+        # Smaller than the rendered results.
+        html_response = self.client.post(
+            '/getresults/', data=form_data, HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        self.assertLess(len(response.content), len(html_response.content))
+        return
+    
+    def test_api_invalid_radius(self):
+        form_data = {
+            "user_latitude": "64.14624",
+            "user_longitude": "-21.94259",
+            "radius": "200000",
+            "search_preset_id": self.search_preset_id,
+            "no_private": "true"
+        }
+        with mock.patch.object(utils, "fetch_elements") as fetch:
+            response = self.client.get('/api/v1/results/', data=form_data)
+        self.assertFalse(fetch.called)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["status"], "error")
+        self.assertIn("Invalid radius", response.json()["debug_msg"])
+        return
+    
+    def test_streamed_search_ajax(self):
+        form_data = {
+            "user_latitude": "64.14624",
+            "user_longitude": "-21.94259",
+            "radius": "500",
+            "search_preset_id": self.search_preset_id,
+            "no_private": "true"
+        }
+        response = self.client.get('/getresults/stream/', data=form_data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = []
+        for event in b''.join(response.streaming_content).decode().split("\n\n")[:-1]:
+            name, data = event.split("\n")
+            events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+        names = [name for name, data in events]
+        self.assertEqual(names[0], "results")
+        self.assertEqual(names[-2:], ["filters", "done"])
+        self.assertIn("addresses", names)
+        results = events[0][1]
+        records = [dict(zip(results["fields"], record)) for record in results["results"]]
+        test_result = [r for r in records if r["name"] == "City Hall of Reykjavik"][0]
+        # Sent before its address is found.
+        self.assertIsNone(test_result["address"])
+        addresses = {
+            (address[0], address[1]): address[2]
+            for name, data in events if name == "addresses"
+            for address in data["addresses"]
+        }
+        self.assertIn(
+            "Adresse estimée : ", addresses[(test_result["type"], test_result["id"])]
+        )
+        self.assertIn('id="filter_unknown_schedules"', events[-2][1]["filters"])
+        self.assertEqual(events[-1][1]["total"], len(records))
+        # The filter panel is not sent with a page of the results.
+        form_data["limit"] = "1"
+        response = self.client.get('/getresults/stream/', data=form_data)
+        body = b''.join(response.streaming_content).decode()
+        self.assertIn("event: done\n", body)
+        self.assertNotIn("event: filters\n", body)
+        # An invalid search is refused with a "failure" event.
+        form_data["radius"] = "200000"
+        with mock.patch.object(utils, "fetch_elements") as fetch:
+            response = self.client.get('/getresults/stream/', data=form_data)
+        self.assertFalse(fetch.called)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content.decode().startswith("event: failure\n"))
         return
 
+def read_streaming_response(response):
+    """
+        Returns a copy of a streamed response (see "light_home") with
+        its content read, so that it can be checked several times.
+    """
+    if not response.streaming:
+        return response
+    read_response = HttpResponse(
+        b''.join(response.streaming_content), status=response.status_code
+    )
+    for attribute in ("client", "request", "wsgi_request", "templates", "context"):
+        setattr(read_response, attribute, getattr(response, attribute))
+    return read_response
+
 class LightViewsTest(TestCase):
     """
         Tests the light search views.
@@ -321,7 +1595,9 @@ class LightViewsTest(TestCase):
         if not form.is_valid():
             self.fail("Validation of the form failed.")
         form.clean()
-        response = self.client.post('/light/', data=form_data, follow=True)
+        response = read_streaming_response(
+            self.client.post('/light/', data=form_data, follow=True)
+        )
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "base_light.html")
         self.assertContains(response, "Voici votre localisation ")
@@ -334,8 +1610,8 @@ class LightViewsTest(TestCase):
         self.assertContains(response, " dans un rayon de 500 mètres.")
         self.assertContains(response, "Exclusion des résultats à accès privé.")
         self.assertContains(response, "Nom : City Hall of Reykjavik")
-        self.assertContains(response, "Distance : 11990937 mètres")
-        self.assertContains(response, "Direction : 107,6° E →")
+        self.assertContains(response, "Distance : 38 mètres")
+        self.assertContains(response, "Direction : 129,8° SE ↘")
         self.assertContains(
             response, (
                 'Téléphone : <a href="tel:+354 411 1111" itemprop="telephone">'
@@ -356,11 +1632,86 @@ class LightViewsTest(TestCase):
         if not form.is_valid():
             self.fail("Validation of the form failed.")
         form.clean()
-        response = self.client.post('/light/', data=form_data, follow=True)
+        response = read_streaming_response(
+            self.client.post('/light/', data=form_data, follow=True)
+        )
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, "base_light.html")
         self.assertContains(response, "Inclusion des résultats à accès privé.")
         return
+    
+    def test_streamed_search(self):
+        get_data = {
+            "sp": self.search_preset_id,
+            "lat": "64.14624",
+            "lon": "-21.94259",
+            "radius": "500",
+            "no_private": "1"
+        }
+        with mock.patch.object(utils, "fetch_elements", wraps=utils.fetch_elements) as fetch, \
+                mock.patch.object(utils, "get_address", wraps=utils.get_address) as get_address:
+            response = self.client.get('/light/', get_data)
+            self.assertTrue(response.streaming)
+            parts = iter(response.streaming_content)
+            # The head is sent before the search and the address of the user.
+            head = next(parts).decode()
+            self.assertIn("Latitude : 64.14624", head)
+            self.assertIn('<span id="user_address">', head)
+            self.assertNotIn("City Hall of Reykjavik", head)
+            self.assertFalse(fetch.called)
+            self.assertFalse(get_address.called)
+            body = b''.join(parts).decode()
+        self.assertTrue(fetch.called)
+        self.assertIn('"user_address": ', body)
+        self.assertIn("Nom : City Hall of Reykjavik", body)
+        self.assertIn("Adresse estimée : ", body)
+        self.assertIn("</html>", body)
+        # The addresses not found in time are filled in at the end.
+        CachedAddress.objects.all().delete()
+        get_ban_addresses = utils.get_ban_addresses
+        def slow_ban_addresses(results):
+            time.sleep(0.3)
+            return get_ban_addresses(results)
+        with mock.patch.dict(settings.GOOSE_LIGHT, {"address_wait": 0.05}), \
+                mock.patch.object(utils, "get_ban_addresses", slow_ban_addresses):
+            body = b''.join(self.client.get('/light/', get_data).streaming_content).decode()
+        placeholder = body.index('_address">')
+        script = body.index("<script>")
+        self.assertLess(placeholder, script)
+        self.assertIn("Adresse estim\\u00e9e : ", body[script:])
+        return
+    
+    def test_streamed_gzip(self):
+        get_data = {
+            "sp": self.search_preset_id,
+            "lat": "64.14624",
+            "lon": "-21.94259",
+            "radius": "500",
+            "no_private": "1"
+        }
+        response = self.client.get('/light/', get_data, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        parts = iter(response.streaming_content)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # The compressed head can be read before the end of the stream.
+        head = b''
+        while b"Latitude : 64.14624" not in head:
+            head += decompressor.decompress(next(parts))
+        self.assertNotIn(b"City Hall of Reykjavik", head)
+        body = head + decompressor.decompress(b''.join(parts))
+        self.assertIn("Nom : City Hall of Reykjavik", body.decode())
+        return
+    
+    def test_streamed_gzip_encoded(self):
+        # A streamed response already compressed is not compressed again.
+        compressed = zlib.compress(b"Compressed content")
+        response = StreamingHttpResponse(iter([compressed]))
+        response["Content-Encoding"] = "gzip"
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING="gzip")
+        response = StreamingGZipMiddleware().process_response(request, response)
+        self.assertEqual(b''.join(response.streaming_content), compressed)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        return
 
 class OtherViewsTest(TestCase):
     """
@@ -378,6 +1729,21 @@ class OtherViewsTest(TestCase):
         self.assertTemplateUsed(response, "base_light.html")
         return
 
+class StatusViewTest(TestCase):
+    """
+        Tests the view exposing the internal statistics.
+    """
+    def test_status_access(self):
+        response = self.client.get('/status/')
+        self.assertEqual(response.status_code, 403)
+        User.objects.create_superuser("admin", "test@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        response = self.client.get('/status/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("overpass_tiles", response.json()["caches"])
+        self.assertIn("hit_rate", response.json()["caches"]["addresses"])
+        return
+
 class SearchFormTest(TestCase):
     """
         Tests the validation of the search form.
@@ -642,7 +2008,7 @@ class PermalinkTest(TestCase):
             "radius": "500",
             "no_private": "1"
         }
-        response = self.client.get('/light/', get_data)
+        response = read_streaming_response(self.client.get('/light/', get_data))
         self.assertEqual(response.status_code, 200)
         self.assertNotContains(response, '<em class="center">Erreur 500')
         self.assertNotContains(response, 'erreur')
@@ -664,7 +2030,7 @@ class PermalinkTest(TestCase):
             "radius": "500",
             "no_private": "0"
         }
-        response = self.client.get('/light/', get_data)
+        response = read_streaming_response(self.client.get('/light/', get_data))
         self.assertEqual(response.status_code, 200)
         self.assertNotContains(response, '<em class="center">Erreur 500')
         self.assertNotContains(response, 'erreur')
@@ -0,0 +1,201 @@
+#  Finds the timezone of a position with a precomputed grid, where most
+#  of the cells lie in one timezone. Only the positions in the other
+#  cells are looked up in the polygons of the timezones.
+
+import os
+import json
+import math
+import shutil
+import threading
+import logging
+import numpy as np
+from timezonefinder import TimezoneFinder
+from timezonefinder.timezonefinder import timezone_names
+from goose import settings
+from search import caching
+
+try:
+    from shapely.geometry import Polygon, box
+    from shapely.prepared import prep
+except ImportError:
+    # Only required to build the grid.
+    Polygon = None
+
+debug_logger = logging.getLogger("DEBUG")
+
+# The TimezoneFinder keeps its files open and seeks in them, so it
+# is created only when needed, and used by one thread at a time.
+_finder = None
+_finder_lock = threading.Lock()
+
+_grid = None
+_grid_lock = threading.Lock()
+
+# The value of the cells which do not lie in one timezone.
+MIXED = 0
+
+timezones_cache = caching.TTLCache(
+    "timezones",
+    settings.GOOSE_TIMEZONES["cache_max_size"],
+    settings.GOOSE_TIMEZONES["cache_ttl"]
+)
+
+def get_finder():
+    global _finder
+    if _finder is None:
+        debug_logger.debug("Loading the timezones polygons.")
+        _finder = TimezoneFinder()
+    return _finder
+
+def find_timezone(coords):
+    """
+        Returns the name of the timezone of the given coordinates (or
+        the closest one) from the polygons of the timezones, or 'UTC'.
+    """
+    with _finder_lock:
+        finder = get_finder()
+        timezone_name = finder.timezone_at(lat=coords[0], lng=coords[1])
+        if timezone_name is None:
+            timezone_name = finder.closest_timezone_at(lat=coords[0], lng=coords[1])
+    return timezone_name or 'UTC'
+
+class TimezoneGrid:
+    """
+        A grid of the timezones, built by 'build_grid'. Each cell holds
+        the id (plus one) of its timezone, or MIXED.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "names.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.cell_size = meta["cell_size"]
+        self.names = meta["names"]
+        # Shared between the workers by the page cache of the system.
+        self.cells = np.load(os.path.join(path, "cells.npy"), mmap_mode='r')
+        return
+    
+    def get_timezone_name(self, coords):
+        """
+            Returns the name of the timezone of the cell of the given
+            coordinates, or None if it is MIXED.
+        """
+        rows, columns = self.cells.shape
+        row = min(int(math.floor((coords[0] + 90) / self.cell_size)), rows - 1)
+        column = min(int(math.floor((coords[1] + 180) / self.cell_size)), columns - 1)
+        value = int(self.cells[row, column])
+        if value == MIXED:
+            return None
+        return self.names[value - 1]
+
+def get_grid():
+    """
+        Returns the grid of the process, loading it on the first call,
+        or None if it has not been built.
+    """
+    global _grid
+    if _grid is None:
+        with _grid_lock:
+            if _grid is None:
+                path = settings.GOOSE_TIMEZONES["grid_path"]
+                try:
+                    _grid = TimezoneGrid(path)
+                except (OSError, ValueError) as e:
+                    debug_logger.error(
+                        "Unable to load the timezones grid ({}).".format(str(e))
+                    )
+                    _grid = False
+    return _grid or None
+
+def get_cache_key(coords):
+    precision = settings.GOOSE_TIMEZONES["cache_precision"]
+    return (round(coords[0], precision), round(coords[1], precision))
+
+def get_timezone_name(coords):
+    """
+        Returns the name of the timezone of the given coordinates
+        (or the closest one), or 'UTC'.
+        
+        The positions in the MIXED cells of the grid are looked up in
+        the polygons, and their result is cached for the small cell
+        ('cache_precision') around them.
+    """
+    grid = get_grid()
+    if grid is not None:
+        timezone_name = grid.get_timezone_name(coords)
+        if timezone_name is not None:
+            return timezone_name
+    return timezones_cache.get_or_set(
+        get_cache_key(coords), lambda: find_timezone(coords)
+    )
+
+def get_polygon(finder, polygon_id, polygons):
+    # Returns a prepared Shapely polygon, built on the first call.
+    if polygon_id not in polygons:
+        exterior, *holes = finder.get_polygon(polygon_id, coords_as_pairs=True)
+        polygons[polygon_id] = prep(Polygon(exterior, holes))
+    return polygons[polygon_id]
+
+def get_cell_value(finder, polygon_ids, zone_ids, cell, polygons):
+    """
+        Returns the value of a cell (a shapely box) from the polygons
+        which may intersect it, as the TimezoneFinder would answer.
+    """
+    if len(polygon_ids) == 0:
+        # Requires the search of the closest timezone.
+        return MIXED
+    if len(set(zone_ids)) == 1:
+        return int(zone_ids[0]) + 1
+    for polygon_id, zone_id in zip(polygon_ids, zone_ids):
+        if get_polygon(finder, int(polygon_id), polygons).contains(cell):
+            return int(zone_id) + 1
+    return MIXED
+
+def build_grid(output, cell_size=None):
+    """
+        Builds the grid of the timezones and saves it in the 'output'
+        directory. Returns the proportion of MIXED cells.
+        Requires Shapely.
+        
+        A cell gets a timezone if all the polygons which may contain
+        it (from the "shortcuts" of TimezoneFinder) are in this
+        timezone, or if it lies entirely in one of them.
+    """
+    if Polygon is None:
+        raise ImportError("Shapely is required to build the timezones grid.")
+    cell_size = cell_size or settings.GOOSE_TIMEZONES["cell_size"]
+    # The cells must not overlap the shortcuts (1° of longitude, 0.5° of latitude).
+    if (1 / cell_size) % 1 or (0.5 / cell_size) % 1:
+        raise ValueError("The cell size must divide 0.5 degree.")
+    finder = TimezoneFinder()
+    rows, columns = int(round(180 / cell_size)), int(round(360 / cell_size))
+    cells = np.zeros((rows, columns), dtype=np.uint16)
+    polygons = {}
+    shortcuts = {}
+    for row in range(rows):
+        south = row * cell_size - 90
+        for column in range(columns):
+            west = column * cell_size - 180
+            shortcut = (
+                int(math.floor(west + cell_size / 2 + 180)),
+                int(math.floor((90 - south - cell_size / 2) * 2))
+            )
+            if shortcut not in shortcuts:
+                polygon_ids = finder.polygon_ids_of_shortcut(*shortcut)
+                shortcuts[shortcut] = (
+                    polygon_ids, finder.id_list(polygon_ids, len(polygon_ids))
+                )
+            polygon_ids, zone_ids = shortcuts[shortcut]
+            cells[row, column] = get_cell_value(
+                finder, polygon_ids, zone_ids,
+                box(west, south, west + cell_size, south + cell_size), polygons
+            )
+    # Written in a temporary directory, then moved, as the
+    # grid may be in use by running workers.
+    tmp = output.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "cells.npy"), cells)
+    with open(os.path.join(tmp, "names.json"), 'w', encoding="utf-8") as f:
+        json.dump({"cell_size": cell_size, "names": timezone_names}, f)
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp, output)
+    return float(np.mean(cells == MIXED))
@@ -0,0 +1,432 @@
+#  Tools to call the upstream services (Overpass, the BAN API and
+#  Nominatim) in a resilient way.
+
+import time
+import random
+import threading
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import overpass
+from goose import settings
+from search import overpass_client
+
+debug_logger = logging.getLogger("DEBUG")
+
+# All the circuit breakers of the process, by name.
+breakers = OrderedDict()
+
+# All the rate limiters of the process, by service.
+buckets = OrderedDict()
+
+class CircuitOpenError(Exception):
+    """
+        Raised instead of calling a service considered as down.
+    """
+    pass
+
+class RateLimitError(CircuitOpenError):
+    """
+        Raised instead of calling a service when its rate limit would
+        not allow it before the maximum waiting time.
+    """
+    pass
+
+class OverpassUnavailableError(CircuitOpenError, overpass.OverpassError):
+    """
+        Raised when the circuits of all the Overpass endpoints are open.
+    """
+    pass
+
+class CircuitBreaker:
+    """
+        Stops calling a service after too many consecutive failures.
+        
+        After 'failure_threshold' consecutive failures, the circuit is
+        "open": the calls fail fast during 'reset_timeout' seconds.
+        Then, it is "half-open": one trial call is allowed, which
+        closes the circuit if it succeeds, or opens it again.
+    """
+    def __init__(self, name, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.successes = 0
+        self.rejected = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        breakers[name] = self
+        return
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+    
+    def allow(self):
+        """
+            Returns True if the service can be called.
+        """
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self._trial_running = False
+        return
+    
+    def cancel_trial(self):
+        """
+            Called when an allowed call was not made after all (see
+            'call_with_retries'), so that the next one can be the trial.
+        """
+        with self._lock:
+            self._trial_running = False
+        return
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if (self._trial_running or
+                    self.consecutive_failures >= self.failure_threshold):
+                if self.opened_at is None or self._trial_running:
+                    debug_logger.error(
+                        "Circuit '{}' opened after {} failure(s).".format(
+                            self.name, self.consecutive_failures
+                        )
+                    )
+                self.opened_at = self.clock()
+            self._trial_running = False
+        return
+    
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failures": self.failures,
+            "successes": self.successes,
+            "rejected": self.rejected,
+        }
+
+def get_breaker(service, name=None):
+    """
+        Returns the circuit breaker of the given name (by default,
+        the name of the service), creating it with the settings of
+        the service if needed.
+    """
+    name = name or service
+    if name not in breakers:
+        CircuitBreaker(
+            name,
+            failure_threshold=settings.GOOSE_UPSTREAM[service]["failure_threshold"],
+            reset_timeout=settings.GOOSE_UPSTREAM[service]["reset_timeout"]
+        )
+    return breakers[name]
+
+class TokenBucket:
+    """
+        Limits the rate of the requests sent to a service by all the
+        threads of the process.
+        
+        The bucket holds at most 'capacity' tokens, and is refilled with
+        'rate' tokens per second. Each request takes a token, waiting
+        for it if the bucket is empty. The tokens are reserved in the
+        order of the calls, so the waiting requests are spread over time.
+    """
+    def __init__(self, name, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated_at = clock()
+        self.acquired = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        buckets[name] = self
+        return
+    
+    def acquire(self, timeout=None):
+        """
+            Takes a token, waiting at most 'timeout' seconds for it.
+            Returns False (without waiting) if it can not be taken in time.
+        """
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            delay = max(0, (1 - self.tokens) / self.rate)
+            if timeout is not None and delay > timeout:
+                self.rejected += 1
+                return False
+            # May become negative: the token is taken in advance.
+            self.tokens -= 1
+            self.acquired += 1
+        if delay > 0:
+            self.sleep(delay)
+        return True
+    
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "acquired": self.acquired,
+            "rejected": self.rejected,
+        }
+
+def get_bucket(service):
+    """
+        Returns the rate limiter of the given service, creating it
+        with the settings of the service if needed.
+    """
+    if service not in buckets:
+        TokenBucket(
+            service,
+            rate=settings.GOOSE_UPSTREAM[service]["rate"],
+            capacity=settings.GOOSE_UPSTREAM[service]["burst"]
+        )
+    return buckets[service]
+
+def rate_limited(service, func):
+    """
+        Returns a function calling 'func' when the rate limit of the
+        service allows it, or raising RateLimitError if it does not
+        allow it before 'max_wait' seconds.
+    """
+    def call(*args, **kwargs):
+        if not get_bucket(service).acquire(settings.GOOSE_UPSTREAM[service]["max_wait"]):
+            raise RateLimitError(
+                "The rate limit of the service '{}' is reached.".format(service)
+            )
+        return func(*args, **kwargs)
+    return call
+
+def get_buckets_stats():
+    return {name: bucket.stats() for name, bucket in buckets.items()}
+
+def get_timeout(service):
+    return settings.GOOSE_UPSTREAM[service]["timeout"]
+
+def backoff_delay(attempt):
+    """
+        Returns the delay to wait before the given retry (starting
+        at 0): an exponential backoff with "full jitter".
+    """
+    return random.uniform(0, min(
+        settings.GOOSE_UPSTREAM["backoff_max"],
+        settings.GOOSE_UPSTREAM["backoff_base"] * 2 ** attempt
+    ))
+
+def call_with_retries(breaker, errors, func, *args, **kwargs):
+    """
+        Calls the given function, retrying with an exponential backoff
+        when it raises one of the given errors.
+        
+        If a circuit breaker is given, the failures are recorded in it
+        (including the other errors, which are not retried), and
+        CircuitOpenError is raised while it is open.
+    """
+    attempts = settings.GOOSE_META["max_geolocation_attempts"]
+    for attempt in range(attempts):
+        if breaker is not None and not breaker.allow():
+            raise CircuitOpenError(
+                "The service '{}' is considered as down.".format(breaker.name)
+            )
+        try:
+            result = func(*args, **kwargs)
+        except CircuitOpenError:
+            # Raised by the rate limiter, before calling the service.
+            if breaker is not None:
+                breaker.cancel_trial()
+            raise
+        except errors as e:
+            if breaker is not None:
+                breaker.record_failure()
+            if attempt == attempts - 1:
+                raise e
+            delay = backoff_delay(attempt)
+            debug_logger.debug(
+                "Error: {}. Retrying in {:.2f}s.".format(str(e), delay)
+            )
+            time.sleep(delay)
+            continue
+        except Exception:
+            # Not retried, but still a failure of the call.
+            if breaker is not None:
+                breaker.record_failure()
+            raise
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+def get_breakers_stats():
+    return {name: breaker.stats() for name, breaker in breakers.items()}
+
+class EndpointStats:
+    """
+        Keeps the latencies of the last successful requests sent
+        to an endpoint.
+    """
+    def __init__(self, url, window=50, default_latency=1.0):
+        self.url = url
+        self.breaker = get_breaker("overpass", "overpass ({})".format(url))
+        self.default_latency = default_latency
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        return
+    
+    def record(self, latency, success):
+        # Only the latencies of the valid answers are kept, as an
+        # endpoint failing fast must not be requested first.
+        with self._lock:
+            if success:
+                self.latencies.append(latency)
+                self.successes += 1
+            else:
+                self.failures += 1
+        return
+    
+    def percentile(self, percent):
+        """
+            Returns the given percentile of the recent latencies
+            (or the default latency if there is no sample yet).
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return self.default_latency
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+        return latencies[index]
+    
+    def stats(self):
+        return {
+            "median_latency": round(self.percentile(50), 3),
+            "p90_latency": round(self.percentile(90), 3),
+            "successes": self.successes,
+            "failures": self.failures,
+        }
+
+class HedgedOverpass:
+    """
+        Sends the Overpass requests to several mirrors.
+        
+        A request is first sent to the endpoint with the lowest median
+        latency. If it did not answer after the 'hedge_percentile'
+        of its recent latencies, the same request is sent to the next
+        endpoint, and so on. The first valid answer wins. An endpoint
+        which fails is immediately replaced by the next one.
+        
+        Each endpoint has its own circuit breaker, and the endpoints
+        whose circuit is open are skipped.
+    """
+    def __init__(self, endpoints, timeout, hedge_percentile=90,
+            min_hedge_delay=0.5, default_latency=2.0):
+        self.endpoints = [
+            EndpointStats(url, default_latency=default_latency)
+            for url in endpoints
+        ]
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        # The losing requests keep running until they end, so that
+        # their latency is still recorded.
+        self.executor = ThreadPoolExecutor(max_workers=4 * len(endpoints))
+        return
+    
+    def send(self, endpoint, query):
+        """
+            Sends the query to one endpoint, and returns the list
+            of the GeoJSON features of the returned elements.
+        """
+        return list(overpass_client.get_features(endpoint.url, query, self.timeout))
+    
+    def _timed_send(self, endpoint, query):
+        start = time.monotonic()
+        try:
+            features = self.send(endpoint, query)
+        except Exception:
+            endpoint.record(time.monotonic() - start, success=False)
+            endpoint.breaker.record_failure()
+            raise
+        endpoint.record(time.monotonic() - start, success=True)
+        endpoint.breaker.record_success()
+        return features
+    
+    def get(self, query):
+        """
+            Returns the list of the features returned by the fastest
+            endpoint, or raises the last error if all of them failed.
+        """
+        endpoints = sorted(self.endpoints, key=lambda e: e.percentile(50))
+        pending = {}
+        error = None
+        
+        def launch():
+            while not endpoints[0].breaker.allow():
+                endpoints.pop(0)
+                if not endpoints:
+                    raise OverpassUnavailableError(
+                        "The circuits of all the Overpass endpoints are open."
+                    )
+            endpoint = endpoints.pop(0)
+            debug_logger.debug("Sending the request to '{}'.".format(endpoint.url))
+            pending[self.executor.submit(self._timed_send, endpoint, query)] = endpoint
+            return endpoint
+        
+        hedge_delay = max(
+            launch().percentile(self.hedge_percentile), self.min_hedge_delay
+        )
+        while pending:
+            done, not_done = wait(
+                pending, timeout=hedge_delay if endpoints else None,
+                return_when=FIRST_COMPLETED
+            )
+            if not done:
+                debug_logger.debug("No answer after {:.2f}s, hedging.".format(hedge_delay))
+                try:
+                    launch()
+                except OverpassUnavailableError:
+                    pass
+                continue
+            for future in done:
+                endpoint = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    debug_logger.error(
+                        "Overpass - Endpoint '{}' failed ({}).".format(
+                            endpoint.url, str(e)
+                        )
+                    )
+                    error = e
+            if not pending and endpoints:
+                try:
+                    launch()
+                except OverpassUnavailableError:
+                    pass
+        raise error
+    
+    def stats(self):
+        return {endpoint.url: endpoint.stats() for endpoint in self.endpoints}
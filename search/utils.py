@@ -2,22 +2,37 @@ import geopy
 from geopy import distance
 import pytz
 import humanized_opening_hours
-from math import sin, cos, atan2, degrees
+from math import sin, cos, atan2, degrees, radians
 from goose import settings
 import overpass
 from collections import namedtuple, Counter, OrderedDict
 import requests
 import io
+import csv
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
-from uuid import uuid4
 from django.utils.html import escape
 from django.template.loader import render_to_string
 from goose import settings
 from search import test_mockers
+from search import caching
+from search import address_cache
+from search import geometry
+from search import timezones
+from search import local_engine
+from search import local_geocoder
+from search import upstream
+from search import http_client
+from search import overpass_client
 from django.utils.translation import ugettext as _
 from django.utils.translation import get_language
+from django.utils import translation
 
-geolocator = geopy.geocoders.Nominatim(timeout=10)
+geolocator = http_client.PooledNominatim(
+    timeout=upstream.get_timeout("nominatim"),
+    user_agent=settings.GOOSE_HTTP["user_agent"]
+)
 debug_logger = logging.getLogger("DEBUG")
 
 def try_geolocator_reverse(coords):
@@ -27,20 +42,16 @@ def try_geolocator_reverse(coords):
     """
     if settings.TESTING:
         return test_mockers.geolocator_object(coords=coords)
-    attempts = 0
-    while attempts < settings.GOOSE_META["max_geolocation_attempts"]:
-        try:
-            position = geolocator.reverse(
-                coords, language=get_language().split('-')[0]
-            )
-            return position
-        except geopy.exc.GeopyError as e:
-            attempts += 1
-            if attempts == settings.GOOSE_META["max_geolocation_attempts"]:
-                debug_logger.error(
-                    "Too much geopy errors ({}). Aborting.".format(str(e))
-                )
-                return None
+    try:
+        return upstream.call_with_retries(
+            upstream.get_breaker("nominatim"), (geopy.exc.GeopyError,),
+            upstream.rate_limited("nominatim", geolocator.reverse), coords, language=get_language().split('-')[0]
+        )
+    except (geopy.exc.GeopyError, upstream.CircuitOpenError) as e:
+        debug_logger.error(
+            "Too much geopy errors ({}). Aborting.".format(str(e))
+        )
+        return None
 
 def try_geolocator_geocode(address):
     """
@@ -49,27 +60,46 @@ def try_geolocator_geocode(address):
     """
     if settings.TESTING:
         return test_mockers.geolocator_object(address=address)
-    attempts = 0
-    while attempts < settings.GOOSE_META["max_geolocation_attempts"]:
-        try:
-            position = geolocator.geocode(
-                address, language=get_language().split('-')[0]
-            )
-            return position
-        except geopy.exc.GeopyError as e:
-            attempts += 1
-            if attempts == settings.GOOSE_META["max_geolocation_attempts"]:
-                debug_logger.error(
-                    "Too much geopy errors ({}). Aborting.".format(str(e))
-                )
-                return None
+    try:
+        return upstream.call_with_retries(
+            upstream.get_breaker("nominatim"), (geopy.exc.GeopyError,),
+            upstream.rate_limited("nominatim", geolocator.geocode), address, language=get_language().split('-')[0]
+        )
+    except (geopy.exc.GeopyError, upstream.CircuitOpenError) as e:
+        debug_logger.error(
+            "Too much geopy errors ({}). Aborting.".format(str(e))
+        )
+        return None
 
-def get_address(coords=None, address=None, skip_gov_api=False, mocking_parameters=None):
+def request_gov_api(url, params):
+    """
+        Requests the french government's address API and returns
+        the "features" of its response, or None in case of error.
+    """
+    def send():
+        r = http_client.session.get(url, params=params, timeout=upstream.get_timeout("ban"))
+        r.raise_for_status()
+        return r.json()
+    try:
+        return upstream.call_with_retries(
+            upstream.get_breaker("ban"), (requests.RequestException, ValueError),
+            send
+        ).get("features")
+    except (requests.RequestException, ValueError, upstream.CircuitOpenError) as e:
+        debug_logger.error("Error of the BAN API ({}).".format(str(e)))
+        return None
+
+def get_address(coords=None, address=None, skip_gov_api=False, mocking_parameters=None, use_cache=True):
     """
         Returns a tuple from a tuple of coordinates or an adress (str).
         
-        Will first try to use the french government's API, then the
-        Overpass one, except if skip_gov_api is set to True.
+        Will first try to use the french government's API (or the local
+        geocoder, if enabled), then the Overpass one, except if
+        skip_gov_api is set to True.
+        
+        The addresses of coordinates are cached in memory (see
+        'address_cache.get_position'), except if use_cache is set
+        to False.
         
         Returned tuple : ((lat (float), lon (float)), address (str))
     """
@@ -77,23 +107,34 @@ def get_address(coords=None, address=None, skip_gov_api=False, mocking_parameter
         return None
     if (not coords and not address) or (coords and address):
         raise ValueError("One (and only one) of the two params must be given.")
+    if coords and not skip_gov_api and local_geocoder.is_enabled():
+        position = local_geocoder.reverse(coords)
+        if position is not None:
+            return position
+    if coords and use_cache:
+        source = "nominatim" if skip_gov_api else "reverse"
+        cached = address_cache.get_position(source, coords)
+        if cached is not caching.MISSING:
+            return cached
+        position = get_address(coords=coords, skip_gov_api=skip_gov_api, use_cache=False)
+        if position is not None:
+            address_cache.set_position(source, coords, position)
+        return position
     result = None
     if skip_gov_api is False:
         if settings.TESTING:
             result = test_mockers.gouv_api_address(coords, address)
         elif coords:
             lat, lon = coords[0], coords[1]
-            r = requests.get(
+            result = request_gov_api(
                 "https://api-adresse.data.gouv.fr/reverse",
                 params={'lat': lat, 'lon': lon}
-            ).json()
-            result = r.get("features")
+            )
         else:
-            r = requests.get(
+            result = request_gov_api(
                 "https://api-adresse.data.gouv.fr/search",
                 params={'q': address}
-            ).json()
-            result = r.get("features")
+            )
     result_is_valid = False
     if result:
         result_lat, result_lon = (
@@ -129,22 +170,24 @@ def get_bearing(coords1, coords2):
     """
         Returns the direction to go from one set of coordinates to another.
     """
-    lat1, lon1 = coords1[0], coords1[1]
-    lat2, lon2 = coords2[0], coords2[1]
+    lat1, lon1 = radians(coords1[0]), radians(coords1[1])
+    lat2, lon2 = radians(coords2[0]), radians(coords2[1])
     bearing = atan2(sin(lon2-lon1)*cos(lat2),
         cos(lat1)*sin(lat2)-sin(lat1)*cos(lat2)*cos(lon2-lon1))
     bearing = degrees(bearing)
     bearing = (bearing + 360) % 360
     return round(bearing, 1)
 
+# The cardinal directions, from the north, every 45 degrees.
+DIRECTIONS = ["N ↑", "NE ↗", "E →", "SE ↘", "S ↓", "SO ↙", "O ←", "NO ↖"]
+
 def deg2dir(deg):
     """
         Returns a cardinal direction from a direction (in degrees).
         https://gist.github.com/RobertSudwarts/acf8df23a16afdb5837f
     """
-    dirs = ["N ↑", "NE ↗", "E →", "SE ↘", "S ↓", "SO ↙", "O ←", "NO ↖"]
     ix = int((deg + 22.5)/45)
-    return dirs[ix % 8]
+    return DIRECTIONS[ix % 8]
 
 def get_permalink(request, use_get_params, search_preset_id, user_latitude, user_longitude, radius, no_private):
     permalink = request.build_absolute_uri()
@@ -158,6 +201,245 @@ def get_permalink(request, use_get_params, search_preset_id, user_latitude, user
         )
     return permalink
 
+def build_tiles_query(osm_key, tiles):
+    """
+        Returns an Overpass query requesting the nodes, the ways and
+        the relations matching one OSM key ('"key"="value"') in the
+        given tiles.
+        
+        Only the tags and the center of the elements are requested,
+        not their full geometry.
+    """
+    tile_size = settings.GOOSE_CACHE["tile_size"]
+    request = '[out:json][timeout:{timeout}][maxsize:{maxsize}];('.format(
+        timeout=settings.GOOSE_OVERPASS["timeout"],
+        maxsize=settings.GOOSE_OVERPASS["maxsize"]
+    )
+    for tile in tiles:
+        south, west, north, east = geometry.tile_bbox(tile, tile_size)
+        request += (
+            'node[{osm_key}]({s},{w},{n},{e});'
+            'way[{osm_key}]({s},{w},{n},{e});'
+            'relation[{osm_key}]({s},{w},{n},{e});'
+        ).format(osm_key=osm_key, s=south, w=west, n=north, e=east)
+    request += ');out tags center qt;'
+    return request
+
+overpass_endpoints = upstream.HedgedOverpass(
+    settings.GOOSE_OVERPASS["endpoints"],
+    timeout=upstream.get_timeout("overpass"),
+    hedge_percentile=settings.GOOSE_OVERPASS["hedge_percentile"],
+    min_hedge_delay=settings.GOOSE_OVERPASS["min_hedge_delay"]
+)
+
+def request_overpass(request):
+    """
+        Sends a request to Overpass and returns the list of the
+        GeoJSON features of the elements it returned.
+    """
+    debug_logger.debug("Requesting '{}'".format(request))
+    if settings.TESTING:
+        return [
+            overpass_client.element_to_feature(element)
+            for element in test_mockers.overpass_elements()
+        ]
+    try:
+        features = upstream.call_with_retries(
+            None, (overpass.OverpassError,), overpass_endpoints.get, request
+        )
+    except overpass.OverpassError as e:
+        debug_logger.debug(
+            "Error: {}. Raising of 500 error.".format(str(e))
+        )
+        raise e
+    debug_logger.debug("Request successfull.")
+    return features
+
+overpass_flight = caching.SingleFlight(
+    "overpass_requests",
+    lock_dir=settings.GOOSE_CACHE["single_flight_dir"],
+    result_ttl=settings.GOOSE_CACHE["single_flight_ttl"]
+)
+
+def fetch_overpass(request):
+    """
+        Sends a request to Overpass and returns the list of
+        GeoJSON features it returned.
+        
+        The concurrent identical requests are sent only once.
+    """
+    return overpass_flight.do(request, lambda: request_overpass(request))
+
+def get_element_meta(element):
+    """
+        Returns the OSM type and ID of a GeoJSON feature.
+    """
+    if "osm_type" in element:
+        return (element["osm_type"], element["id"])
+    elif element["geometry"]["type"] == "Point":
+        return ("node", element["id"])
+    else:  # Should be "LineString".
+        return ("way", element["id"])
+
+def get_element_coordinates(element):
+    """
+        Returns the coordinates (lat, lon) of a GeoJSON feature
+        (its center for the ways and relations returned by Overpass,
+        a representative point for the other ways).
+    """
+    if element["geometry"]["type"] == "Point":
+        lon, lat = element["geometry"]["coordinates"]
+        return (lat, lon)
+    return geometry.representative_point(element["geometry"]["coordinates"])
+
+def fetch_tiles(osm_key, tiles):
+    """
+        Requests the elements matching one OSM key in the given tiles.
+        
+        Returns a dict of the form {tile: [element, ...]}. Each element
+        is stored in the tile containing its coordinates.
+    """
+    tile_size = settings.GOOSE_CACHE["tile_size"]
+    tiles_content = {tile: [] for tile in tiles}
+    for element in fetch_overpass(build_tiles_query(osm_key, tiles)):
+        tile = geometry.tile_of(get_element_coordinates(element), tile_size)
+        if tile in tiles_content:
+            tiles_content[tile].append(element)
+    return tiles_content
+
+tiles_cache = caching.TTLCache(
+    "overpass_tiles",
+    max_size=settings.GOOSE_CACHE["tiles_max_size"],
+    ttl=settings.GOOSE_CACHE["tiles_ttl"],
+    stale_ttl=settings.GOOSE_CACHE["tiles_stale_ttl"]
+)
+
+def get_elements(osm_keys, coords, radius):
+    """
+        Returns the list of the GeoJSON features matching the given
+        OSM keys in all the tiles intersecting the search circle.
+        
+        The tiles are cached for each line of the OSM keys, and only
+        the missing ones are requested to Overpass (in one request
+        per line). The stale tiles of a line are also refreshed in one
+        request, in the background.
+    """
+    tile_size = settings.GOOSE_CACHE["tile_size"]
+    tiles = geometry.tiles_around(coords, radius, tile_size)
+    elements = OrderedDict()
+    for osm_key in osm_keys.splitlines():
+        missing_tiles = []
+        stale_keys = []
+        for tile in tiles:
+            content, stale = tiles_cache.get_entry((osm_key, tile))
+            if content is caching.MISSING:
+                missing_tiles.append(tile)
+                continue
+            if stale:
+                stale_keys.append((osm_key, tile))
+            for element in content:
+                elements[get_element_meta(element)] = element
+        if stale_keys:
+            tiles_cache.refresh(stale_keys, lambda keys, osm_key=osm_key: {
+                (osm_key, tile): content for tile, content in fetch_tiles(
+                    osm_key, [tile for key, tile in keys]
+                ).items()
+            })
+        debug_logger.debug(
+            "Key '{}': {} tile(s) cached, {} tile(s) to request.".format(
+                osm_key, len(tiles) - len(missing_tiles), len(missing_tiles)
+            )
+        )
+        if not missing_tiles:
+            continue
+        for tile, content in fetch_tiles(osm_key, missing_tiles).items():
+            tiles_cache.set((osm_key, tile), content)
+            for element in content:
+                elements[get_element_meta(element)] = element
+    return list(elements.values())
+
+def fetch_elements(search_preset, user_coords, radius):
+    """
+        Returns the list of the GeoJSON features matching the OSM keys of
+        the search preset in the tiles around the user, from Overpass or
+        from the local index (depending on the GOOSE_SEARCH_BACKEND setting).
+        
+        Overpass is used while the local index is not built.
+    """
+    if settings.GOOSE_SEARCH_BACKEND == "local":
+        index = local_engine.get_index()
+        if index is not None:
+            return index.get_elements(search_preset.osm_keys, user_coords, radius)
+    return get_elements(search_preset.osm_keys, user_coords, radius)
+
+def get_distance(coords1, coords2):
+    """
+        Returns the distance (in meters, rounded) between two coordinates.
+    """
+    return round(distance.vincenty(coords1, coords2).m)
+
+ResultsPage = namedtuple("ResultsPage", ["results", "total", "next_offset"])
+
+def select_nearest(elements, user_coords, radius, no_private, offset=0, limit=None):
+    """
+        Returns the list of the records (distance, (osm_type, osm_id),
+        element, bearing) of the requested page of the elements in the
+        radius, sorted by distance, and the total number of these elements.
+        
+        The distances and bearings of all the elements are computed at
+        once (see the GOOSE_GEOMETRY setting). Only the 'offset + limit'
+        nearest records are selected and sorted (with a bounded heap),
+        the others are left unsorted.
+    """
+    elements = [
+        element for element in elements
+        if not (no_private and element["properties"].get("access") in ["private", "no"])
+    ]
+    if not elements:
+        return [], 0
+    distances, bearings = geometry.distances_and_bearings(
+        user_coords, [get_element_coordinates(element) for element in elements],
+        settings.GOOSE_GEOMETRY["distance_model"]
+    )
+    distances = distances.round()
+    records = [
+        (int(distances[i]), get_element_meta(elements[i]), elements[i], round(float(bearings[i]), 1))
+        for i in (distances <= radius).nonzero()[0]
+    ]
+    key = lambda record: record[:2]
+    if limit is None:
+        selected = sorted(records, key=key)
+    else:
+        selected = heapq.nsmallest(offset + limit, records, key=key)
+    return selected[offset:], len(records)
+
+def build_results(elements, search_preset, user_coords, radius, no_private,
+        timezone_name, offset=0, limit=None):
+    """
+        Returns a ResultsPage with the Result objects of the requested
+        page of the GeoJSON features (all of them by default), cut to
+        the requested radius and sorted by distance.
+        
+        Only the results of the page are built.
+    """
+    records, total = select_nearest(
+        elements, user_coords, radius, no_private, offset, limit
+    )
+    results = []
+    for element_distance, osm_meta, element, bearing in records:
+        # The "uuid" is stable, so that the concurrent identical searches
+        # send identical requests to the address API.
+        results.append(Result(
+            "{}_{}".format(*osm_meta), element,
+            search_preset, user_coords, timezone_name,
+            element_distance, bearing
+        ))
+    next_offset = offset + len(results)
+    if next_offset >= total:
+        next_offset = None
+    debug_logger.debug("Got {} result(s) out of {}.".format(len(results), total))
+    return ResultsPage(results, total, next_offset)
+
 def get_results(search_preset, user_coords, radius, no_private, timezone_name):
     """
         Returns a list of dicts with the properties of all results.
@@ -165,44 +447,18 @@ def get_results(search_preset, user_coords, radius, no_private, timezone_name):
     debug_logger.debug(
         "Getting results. SearchPreset: {}.".format(search_preset.id)
     )
-    api = overpass.API()
-    response = []
-    results = []
-    request = '('
-    for line in search_preset.osm_keys.splitlines():
-        # Requests both nodes and ways.
-        request += (
-            'node[{osm_key}](around:{r},{lat},{lon});'
-            'way[{osm_key}](around:{r},{lat},{lon});'
-        ).format(
-            osm_key=line, r=radius,
-            lat=user_coords[0], lon=user_coords[1]
-        )
-    request += ');'
-    attempts = 0
-    debug_logger.debug("Requesting '{}'".format(line))
-    while attempts < settings.GOOSE_META["max_geolocation_attempts"]:
-        if settings.TESTING:
-            response = test_mockers.geojsons()
-            break
-        try:
-            response += api.Get(request)['features']
-            debug_logger.debug("Request successfull.")
-            break
-        except overpass.OverpassError as e:
-            attempts += 1
-            if attempts == settings.GOOSE_META["max_geolocation_attempts"]:
-                debug_logger.debug(
-                    "Error: {}. Raising of 500 error.".format(str(e))
-                )
-                raise e
-    for element in response:
-        if no_private and element["properties"].get("access") in ["private", "no"]:
-            continue
-        results.append(Result(str(uuid4()), element, search_preset, user_coords, timezone_name))
-    results = sorted(results, key=lambda result: result.distance)
-    debug_logger.debug("Got {} result(s).".format(len(results)))
-    return results
+    radius = int(radius)
+    elements = fetch_elements(search_preset, user_coords, radius)
+    return build_results(
+        elements, search_preset, user_coords, radius, no_private, timezone_name
+    ).results
+
+def get_timezone_name(coords):
+    """
+        Returns the name of the timezone of the given coordinates
+        (or the closest one), or 'UTC'.
+    """
+    return timezones.get_timezone_name(coords)
 
 def render_filter_panel(results):
     """
@@ -236,10 +492,109 @@ def render_filter_panel(results):
     )
     return html
 
-def parse_csv_data(result, csv_line, address_data):
+def request_fallback_address(result):
     """
-        Parses a line of the CSV obtained by
-        the function 'get_all_addresses'.
+        Returns the address of a result obtained with Nominatim,
+        or None. Does not use the cache, and so can be called
+        outside of the thread of the request.
+    """
+    address = get_address(
+        coords=(result.coordinates[0], result.coordinates[1]),
+        skip_gov_api=True, use_cache=False
+    )
+    if not address or not address[1]:
+        return None
+    return address[1]
+
+def format_fallback_address(label):
+    if not label:
+        return ''
+    return _("Adresse estimée : {}").format(label)
+
+def get_cached_fallback_addresses(results):
+    """
+        Fills the cached Nominatim addresses of the given results,
+        and returns the list of the results which are not cached.
+    """
+    keys = [address_cache.result_key("nominatim", result) for result in results]
+    cached = address_cache.get_many(keys)
+    uncached = []
+    for key, result in zip(keys, results):
+        if key in cached:
+            result.string_address = format_fallback_address(cached[key])
+        else:
+            uncached.append(result)
+    return uncached
+
+def store_fallback_addresses(results, labels):
+    """
+        Caches the Nominatim addresses (or None) of the given results.
+        The failures are not cached, as they may be temporary.
+    """
+    address_cache.set_many({
+        address_cache.result_key("nominatim", result): label
+        for result, label in zip(results, labels) if label
+    })
+    return
+
+def get_fallback_address(result):
+    """
+        Returns the address of a result obtained with Nominatim, for the
+        results whose address is not given by the government's API.
+    """
+    key = address_cache.result_key("nominatim", result)
+    label = address_cache.get(key)
+    if label is caching.MISSING:
+        label = request_fallback_address(result)
+        store_fallback_addresses([result], [label])
+    return format_fallback_address(label)
+
+# Runs the Nominatim requests of the searches not run by the pipeline.
+fallback_executor = ThreadPoolExecutor(
+    max_workers=settings.GOOSE_PIPELINE["nominatim_parallelism"]
+)
+
+def get_fallback_addresses(results):
+    """
+        Fills the addresses of the given results with Nominatim, for the
+        results whose address is not given by the government's API.
+        
+        The requests are sent in parallel. The addresses not obtained
+        after the 'nominatim_deadline' are left empty.
+    """
+    results = get_cached_fallback_addresses(results)
+    if not results:
+        return
+    language = get_language()
+    
+    def request(result):
+        with translation.override(language):
+            return request_fallback_address(result)
+    
+    futures = [fallback_executor.submit(request, result) for result in results]
+    done, not_done = wait(futures, timeout=settings.GOOSE_PIPELINE["nominatim_deadline"])
+    for future in not_done:
+        future.cancel()
+    if not_done:
+        debug_logger.error(
+            "{} address(es) not obtained from Nominatim in time.".format(len(not_done))
+        )
+    labels = [
+        future.result() if future in done else None for future in futures
+    ]
+    for result, label in zip(results, labels):
+        result.string_address = format_fallback_address(label)
+    store_fallback_addresses(results, labels)
+    return
+
+def parse_csv_data(result, csv_line, address_data, fallback=True):
+    """
+        Returns the address of a result from the 'address_data' of
+        a line of the CSV obtained by the function 'get_all_addresses'
+        ('csv_line' is only used in the logs).
+        
+        If the address is incomplete, gets it with Nominatim, or returns
+        None if 'fallback' is False.
     """
     # Checks address_data contains at least one information,
     # and / including the street name.
@@ -278,129 +633,358 @@ def parse_csv_data(result, csv_line, address_data):
                 result.osm_meta[1]
             )
         )
-        address = get_address(
-            coords=(result.coordinates[0], result.coordinates[1]),
-            skip_gov_api=True
-        )[1]
-        if not address:
-            return ''
-        address = _("Adresse estimée : {}").format(address)
+        if not fallback:
+            return None
+        address = get_fallback_address(result)
     return address
 
-def get_all_addresses(results):
+ban_flight = caching.SingleFlight(
+    "ban_requests",
+    lock_dir=settings.GOOSE_CACHE["single_flight_dir"],
+    result_ttl=settings.GOOSE_CACHE["single_flight_ttl"]
+)
+
+ban_executor = ThreadPoolExecutor(
+    max_workers=settings.GOOSE_UPSTREAM["ban"]["parallel_batches"]
+)
+
+def parse_ban_csv(lines):
     """
-        Fills the addresses of the given results (list).
-        
-        Tries first with the french government's API, then with the
-        Overpass one for the addresses which couldn't be obtained.
+        Returns a dict of the form {uuid: address_data} from the lines
+        of a CSV returned by the BAN API, where 'address_data' is the
+        list [housenumber, street, postcode, city].
+    """
+    addresses = {}
+    for row in csv.DictReader(lines):
+        addresses[row["uuid"]] = [
+            row.get("result_housenumber") or '',
+            row.get("result_name") or '',
+            row.get("result_postcode") or '',
+            row.get("result_city") or ''
+        ]
+    return addresses
+
+def request_ban_addresses(csv_data):
+    """
+        Sends a CSV of coordinates to the BAN API and returns the
+        addresses it found (see 'parse_ban_csv').
         
-        API doc : https://adresse.data.gouv.fr/api
+        The response is parsed while it is received. The concurrent
+        identical requests are sent only once.
     """
-    # Creates a CSV to request the API.
-    debug_logger.debug("Getting addresses of results.")
-    debug_logger.debug(results)
-    csv = "latitude,longitude,uuid\n"
-    for result in results:
-        if result.default_address is '':
-            csv += str(result.coordinates[0]) + ',' + str(result.coordinates[1]) + ',' + result.uuid + '\n'
-    debug_logger.debug("CSV created.")
-    debug_logger.debug("Content:\n" + csv)
     if settings.TESTING:
-        csv_returned = test_mockers.gouv_api_csv(csv)
+        csv_returned = test_mockers.gouv_api_csv(csv_data)
         debug_logger.debug("Mocker returned CSV.")
-        debug_logger.debug('\n' + csv_returned)
-        csv_returned = csv_returned.splitlines()
-    else:
-        fake_file = io.StringIO(csv)
-        files = {'file': fake_file}
-        r = requests.post(
+        return parse_ban_csv(csv_returned.splitlines())
+    def send():
+        r = http_client.session.post(
             "https://api-adresse.data.gouv.fr/reverse/csv/",
-            files={'data': fake_file}
+            files={'data': io.StringIO(csv_data)},
+            timeout=upstream.get_timeout("ban"),
+            stream=True
         )
         debug_logger.debug(
             "Request sent. API returned {} status code. URL: {}".format(
                 r.status_code, r.url
             )
         )
-        debug_logger.debug('\n' + r.text)
-        csv_returned = r.text.splitlines()[1:]
-    for csv_line in csv_returned:
-        parsed_line = csv_line.split(',')
-        current_uuid = parsed_line[2]
-        for result in results:
-            if str(result.uuid) != str(current_uuid):
-                continue
-            address_data = [
-                parsed_line[9],
-                parsed_line[10],
-                parsed_line[12],
-                parsed_line[13]
-            ]
-            result.string_address = parse_csv_data(result, csv_line, address_data)
-    debug_logger.debug("Address getting finished successfully.")
+        with r:
+            r.raise_for_status()
+            r.encoding = 'utf-8'
+            return parse_ban_csv(r.iter_lines(decode_unicode=True))
+    return ban_flight.do(csv_data, lambda: upstream.call_with_retries(
+        upstream.get_breaker("ban"), (requests.RequestException,), send
+    ))
+
+def get_ban_addresses(results):
+    """
+        Returns the addresses found by the BAN API for the given
+        results (see 'parse_ban_csv').
+        
+        The large result sets are split in batches, sent in parallel.
+        The results of a failed batch are left without address.
+    """
+    batch_size = settings.GOOSE_UPSTREAM["ban"]["batch_size"]
+    batches = []
+    for i in range(0, len(results), batch_size):
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow(["latitude", "longitude", "uuid"])
+        for result in results[i:i+batch_size]:
+            writer.writerow([result.coordinates[0], result.coordinates[1], result.uuid])
+        batches.append(output.getvalue())
+    debug_logger.debug("{} CSV batch(es) created.".format(len(batches)))
+    
+    def request(batch):
+        try:
+            return request_ban_addresses(batch)
+        except (requests.RequestException, upstream.CircuitOpenError) as e:
+            # The addresses are left empty, rather than failing the search.
+            debug_logger.error("Error of the BAN API ({}).".format(str(e)))
+            return {}
+    
+    # The first batch is sent from the current thread.
+    futures = [ban_executor.submit(request, batch) for batch in batches[1:]]
+    # Not updated in place, as it may be shared with concurrent searches.
+    addresses = dict(request(batches[0]))
+    for future in futures:
+        addresses.update(future.result())
+    return addresses
+
+def get_addressless_results(results):
+    """
+        Returns an OrderedDict of the given results which have no
+        address yet, indexed by their (stable) uuid.
+    """
+    return OrderedDict(
+        (result.uuid, result) for result in results
+        if result.default_address is ''
+    )
+
+def get_cached_addresses(results):
+    """
+        Returns the BAN addresses cached for the given results, as
+        a dict of the form {uuid: address_data}, and the list of the
+        results which are not cached.
+        
+        If the local geocoder is enabled, all the addresses are
+        obtained from its index, which is faster than the cache.
+    """
+    if local_geocoder.is_enabled():
+        return local_geocoder.get_addresses(results), []
+    keys = [address_cache.result_key("ban", result) for result in results]
+    cached = address_cache.get_many(keys)
+    addresses = {}
+    uncached = []
+    for key, result in zip(keys, results):
+        if key in cached:
+            addresses[result.uuid] = cached[key]
+        else:
+            uncached.append(result)
+    return addresses, uncached
+
+def store_addresses(results, addresses):
+    """
+        Caches the BAN addresses obtained for the given results,
+        including the empty ones, so that the places outside of France
+        are not sent again to the API.
+    """
+    address_cache.set_many({
+        address_cache.result_key("ban", result): addresses[result.uuid]
+        for result in results if result.uuid in addresses
+    })
     return
 
+def merge_addresses(results_index, addresses, fallback=True):
+    """
+        Fills the addresses of the results of 'results_index' (see
+        'get_addressless_results') from a dict of the form
+        {uuid: address_data}.
+        
+        If 'fallback' is False, returns the list of the results whose
+        address is incomplete instead of getting it with Nominatim.
+    """
+    missing = []
+    for uuid, result in results_index.items():
+        address_data = addresses.get(uuid)
+        if address_data is None:
+            continue
+        address = parse_csv_data(result, uuid, address_data, fallback)
+        if address is None:
+            missing.append(result)
+        else:
+            result.string_address = address
+    return missing
+
+def get_all_addresses(results, fallback=True):
+    """
+        Fills the addresses of the given results (list).
+        
+        Tries first with the cache and the french government's API,
+        then with the Overpass one for the addresses which couldn't be
+        obtained (see 'get_fallback_addresses'). If 'fallback' is False,
+        returns the list of these results instead of getting their address.
+        
+        API doc : https://adresse.data.gouv.fr/api
+    """
+    debug_logger.debug("Getting addresses of results.")
+    results_index = get_addressless_results(results)
+    if not results_index:
+        return []
+    addresses, uncached = get_cached_addresses(list(results_index.values()))
+    if uncached:
+        fetched = get_ban_addresses(uncached)
+        store_addresses(uncached, fetched)
+        addresses.update(fetched)
+    missing = merge_addresses(results_index, addresses, False)
+    if fallback and missing:
+        get_fallback_addresses(missing)
+        missing = []
+    debug_logger.debug("Address getting finished successfully.")
+    return missing
+
+def get_hoh_language():
+    """
+        Returns the language in which the opening hours are rendered
+        (the current one if HOH supports it, else English).
+    """
+    lang = get_language().split('-')[0]
+    if lang not in ["fr", "en"]:
+        lang = "en"
+    return lang
+
+opening_hours_cache = caching.TTLCache(
+    "opening_hours",
+    max_size=settings.GOOSE_CACHE["opening_hours_max_size"],
+    ttl=settings.GOOSE_CACHE["opening_hours_ttl"]
+)
+
+week_schedules_cache = caching.TTLCache(
+    "week_schedules",
+    max_size=settings.GOOSE_CACHE["opening_hours_max_size"],
+    ttl=settings.GOOSE_CACHE["opening_hours_ttl"]
+)
+
+def parse_opening_hours(oh_field, timezone_name, lang, osm_id=None):
+    """
+        Returns a HumanizedOpeningHours object from an "opening_hours"
+        field, or None if it can not be parsed.
+        
+        The objects are shared by all the results with the same field,
+        timezone and language (they are not modified after their
+        creation). The failures are cached too, so that an invalid
+        field is only parsed (and logged) once.
+    """
+    key = (oh_field, timezone_name, lang)
+    opening_hours = opening_hours_cache.get(key)
+    if opening_hours is not caching.MISSING:
+        return opening_hours
+    try:
+        opening_hours = humanized_opening_hours.HumanizedOpeningHours(
+            oh_field, lang, tz=pytz.timezone(timezone_name)
+        )
+    except humanized_opening_hours.HOHError:
+        # TODO : Warn user ?
+        debug_logger.error(
+            "Opening hours - HOHError ; OSM_ID: '{id}' ; opening_hours: '{oh}'".format(
+                id=osm_id,
+                oh=oh_field
+            )
+        )
+        opening_hours = None
+    except Exception as e:
+        # TODO : Warn user ?
+        debug_logger.error(
+            "Opening hours - Error ; Exception: '{exception}' ; OSM_ID: '{id}' ; opening_hours: '{oh}'".format(
+                exception=str(e),
+                id=osm_id,
+                oh=oh_field
+            )
+        )
+        opening_hours = None
+    opening_hours_cache.set(key, opening_hours)
+    return opening_hours
+
+def get_week_schedules(oh_field, timezone_name, lang):
+    """
+        Returns the human-readable week schedules of an "opening_hours"
+        field (cached), or '' if it can not be parsed.
+    """
+    def stringify():
+        opening_hours = parse_opening_hours(oh_field, timezone_name, lang)
+        if opening_hours is None:
+            return ''
+        return opening_hours.stringify_week_schedules()
+    return week_schedules_cache.get_or_set((oh_field, timezone_name, lang), stringify)
+
+# Value of the lazy attributes of a Result which are not computed yet.
+NOT_COMPUTED = object()
+
 class Result:
     """
         A result and its properties.
+        
+        The opening hours, the tags and the default address are
+        only computed when they are accessed for the first time.
     """
-    def __init__(self, uuid, geojson, search_preset, user_coordinates, timezone_name):
+    __slots__ = (
+        "uuid", "osm_meta", "coordinates", "user_coords", "search_preset",
+        "timezone_name", "properties", "string_address", "distance", "bearing",
+        "_default_address", "_opening_hours", "_tags"
+    )
+    
+    def __init__(self, uuid, geojson, search_preset, user_coordinates, timezone_name,
+            distance=None, bearing=None):
         self.uuid = uuid
-        if geojson['geometry']['type'] == "Point":
-            self.osm_meta = ("node", geojson["id"])
-            self.coordinates = (
-                geojson["geometry"]["coordinates"][1],
-                geojson["geometry"]["coordinates"][0]
-            )
-        else:  # Should be "LineString".
-            self.osm_meta = ("way", geojson["id"])
-            self.coordinates = (
-                geojson["geometry"]["coordinates"][0][1],
-                geojson["geometry"]["coordinates"][0][0]
-            )
+        self.osm_meta = get_element_meta(geojson)
+        self.coordinates = get_element_coordinates(geojson)
         self.user_coords = user_coordinates
         self.search_preset = search_preset
+        self.timezone_name = timezone_name
+        # Not copied, as it is shared with the cached elements.
         self.properties = geojson["properties"]
-        self.default_address = self.get_default_address()
         self.string_address = ''
-        self.distance = round(distance.vincenty(
-            (user_coordinates[0], user_coordinates[1]), self.coordinates
-        ).m)
-        self.bearing = get_bearing(user_coordinates, self.coordinates)
-        self.direction = deg2dir(self.bearing)
-        oh_field = self.properties.get("opening_hours")
-        self.opening_hours = None
-        lang = get_language().split('-')[0]
-        if lang not in ["fr", "en"]:
-            lang = "en"
-        if oh_field:
-            try:
-                self.opening_hours = humanized_opening_hours.HumanizedOpeningHours(
-                    oh_field, lang, tz=pytz.timezone(timezone_name)
-                )
-            except humanized_opening_hours.HOHError:
-                # TODO : Warn user ?
-                debug_logger.error(
-                    "Opening hours - HOHError ; OSM_ID: '{id}' ; opening_hours: '{oh}'".format(
-                        id=self.osm_meta[1],
-                        oh=oh_field
-                    )
-                )
-                self.opening_hours = None
-            except Exception as e:
-                # TODO : Warn user ?
-                debug_logger.error(
-                    "Opening hours - Error ; Exception: '{exception}' ; OSM_ID: '{id}' ; opening_hours: '{oh}'".format(
-                        exception=str(e),
-                        id=self.osm_meta[1],
-                        oh=oh_field
-                    )
-                )
-                self.opening_hours = None
-        self.tags = self.get_tags()
-        self.renderable_tags = [t[0] for t in self.tags]
+        # The distance and the bearing are usually computed
+        # for all the results at once (see 'select_nearest').
+        if distance is None:
+            distance = get_distance(user_coordinates, self.coordinates)
+        if bearing is None:
+            bearing = get_bearing(user_coordinates, self.coordinates)
+        self.distance = distance
+        self.bearing = bearing
+        self._default_address = NOT_COMPUTED
+        self._opening_hours = NOT_COMPUTED
+        self._tags = NOT_COMPUTED
         return
     
+    @property
+    def direction(self):
+        return deg2dir(self.bearing)
+    
+    @property
+    def default_address(self):
+        if self._default_address is NOT_COMPUTED:
+            self._default_address = self.get_default_address()
+        return self._default_address
+    
+    @property
+    def opening_hours(self):
+        if self._opening_hours is NOT_COMPUTED:
+            self._opening_hours = self.get_opening_hours()
+        return self._opening_hours
+    
+    @property
+    def tags(self):
+        if self._tags is NOT_COMPUTED:
+            self._tags = self.get_tags()
+        return self._tags
+    
+    @property
+    def renderable_tags(self):
+        return [t[0] for t in self.tags]
+    
+    def get_opening_hours(self):
+        """
+            Returns a HumanizedOpeningHours object from the
+            "opening_hours" tag of the result, or None.
+        """
+        oh_field = self.properties.get("opening_hours")
+        if not oh_field:
+            return None
+        return parse_opening_hours(
+            oh_field, self.timezone_name, get_hoh_language(), self.osm_meta[1]
+        )
+    
+    def get_week_schedules(self):
+        """
+            Returns the human-readable week schedules of the
+            result, or '' if its opening hours are unknown.
+        """
+        oh_field = self.properties.get("opening_hours")
+        if not oh_field:
+            return ''
+        return get_week_schedules(oh_field, self.timezone_name, get_hoh_language())
+    
     def get_address(self):
         if self.default_address:
             return self.default_address
@@ -445,10 +1029,7 @@ class Result:
         tags = []
         
         # Specific tags.
-        for filter in self.search_preset.filters.all():
-            tag = filter.parse_result(self)
-            if tag:
-                tags.append(tag)
+        tags.extend(self.search_preset.get_filters_tags(self.properties))
         
         # Universal tags.
         # Uses three letters to order filters.
@@ -528,7 +1109,7 @@ class Result:
         
         try:
             if opening_hours and self.opening_hours is not None:
-                opening_hours_text = self.opening_hours.stringify_week_schedules()
+                opening_hours_text = self.get_week_schedules()
                 if oh_in_popover:
                     oh_string = _("Horaires d'ouverture")
                     oh_content = (
@@ -2,23 +2,30 @@ from django.shortcuts import render
 from django.shortcuts import redirect
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.http import StreamingHttpResponse
 from django.template.loader import render_to_string
-from django.utils.html import escape
+from django.utils.html import escape, format_html
 from django.utils.translation import ugettext as _
+from django.utils import translation
 from search.models import SearchPreset
 from search.forms import SearchForm
 from ratelimit.decorators import ratelimit
 from goose import settings
 from search import utils
-from timezonefinder import TimezoneFinder
+from search import caching
+from search import upstream
+from search import http_client
+from search import pipeline
+from search import fragments
+from search import api
 from search.templatetags import geo_extras
 import geopy
 import overpass
+import asyncio
 import logging
 import json
 
 debug_logger = logging.getLogger("DEBUG")
-tf = TimezoneFinder()
 
 def home(request):
     """
@@ -157,7 +164,9 @@ def results(request):
         "use_get_params": use_get_params,
         "error_msg": error_msg,
         "permalink": permalink,
-        "search_description": search_description
+        "search_description": search_description,
+        "client_rendering": settings.GOOSE_API["client_rendering"],
+        "server_sent_events": settings.GOOSE_API["server_sent_events"]
         }
     )
 
@@ -182,81 +191,89 @@ def handle_500_get_results(view):
             )
     return wrapper
 
-@csrf_exempt
-@handle_500_get_results
-def get_results(request):
+def get_search_params(params):
     """
-        Used by Ajax to get the results.
+        Returns the parameters of a search from the data of a request
+        (see "get_results"), as a tuple (search_preset_id, search_preset,
+        radius, user_latitude, user_longitude, no_private, offset, limit).
+        
+        Raises ValueError if they are invalid.
     """
-    if not request.is_ajax():
-        return HttpResponseForbidden("This URL if for Ajax only.")
-    debug_logger.debug("----- A new request is coming! -----")
-    search_preset_id = request.POST["search_preset_id"]
+    search_preset_id = params["search_preset_id"]
     search_preset = SearchPreset.objects.get(id=search_preset_id)
-    radius = request.POST["radius"]
-    user_latitude = float(request.POST["user_latitude"])
-    user_longitude = float(request.POST["user_longitude"])
-    no_private = request.POST["no_private"]
+    radius = int(params["radius"])
+    radius_extreme_values = settings.GOOSE_META["radius_extreme_values"]
+    if radius % 10 != 0 or not (
+        radius_extreme_values[0] <= radius <= radius_extreme_values[1]
+    ):
+        raise ValueError("Invalid radius: {}.".format(radius))
+    user_latitude = float(params["user_latitude"])
+    user_longitude = float(params["user_longitude"])
+    no_private = params["no_private"]
     if no_private == "true":
         no_private = True
     else:
         no_private = False
-    rendered_results = []
-    status = "error"
-    fail_msg = ''
-    err_msg = ''
-    debug_msg = ''
-    filter_panel = ''
-    results = []
+    # Pagination (optional, the first page contains all the results
+    # by default).
+    offset = max(int(params.get("offset", 0)), 0)
+    limit = params.get("limit")
+    if limit is not None:
+        limit = min(max(int(limit), 1), settings.GOOSE_META["max_page_size"])
+    return (
+        search_preset_id, search_preset, radius, user_latitude, user_longitude,
+        no_private, offset, limit
+    )
+
+def read_search_request(request, params):
+    """
+        Returns a tuple (error, search_params), with the parameters of
+        the search (see "get_search_params"), or the error to send, a
+        tuple (err_msg, debug_msg, status), if the request was rate
+        limited or if its parameters are invalid.
+    """
+    if getattr(request, 'limited', False):
+        return (_(
+            "Trop de requêtes ont été faites en trop peu de temps. "
+            "Merci d'attendre quelques secondes avant de raffraichir la page."
+        ), "Rate limited.", 429), None
     try:
-        timezone_name = tf.timezone_at(lat=user_latitude, lng=user_longitude)
-        if timezone_name is None:
-            timezone_name = tf.closest_timezone_at(lat=user_latitude, lng=user_longitude)
-        if timezone_name is None:
-            timezone_name = 'UTC'
-        results = utils.get_results(
-            search_preset, (user_latitude, user_longitude), radius,
-            no_private, timezone_name
-        )
-        utils.get_all_addresses(results)
-        for result in results:
-            result_block = render_to_string(
-                "search/result_block.part.html",
-                {
-                    "result": result, "render_tags": True,
-                    "oh_in_popover": True, "light": False
-                }
-            )
-            rendered_results.append('<li>' + result_block + '</li>')
-        if results:
-            filter_panel = utils.render_filter_panel(results)
-        status = "ok"
-        debug_logger.debug("Request successfull!")
-        if not results:
-            fail_msg = '<em class="center">' + _("Pas de résultats.") + '</em>'
-    except geopy.exc.GeopyError as e:
+        return None, get_search_params(params)
+    except ValueError as e:
+        return (
+            _("Les paramètres de la recherche sont invalides."), str(e), 400
+        ), None
+
+def get_search_error(e):
+    """
+        Returns the messages (err_msg, debug_msg) of an error which
+        occurred during a search.
+    """
+    if isinstance(e, geopy.exc.GeopyError):
         err_msg = _(
             "Une erreur s'est produite lors de l'acquisition "
             "de vos coordonnées. Vous pouvez essayer de recharger "
             "la page dans quelques instants."
         )
-        debug_msg = str(e)
         debug_logger.debug("Geopy error: {}".format(str(e)))
-    except overpass.OverpassError as e:
+    elif isinstance(e, overpass.OverpassError):
         err_msg = _(
             "Une erreur s'est produite lors de la requête vers "
             "les serveurs d'OpenStreetMap. Vous pouvez essayer "
             "de recharger la page dans quelques instants."
         )
-        debug_msg = str(e)
         debug_logger.debug("Overpass error: {}".format(str(e)))
-    except Exception as e:
+    else:
         err_msg = _("Une erreur non prise en charge s'est produite.")
-        debug_msg = str(e)
         debug_logger.debug("Unhandled error: {}".format(str(e)))
-    # Logs the request to make statistics.
-    # Doesn't logs if the request comes from an authenticated user,
-    # as it is probably an admin.
+    return err_msg, str(e)
+
+def log_search(request, search_preset_id, radius, user_latitude, user_longitude):
+    """
+        Logs a search to make statistics.
+        Doesn't logs if the request comes from an authenticated user,
+        as it is probably an admin.
+    """
     if not request.user.is_authenticated():
         logger = logging.getLogger("statistics")
         logger.info(
@@ -268,23 +285,217 @@ def get_results(request):
                 lon=round(user_longitude)
             )
         )
+    return
+
+@csrf_exempt
+@handle_500_get_results
+def get_results(request):
+    """
+        Used by Ajax to get the results.
+    """
+    if not request.is_ajax():
+        return HttpResponseForbidden("This URL if for Ajax only.")
+    debug_logger.debug("----- A new request is coming! -----")
+    (
+        search_preset_id, search_preset, radius, user_latitude, user_longitude,
+        no_private, offset, limit
+    ) = get_search_params(request.POST)
+    rendered_results = []
+    status = "error"
+    fail_msg = ''
+    err_msg = ''
+    debug_msg = ''
+    filter_panel = ''
+    results = []
+    total = 0
+    next_offset = None
+    try:
+        results, total, next_offset = pipeline.run(pipeline.search(
+            search_preset, (user_latitude, user_longitude), radius,
+            no_private, offset, limit
+        ))
+        for result in results:
+            result_block = fragments.render_result_block(
+                result, render_tags=True, oh_in_popover=True, light=False
+            )
+            rendered_results.append('<li>' + result_block + '</li>')
+        # The counts of a page would not be those of the search, so the
+        # panel is only sent with all the results.
+        if results and limit is None:
+            filter_panel = utils.render_filter_panel(results)
+        status = "ok"
+        debug_logger.debug("Request successfull!")
+        if not results:
+            fail_msg = '<em class="center">' + _("Pas de résultats.") + '</em>'
+    except Exception as e:
+        err_msg, debug_msg = get_search_error(e)
+    log_search(request, search_preset_id, radius, user_latitude, user_longitude)
     map_data = []
     for result in results:
-        result_str = render_to_string(
-            "search/marker_popup.part.html",
-            {"result": result}
-        )
+        result_str = fragments.render_marker_popup(result)
         marker_id = geo_extras.render_anchor(result, "map")
         map_data.append((result.osm_meta, result.coordinates, result_str, marker_id))
     return HttpResponse(json.dumps({
             "status": status, "content": rendered_results,
             "filters": filter_panel, "map_data": map_data,
             "err_msg": err_msg, "debug_msg": debug_msg,
-            "fail_msg": fail_msg
+            "fail_msg": fail_msg, "total": total, "next_offset": next_offset
         }),
         content_type="application/json"
     )
 
+@csrf_exempt
+@ratelimit(key='ip', rate="3/m")
+@handle_500_get_results
+def api_results(request):
+    """
+        Returns the results of a search as structured records (see
+        "search.api"), rendered by the client. Takes the parameters
+        of "get_results", by GET or POST.
+    """
+    params = request.POST if request.method == "POST" else request.GET
+    error, search_params = read_search_request(request, params)
+    if error is not None:
+        err_msg, debug_msg, status = error
+        return JsonResponse({
+            "version": api.VERSION, "status": "error",
+            "err_msg": err_msg, "debug_msg": debug_msg
+        }, status=status)
+    (
+        search_preset_id, search_preset, radius, user_latitude, user_longitude,
+        no_private, offset, limit
+    ) = search_params
+    try:
+        results, total, next_offset = pipeline.run(pipeline.search(
+            search_preset, (user_latitude, user_longitude), radius,
+            no_private, offset, limit
+        ))
+        data = api.serialize_results(
+            results, (user_latitude, user_longitude), total, next_offset
+        )
+    except Exception as e:
+        err_msg, debug_msg = get_search_error(e)
+        data = {
+            "version": api.VERSION, "status": "error",
+            "err_msg": err_msg, "debug_msg": debug_msg
+        }
+    log_search(request, search_preset_id, radius, user_latitude, user_longitude)
+    return JsonResponse(data, json_dumps_params={"separators": (',', ':')})
+
+def format_event(name, data):
+    """
+        Returns a Server-Sent Event, with JSON data.
+    """
+    return "event: {}\ndata: {}\n\n".format(
+        name, json.dumps(data, separators=(',', ':'))
+    )
+
+def stream_results(search_preset, user_coords, radius, no_private, offset, limit,
+        language):
+    """
+        Yields the Server-Sent Events of a search (see "get_results_stream").
+        Runs after the view returned, so 'language' (the language of
+        the request) is set again.
+    """
+    loop = asyncio.new_event_loop()
+    found = []
+    
+    def on_found(results):
+        # Sends the addresses found at once.
+        found.extend(results)
+        loop.stop()
+    
+    try:
+        with translation.override(language):
+            try:
+                page = loop.run_until_complete(pipeline.search(
+                    search_preset, user_coords, radius, no_private,
+                    offset, limit, addresses=False
+                ))
+                debug_logger.debug("Request successfull!")
+            except Exception as e:
+                err_msg, debug_msg = get_search_error(e)
+                yield format_event(
+                    "failure", {"err_msg": err_msg, "debug_msg": debug_msg}
+                )
+                return
+            results = page.results
+            yield format_event("results", api.serialize_results(
+                results, user_coords, page.total, page.next_offset,
+                pending_addresses=True
+            ))
+            pending = [result for result in results if not result.default_address]
+            if pending:
+                task = loop.create_task(pipeline.get_all_addresses(results, on_found))
+                task.add_done_callback(lambda task: loop.stop())
+                sent = set()
+                while not task.done():
+                    loop.run_forever()
+                    if found:
+                        yield format_event("addresses", api.serialize_addresses(found))
+                        sent.update(found)
+                        del found[:]
+                if task.exception() is not None:
+                    debug_logger.error(
+                        "Unable to get the addresses ({}).".format(str(task.exception()))
+                    )
+                # The addresses not found before the deadline.
+                late = [result for result in pending if result not in sent]
+                if late:
+                    yield format_event("addresses", api.serialize_addresses(late))
+            # Only with all the results (see "get_results").
+            if limit is None:
+                yield format_event(
+                    "filters", {"filters": utils.render_filter_panel(results)}
+                )
+            yield format_event(
+                "done", {"total": page.total, "next_offset": page.next_offset}
+            )
+    finally:
+        # The client may have closed the connection.
+        pipeline.close_loop(loop)
+    return
+
+@csrf_exempt
+@ratelimit(key='ip', rate="3/m")
+@handle_500_get_results
+def get_results_stream(request):
+    """
+        Sends the results of a search as Server-Sent Events, as soon as
+        they are known. Takes the parameters of "get_results", by GET
+        (for EventSource).
+        
+        The events are "results" (the structured results of
+        "api_results", without the addresses not found yet),
+        "addresses" (as they are found), "filters" (the filter panel,
+        not sent with a limit) and "done", or "failure" if the search
+        failed (or if it was refused).
+    """
+    error, search_params = read_search_request(request, request.GET)
+    if error is not None:
+        err_msg, debug_msg, status = error
+        # Sent as an event (with the status 200), as EventSource ignores the body of the errors.
+        return HttpResponse(
+            format_event("failure", {"err_msg": err_msg, "debug_msg": debug_msg}),
+            content_type="text/event-stream"
+        )
+    (
+        search_preset_id, search_preset, radius, user_latitude, user_longitude,
+        no_private, offset, limit
+    ) = search_params
+    log_search(request, search_preset_id, radius, user_latitude, user_longitude)
+    response = StreamingHttpResponse(
+        stream_results(
+            search_preset, (user_latitude, user_longitude), radius, no_private,
+            offset, limit, translation.get_language()
+        ),
+        content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # Disables the buffering of the reverse proxy (Nginx).
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 @csrf_exempt
 def get_map(request):
     """
@@ -301,6 +512,168 @@ def get_map(request):
         content_type="application/json"
     )
 
+# Replaced by the results in the streamed light pages.
+RESULTS_MARKER = fragments.MARKER.format("results")
+BLOCKS_MARKER = fragments.MARKER.format("blocks")
+
+# Fills the addresses found after their placeholder was sent.
+LATE_ADDRESSES_SCRIPT = """\
+<script>
+    (function (addresses) {{
+        for (var id in addresses) {{
+            var element = document.getElementById(id);
+            if (element) {{
+                element.innerHTML = addresses[id];
+            }}
+        }}
+    }})({});
+</script>
+"""
+
+def render_late_addresses(addresses):
+    """
+        Returns the script filling the placeholders of the given
+        addresses, of the form {id: address (HTML)}.
+    """
+    return LATE_ADDRESSES_SCRIPT.format(json.dumps(addresses).replace("</", "<\\/"))
+
+def get_user_address_html(task):
+    """
+        Returns the address of the user (escaped) from the task of
+        'pipeline.get_address', which must be done.
+    """
+    if task.exception() is not None:
+        debug_logger.error(
+            "Unable to get the address of the user ({}).".format(str(task.exception()))
+        )
+        return _("Adresse inconnue")
+    position = task.result()
+    if not position:
+        return _("Adresse inconnue")
+    return escape(position[1])
+
+def render_light_blocks(results, done):
+    """
+        Returns the blocks of the given results for the light version,
+        and the results whose address is not found yet ('done' is
+        False), rendered with a placeholder.
+    """
+    blocks = []
+    late_results = []
+    for result in results:
+        address = None
+        if not done and not (result.default_address or result.string_address):
+            late_results.append(result)
+            address = '<span id="{}">{}</span>'.format(
+                geo_extras.render_anchor(result, "address"),
+                _("Recherche de l'adresse…")
+            )
+        blocks.append(fragments.render_result_block(
+            result, render_tags=False, oh_in_popover=False, light=True,
+            address=address
+        ))
+    return ''.join(blocks), late_results
+
+def stream_light_results(head, tail, search_preset, user_coords, radius, no_private,
+        language, find_user_address=False, mocking_parameters=None):
+    """
+        Yields the parts of a page of results of the light version:
+        its head, sent before the search, then the blocks of the
+        results, by chunks, and finally its tail.
+        
+        The addresses of a chunk are awaited for 'address_wait'
+        seconds. The blocks whose address is not found yet are sent
+        with a placeholder, filled in by a script at the end.
+        
+        If 'find_user_address' is True, the address of the user is
+        looked up during the search, and filled in the same way.
+        
+        Runs after the view returned, so 'language' (the language of
+        the request) is set again.
+    """
+    yield head
+    loop = asyncio.new_event_loop()
+    user_address_task = None
+    
+    def user_address_script(wait=False):
+        # The script filling the address of the user, once it is found.
+        nonlocal user_address_task
+        if user_address_task is None:
+            return ''
+        if wait:
+            loop.run_until_complete(asyncio.wait([user_address_task]))
+        if not user_address_task.done():
+            return ''
+        script = render_late_addresses(
+            {"user_address": get_user_address_html(user_address_task)}
+        )
+        user_address_task = None
+        return script
+    
+    try:
+        with translation.override(language):
+            if find_user_address:
+                user_address_task = loop.create_task(
+                    pipeline.get_address(user_coords, mocking_parameters)
+                )
+            try:
+                results = loop.run_until_complete(pipeline.search(
+                    search_preset, user_coords, radius, no_private, addresses=False
+                )).results
+                debug_logger.debug("Request successfull!")
+            except Exception as e:
+                error_msg, debug_msg = get_search_error(e)
+                yield render_to_string(
+                    "search/light_results_list.part.html", {"error_msg": error_msg}
+                ) + user_address_script(wait=True)
+                yield tail
+                return
+            if not results:
+                yield render_to_string(
+                    "search/light_results_list.part.html"
+                ) + user_address_script(wait=True)
+                yield tail
+                return
+            list_head, list_tail = render_to_string(
+                "search/light_results_list.part.html",
+                {"results": results, "blocks_marker": BLOCKS_MARKER}
+            ).split(BLOCKS_MARKER)
+            yield user_address_script() + list_head
+            chunk_size = settings.GOOSE_LIGHT["chunk_size"]
+            chunks = [
+                results[i:i + chunk_size] for i in range(0, len(results), chunk_size)
+            ]
+            # The addresses of all the chunks are searched at once.
+            tasks = [
+                loop.create_task(pipeline.get_all_addresses(chunk))
+                for chunk in chunks
+            ]
+            late_results = []
+            for chunk, task in zip(chunks, tasks):
+                loop.run_until_complete(asyncio.wait(
+                    [task], timeout=settings.GOOSE_LIGHT["address_wait"]
+                ))
+                blocks, late = render_light_blocks(chunk, task.done())
+                late_results.extend(late)
+                yield blocks + user_address_script()
+            loop.run_until_complete(asyncio.wait(tasks))
+            for task in tasks:
+                if task.exception() is not None:
+                    debug_logger.error(
+                        "Unable to get the addresses ({}).".format(str(task.exception()))
+                    )
+            if late_results:
+                yield render_late_addresses({
+                    geo_extras.render_anchor(result, "address"): result.get_address()
+                    for result in late_results
+                })
+            yield user_address_script(wait=True) + list_tail
+            yield tail
+    finally:
+        # The client may have closed the connection.
+        pipeline.close_loop(loop)
+    return
+
 # Higher ratelimit, because users of light version may have
 # network troubles (like load interruptions).
 @ratelimit(key='ip', rate="10/m")
@@ -347,24 +720,6 @@ def light_home(request):
             errors.append(_("Vos coordonnées sont invalides."))
             user_latitude = 0.0
             user_longitude = 0.0
-        if settings.TESTING:
-            mocking_parameters = request.GET.get("mocking_parameters")
-        else:
-            mocking_parameters = None
-        user_address = user_address = utils.get_address(
-            coords=(float(user_latitude), float(user_longitude)),
-            mocking_parameters=mocking_parameters
-        )
-        if user_address:
-            user_address = escape(user_address[1])
-        else:
-            user_address = _("Adresse inconnue")
-            # Does not set "get_params_valid" to False, because
-            # the address is not useful for searching.
-            errors.append(_(
-                "Vos coordonnées n'ont pas permis de trouver votre "
-                "adresse actuelle."
-            ))
         try:
             radius = int(get_params[3])
             radius_extreme_values = settings.GOOSE_META["radius_extreme_values"]
@@ -377,9 +732,33 @@ def light_home(request):
             errors.append(_("Le rayon de recherche demandé est invalide."))
             radius = 0
         no_private = get_params[4] == '1'
+        if settings.TESTING:
+            mocking_parameters = request.GET.get("mocking_parameters")
+        else:
+            mocking_parameters = None
+        if get_params_valid and settings.GOOSE_LIGHT["streaming"]:
+            # Looked up while the page is streamed, so that its head
+            # is sent at once (see "stream_light_results").
+            user_address = None
+        else:
+            user_address = user_address = utils.get_address(
+                coords=(float(user_latitude), float(user_longitude)),
+                mocking_parameters=mocking_parameters
+            )
+            if user_address:
+                user_address = escape(user_address[1])
+            else:
+                user_address = _("Adresse inconnue")
+                # Does not set "get_params_valid" to False, because
+                # the address is not useful for searching.
+                errors.append(_(
+                    "Vos coordonnées n'ont pas permis de trouver votre "
+                    "adresse actuelle."
+                ))
     else:
         use_get_params = False
         get_params_valid = None
+        mocking_parameters = None
         search_preset = form.cleaned_data["search_preset"]
         user_latitude = form.cleaned_data["latitude"]
         user_longitude = form.cleaned_data["longitude"]
@@ -422,20 +801,35 @@ def light_home(request):
             "error_msg": error_msg
         })
     
-    timezone_name = tf.timezone_at(lat=user_latitude, lng=user_longitude)
-    if timezone_name is None:
-        timezone_name = tf.closest_timezone_at(lat=user_latitude, lng=user_longitude)
-    if timezone_name is None:
-        timezone_name = 'UTC'
+    if settings.GOOSE_LIGHT["streaming"]:
+        log_search(request, search_preset.id, radius, user_latitude, user_longitude)
+        find_user_address = user_address is None
+        if find_user_address:
+            user_address = format_html(
+                '<span id="user_address">{}</span>', _("Recherche de l'adresse…")
+            )
+        head, tail = render_to_string("search/light_results.html", {
+            "results_marker": RESULTS_MARKER,
+            "user_coords": user_coords,
+            "user_address": user_address,
+            "search_description": search_description,
+            "permalink": permalink,
+            "error_msg": ''
+        }, request=request).split(RESULTS_MARKER)
+        response = StreamingHttpResponse(stream_light_results(
+            head, tail, search_preset, user_coords, radius, no_private,
+            translation.get_language(), find_user_address, mocking_parameters
+        ))
+        # Disables the buffering of the reverse proxy (Nginx).
+        response["X-Accel-Buffering"] = "no"
+        return response
     
     results = []
     error_msg = ''
     try:
-        results = utils.get_results(
-            search_preset, user_coords, radius,
-            no_private, timezone_name
-        )
-        utils.get_all_addresses(results)
+        results = pipeline.run(pipeline.search(
+            search_preset, user_coords, radius, no_private
+        )).results
         debug_logger.debug("Request successfull!")
     except geopy.exc.GeopyError as e:
         error_msg = _(
@@ -458,20 +852,7 @@ def light_home(request):
         debug_msg = str(e)
         debug_logger.debug("Unhandled error: {}".format(str(e)))
         raise e
-    # Logs the request to make statistics.
-    # Doesn't logs if the request comes from an authenticated user,
-    # as it is probably an admin.
-    if not request.user.is_authenticated():
-        logger = logging.getLogger("statistics")
-        logger.info(
-            "search:{id}:{radius}:{lat}:{lon}".format(
-                id=search_preset.id,
-                radius=radius,
-                # Rounds the stored coordinates for privacy's sake.
-                lat=round(user_latitude),
-                lon=round(user_longitude)
-            )
-        )
+    log_search(request, search_preset.id, radius, user_latitude, user_longitude)
     
     return render(request, "search/light_results.html", {
         "results": results,
@@ -495,6 +876,21 @@ def about(request):
     logger.info("about_page")
     return render(request, "search/about.html", {"base_template": base_template})
 
+def status(request):
+    """
+        Returns some statistics about the internals of the current
+        process (caches...), as JSON. Reserved to staff members.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden("This URL is for staff members only.")
+    return JsonResponse({
+        "caches": caching.get_stats(),
+        "overpass_endpoints": utils.overpass_endpoints.stats(),
+        "breakers": upstream.get_breakers_stats(),
+        "rate_limits": upstream.get_buckets_stats(),
+        "hosts": http_client.get_stats(),
+    })
+
 def handler404(request):
     return render(request, "404.html", status=404)
 